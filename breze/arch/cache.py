@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+
+"""Module providing a cache for compiled Theano functions.
+
+Compiling a Theano graph is expensive: the graph has to be optimized and C
+code has to be generated or looked up for every node. Since the same model
+architectures tend to be compiled over and over again, e.g. after restarting a
+worker process, this module offers a content addressed cache for compiled
+functions.
+
+Functions are identified by the structure of their graph, the input/output
+signature, the compilation mode and the relevant parts of the Theano
+configuration (such as ``floatX``). There are two tiers: a memory tier, which
+holds a bounded number of function objects of the current process, and an
+optional on-disk tier, which holds pickled functions in a directory of bounded
+size. Least recently used entries are evicted first in both tiers.
+
+Graphs which contain shared variables (e.g. random number generators) are only
+cached in memory, since the unpickled function would not be connected to the
+shared variables of the current process anymore.
+
+The on-disk tier is enabled by setting the environment variable
+``BREZE_FUNCTION_CACHE_DIR`` to a directory. Its maximum size in megabytes can
+be set via ``BREZE_FUNCTION_CACHE_SIZE``. The memory tier of the process wide
+cache is enabled by setting ``BREZE_FUNCTION_CACHE_ITEMS`` to the number of
+functions it may hold. Note that it hands out the same function object for
+every request of an equal graph.
+"""
+
+
+import collections
+import cPickle
+import hashlib
+import os
+import re
+import tempfile
+import time
+import warnings
+
+import numpy as np
+import theano
+from theano.compile import SharedVariable
+from theano.gof import Constant, Variable
+from theano.gof.graph import io_toposort, inputs as graph_inputs
+
+
+# Used to remove memory addresses from string representations, which would
+# otherwise make keys differ between processes.
+_address_re = re.compile(r' at 0x[0-9a-fA-F]+')
+
+
+def _clean(s):
+    return _address_re.sub('', s)
+
+
+def _data_signature(data):
+    arr = np.asarray(data)
+    return '%s%s:%s' % (arr.dtype, arr.shape,
+                        hashlib.sha1(arr.tostring()).hexdigest())
+
+
+def _op_signature(op):
+    sig = [type(op).__module__, type(op).__name__, _clean(str(op))]
+    props = getattr(op, '__props__', None)
+    if props:
+        sig.append(_clean(repr([getattr(op, i) for i in props])))
+    info = getattr(op, 'info', None)
+    if isinstance(info, dict):
+        # Scan keeps its configuration in here.
+        sig.append(_clean(repr(sorted(info.items()))))
+    if (isinstance(getattr(op, 'inputs', None), list)
+            and isinstance(getattr(op, 'outputs', None), list)):
+        # Ops with inner graphs, e.g. scan; the inner inputs are identified by
+        # their position.
+        inner_sig, _ = graph_signature(op.inputs, op.outputs)
+        sig.append(inner_sig)
+    return '|'.join(sig)
+
+
+def graph_signature(inputs, outputs):
+    """Return a pair ``(signature, portable)`` for the graph leading from
+    ``inputs`` to ``outputs``.
+
+    ``signature`` is a hex digest that only depends on the structure of the
+    graph, i.e. the operations, the types of the variables, the values of
+    constants and the positions of the inputs.
+
+    ``portable`` is False if the signature depends on objects of the current
+    process (e.g. shared variables or free variables which are not part of
+    ``inputs``), in which case it must not be used across processes."""
+    sigs = {}
+    portable = [True]
+
+    for i, var in enumerate(inputs):
+        sigs[var] = 'i%i:%s' % (i, var.type)
+
+    def var_sig(var):
+        if var in sigs:
+            return sigs[var]
+        if isinstance(var, Constant):
+            sig = 'c:%s:%s' % (var.type, _data_signature(var.data))
+        else:
+            # Shared variables and free variables are not determined by the
+            # structure alone.
+            portable[0] = False
+            sig = 'x:%s:%i' % (var.type, id(var))
+        sigs[var] = sig
+        return sig
+
+    h = hashlib.sha1()
+    roots = graph_inputs(outputs)
+    for node in io_toposort(roots, outputs):
+        in_sigs = [var_sig(i) for i in node.inputs]
+        node_sig = '%s(%s)' % (_op_signature(node.op), ','.join(in_sigs))
+        h.update(node_sig)
+        node_hash = hashlib.sha1(node_sig).hexdigest()
+        for j, out in enumerate(node.outputs):
+            sigs[out] = 'n%s.%i:%s' % (node_hash, j, out.type)
+
+    h.update('->' + ','.join(var_sig(i) for i in outputs))
+    return h.hexdigest(), portable[0]
+
+
+def _variables_of(obj):
+    """Return a list of the Theano variables in ``obj``, which is a variable,
+    an output specification or a value."""
+    if isinstance(obj, theano.Out):
+        return [obj.variable]
+    if isinstance(obj, Variable):
+        return [obj]
+    return []
+
+
+class FunctionCache(object):
+    """FunctionCache class.
+
+    Two tier cache of compiled Theano functions.
+
+    Parameters
+    ----------
+
+    directory : string or None, optional, default: None
+        Directory of the on-disk tier. If None, only the memory tier is used.
+
+    max_disk_bytes : integer, optional, default: 512MB
+        Maximum number of bytes the on-disk tier may occupy.
+
+    max_memory_items : integer, optional, default: 128
+        Maximum number of functions held in the memory tier. If zero, the
+        memory tier is disabled.
+
+
+    Attributes
+    ----------
+
+    stats : dictionary
+        Totals over all requests with the keys ``memory_hits``,
+        ``disk_hits``, ``misses``, ``compile_time`` and ``load_time``.
+    """
+
+    def __init__(self, directory=None, max_disk_bytes=512 * 2 ** 20,
+                 max_memory_items=128):
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_items = max_memory_items
+
+        self._memory = collections.OrderedDict()
+        self.stats = dict(memory_hits=0, disk_hits=0, misses=0,
+                          compile_time=0., load_time=0.)
+
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, inputs, outputs, **kwargs):
+        """Return a pair ``(key, portable)`` identifying the function that
+        ``theano.function(inputs, outputs, **kwargs)`` would compile.
+
+        ``portable`` is False if the key is only valid within the current
+        process."""
+        key, portable, _ = self._key(inputs, outputs, **kwargs)
+        return key, portable
+
+    def _key(self, inputs, outputs, **kwargs):
+        """Return a triple ``(key, portable, pinned)``, where the first two
+        are as in ``.key``.
+
+        Keys which are not portable embed the ids of objects of the current
+        process. ``pinned`` holds references to all of them, which have to be
+        kept alive as long as the key is in use; otherwise the ids might be
+        given to different objects after garbage collection."""
+        givens = kwargs.pop('givens', None) or {}
+        updates = kwargs.pop('updates', None) or {}
+        mode = kwargs.pop('mode', None)
+
+        pairs = list(givens.items()) + list(updates.items())
+        graph_outputs = []
+        for o in outputs:
+            graph_outputs += _variables_of(o)
+        for k, v in pairs:
+            graph_outputs += _variables_of(k) + _variables_of(v)
+
+        signature, portable = graph_signature(inputs, graph_outputs)
+        # Shared and free variables are ancestors of the outputs.
+        pinned = [list(inputs), graph_outputs, mode]
+
+        extra = [
+            'outputs:%s' % [getattr(o, 'borrow', None) for o in outputs],
+            'pairs:%i,%i' % (len(givens), len(updates)),
+        ]
+        # Givens can be substituted with plain values.
+        extra += [_data_signature(v) for _, v in pairs
+                  if not _variables_of(v)]
+
+        if mode is None or isinstance(mode, str):
+            extra.append('mode:%s' % mode)
+        else:
+            portable = False
+            extra.append('mode:%i' % id(mode))
+
+        extra += ['%s:%r' % (k, kwargs[k]) for k in sorted(kwargs)]
+        extra += [
+            'theano:%s' % theano.__version__,
+            'floatX:%s' % theano.config.floatX,
+            'device:%s' % theano.config.device,
+            'config_mode:%s' % theano.config.mode,
+            'optimizer:%s' % theano.config.optimizer,
+            'linker:%s' % theano.config.linker,
+        ]
+
+        h = hashlib.sha1(signature)
+        h.update('|'.join(extra))
+        return h.hexdigest(), portable, pinned
+
+    def function(self, inputs, outputs, **kwargs):
+        """Return a pair ``(f, info)``, where ``f`` is the result of
+        ``theano.function(inputs, outputs, **kwargs)``, served from the cache
+        if possible.
+
+        ``info`` is a dictionary describing this request, with the keys
+        ``key``, ``source`` (one of ``memory``, ``disk`` or ``compile``) and
+        ``time``, the seconds it took to obtain the function."""
+        start = time.time()
+        key, portable, pinned = self._key(inputs, outputs, **kwargs.copy())
+
+        entry = self._memory.pop(key, None)
+        if entry is not None:
+            self._memory[key] = entry
+            f = entry[0]
+            self.stats['memory_hits'] += 1
+            return f, dict(key=key, source='memory',
+                           time=time.time() - start)
+
+        use_disk = portable and self.directory is not None
+        if use_disk:
+            f = self._load(key)
+            if f is not None:
+                self._remember(key, f, pinned)
+                took = time.time() - start
+                self.stats['disk_hits'] += 1
+                self.stats['load_time'] += took
+                return f, dict(key=key, source='disk', time=took)
+
+        f = theano.function(inputs, outputs, **kwargs)
+        took = time.time() - start
+        self.stats['misses'] += 1
+        self.stats['compile_time'] += took
+
+        self._remember(key, f, pinned)
+        if use_disk:
+            self._store(key, f)
+        return f, dict(key=key, source='compile', time=took)
+
+    def clear(self, disk=False):
+        """Empty the memory tier and, if ``disk`` is True, the on-disk tier."""
+        self._memory.clear()
+        if disk and self.directory is not None:
+            for fn, _, _ in self._disk_entries():
+                os.remove(fn)
+
+    def _remember(self, key, f, pinned):
+        if self.max_memory_items < 1:
+            return
+        # The entry holds on to ``pinned``, so that no other object can get
+        # one of the ids in the key while it is in memory.
+        self._memory[key] = f, pinned
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pkl')
+
+    def _disk_entries(self):
+        """Return a list of triples ``(filename, size, last_used)``."""
+        entries = []
+        for fn in os.listdir(self.directory):
+            if not fn.endswith('.pkl'):
+                continue
+            fn = os.path.join(self.directory, fn)
+            try:
+                st = os.stat(fn)
+            except OSError:
+                # Removed by another process in the meantime.
+                continue
+            entries.append((fn, st.st_size, st.st_mtime))
+        return entries
+
+    def _load(self, key):
+        fn = self._path(key)
+        if not os.path.exists(fn):
+            return None
+
+        # The stored graph has already been optimized.
+        reoptimize = theano.config.reoptimize_unpickled_function
+        theano.config.reoptimize_unpickled_function = False
+        try:
+            with open(fn, 'rb') as fp:
+                f = cPickle.load(fp)
+        except Exception:
+            # Truncated or stale entry, e.g. from a different Theano version.
+            f = None
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+        finally:
+            theano.config.reoptimize_unpickled_function = reoptimize
+
+        if f is not None:
+            # Mark as recently used for eviction.
+            try:
+                os.utime(fn, None)
+            except OSError:
+                pass
+        return f
+
+    def _store(self, key, f):
+        try:
+            data = cPickle.dumps(f, protocol=cPickle.HIGHEST_PROTOCOL)
+        except Exception, e:
+            warnings.warn('could not pickle compiled function: %s' % e)
+            return
+
+        if len(data) > self.max_disk_bytes:
+            return
+
+        # Write to a temporary file first and rename it, so other processes
+        # never see half written entries.
+        fd, tmp_fn = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        os.rename(tmp_fn, self._path(key))
+
+        self._evict()
+
+    def _evict(self):
+        entries = sorted(self._disk_entries(), key=lambda x: x[2])
+        total = sum(i[1] for i in entries)
+        for fn, size, _ in entries:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+            total -= size
+
+
+def cache_from_environ():
+    """Return a FunctionCache configured by the environment variables
+    ``BREZE_FUNCTION_CACHE_DIR``, ``BREZE_FUNCTION_CACHE_SIZE`` and
+    ``BREZE_FUNCTION_CACHE_ITEMS``.
+
+    The memory tier is disabled unless ``BREZE_FUNCTION_CACHE_ITEMS`` is
+    set."""
+    directory = os.environ.get('BREZE_FUNCTION_CACHE_DIR', None)
+    size = os.environ.get('BREZE_FUNCTION_CACHE_SIZE', None)
+    items = os.environ.get('BREZE_FUNCTION_CACHE_ITEMS', 0)
+    kwargs = {'max_memory_items': int(items)}
+    if size is not None:
+        kwargs['max_disk_bytes'] = int(float(size) * 2 ** 20)
+    return FunctionCache(directory, **kwargs)
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 
+import numpy as np
+import theano
 import theano.tensor as T
 
 import norm as norm_
@@ -13,10 +15,59 @@ def pairwise_diff(X, Y=None):
     return diffs
 
 
-def distance_matrix(X, Y=None, norm=norm_.l2):
-    """Return an expression containing the distances given the norm."""
-    diff = pairwise_diff(X, Y)
-    return distance_matrix_by_diff(diff, norm=norm)
+def squared_l2_distances(X, Y=None):
+    """Return an expression for the squared Euclidean distances between the
+    rows of ``X`` and ``Y`` (or ``X``, if None).
+
+    The distances are computed as ``|x|^2 + |y|^2 - 2 x^T y``, which only
+    takes memory for the result. If ``Y`` is None, the diagonal is exactly
+    zero."""
+    X_sqrd = (X ** 2).sum(axis=1)
+    if Y is None:
+        Y, Y_sqrd = X, X_sqrd
+    else:
+        Y_sqrd = (Y ** 2).sum(axis=1)
+    D2 = X_sqrd.dimshuffle(0, 'x') + Y_sqrd.dimshuffle('x', 0) - 2 * T.dot(X, Y.T)
+    # Cancellation can lead to slightly negative values.
+    D2 = T.maximum(D2, 0)
+    if X is Y:
+        D2 = D2 - T.identity_like(D2) * D2
+    return D2
+
+
+def distance_matrix(X, Y=None, norm=norm_.l2, max_bytes=None):
+    """Return an expression containing the distances given the norm.
+
+    For the (squared) Euclidean norms ``l2`` and ``root_l2``, the distances
+    are computed without any intermediate differences, see
+    ``squared_l2_distances``. For other norms, the differences of all pairs
+    of rows are formed, which takes ``n * d * m`` elements; if ``max_bytes``
+    is given, they are instead formed for blocks of rows of ``X`` taking at
+    most that many bytes each, one block after the other."""
+    if isinstance(norm, (str, unicode)):
+        norm = lookup(norm, norm_)
+    if norm is norm_.l2:
+        return squared_l2_distances(X, Y)
+    elif norm is norm_.root_l2:
+        return T.sqrt(squared_l2_distances(X, Y) + 1e-8)
+    elif max_bytes is None:
+        return distance_matrix_by_diff(pairwise_diff(X, Y), norm=norm)
+
+    Y = X if Y is None else Y
+    n, m = X.shape[0], Y.shape[0]
+    itemsize = np.dtype(X.dtype).itemsize
+    rows = T.maximum(max_bytes // (X.shape[1] * m * itemsize), 1)
+    n_blocks = (n + rows - 1) // rows
+
+    # Pad ``X`` so that all blocks have the same size.
+    X_padded = T.zeros((n_blocks * rows, X.shape[1]), dtype=X.dtype)
+    X_padded = T.set_subtensor(X_padded[:n], X)
+    blocks, _ = theano.scan(
+        lambda i, X_, Y_: distance_matrix_by_diff(
+            pairwise_diff(X_[i * rows:(i + 1) * rows], Y_), norm=norm),
+        sequences=T.arange(n_blocks),
+        non_sequences=[X_padded, Y])
+    return blocks.reshape((n_blocks * rows, m))[:n]
 
 
 def distance_matrix_by_diff(diff, norm=norm_.l2):
@@ -26,6 +77,91 @@ def distance_matrix_by_diff(diff, norm=norm_.l2):
     return dist_comps
 
 
+# NumPy counterparts of the functions in ``breze.arch.component.norm``.
+numpy_norms = {
+    'l1': lambda x, axis=None: abs(x).sum(axis=axis),
+    'soft_l1': lambda x, axis=None: np.sqrt(x ** 2 + 1e-8).sum(axis=axis),
+    'l2': lambda x, axis=None: (x ** 2).sum(axis=axis),
+    'root_l2': lambda x, axis=None: np.sqrt((x ** 2).sum(axis=axis) + 1e-8),
+    'exp': lambda x, axis=None: np.exp(x).sum(axis=axis),
+}
+
+
+def numpy_distance_matrix(X, Y=None, norm='l2', max_bytes=2 ** 26, out=None):
+    """Return an array containing the distances between the rows of ``X`` and
+    ``Y`` (or ``X``, if None) given the norm, computed with NumPy.
+
+    Parameters
+    ----------
+
+    X : array_like
+        Array of shape ``(n, d)``.
+
+    Y : array_like, optional, default: None
+        Array of shape ``(m, d)``.
+
+    norm : string or function, optional, default: 'l2'
+        Name of a norm in ``breze.arch.component.norm``, such a norm
+        function itself or a function of an array of shape ``(k, d, m)`` and
+        ``axis=1`` returning an array of shape ``(k, m)``.
+
+    max_bytes : integer, optional, default: 64MB
+        Maximum number of bytes of intermediate results. Rows of ``X`` are
+        processed in blocks accordingly.
+
+    out : array_like, optional, default: None
+        Array of shape ``(n, m)`` to write the result to.
+
+    Returns
+    -------
+
+    D : array_like
+        Array of shape ``(n, m)``.
+    """
+    if not isinstance(norm, (str, unicode)):
+        # Translate the Theano norms.
+        if getattr(norm_, getattr(norm, '__name__', ''), None) is norm:
+            norm = norm.__name__
+    if isinstance(norm, (str, unicode)):
+        try:
+            norm = numpy_norms[norm]
+        except KeyError:
+            raise ValueError('could not find norm %s' % norm)
+
+    X = np.asarray(X)
+    same = Y is None
+    Y = X if same else np.asarray(Y)
+    n, d = X.shape
+    m = Y.shape[0]
+    if out is None:
+        out = np.empty((n, m), dtype=np.result_type(X, Y))
+
+    euclidean = norm in (numpy_norms['l2'], numpy_norms['root_l2'])
+    row_bytes = m * X.itemsize * (1 if euclidean else d)
+    rows = max(max_bytes // max(row_bytes, 1), 1)
+
+    if euclidean:
+        Y_sqrd = (Y ** 2).sum(axis=1)
+    for start in range(0, n, rows):
+        stop = min(start + rows, n)
+        block = out[start:stop]
+        if not euclidean:
+            block[...] = norm(X[start:stop, :, np.newaxis]
+                              - Y.T[np.newaxis], axis=1)
+            continue
+        block[...] = np.dot(X[start:stop], Y.T)
+        block *= -2
+        block += (X[start:stop] ** 2).sum(axis=1)[:, np.newaxis]
+        block += Y_sqrd
+        np.maximum(block, 0, out=block)
+        if same:
+            block[np.arange(stop - start), np.arange(start, stop)] = 0
+        if norm is numpy_norms['root_l2']:
+            block += 1e-8
+            np.sqrt(block, out=block)
+    return out
+
+
 def discrete_entropy(X, axis=None):
     X = T.minimum(1, X + 1e-8)
     return -(X * T.log(X)).sum(axis=axis)
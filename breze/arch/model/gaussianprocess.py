@@ -60,12 +60,11 @@ class GaussianProcess(Model):
         amplitude = T.exp(amplitude) + 1e-4
 
         # In the case of stationary kernels (those which work on the distances
-        # only) we can save some work by caching the distances. Thus we first
-        # find out if it is a stationary tensor by checking whether the kernel
-        # can be computed by looking at diffs only---this is the case if a
-        # ``XXX_by_diff`` function is available in the kernel modile.
-        # I that is the case, we add the diff expr to the exprs dict, so it can
-        # be exploited by code on the top via a givens directory.
+        # only) we can save some work by computing the distances only once.
+        # Thus we first find out if it is a stationary tensor by checking
+        # whether the kernel can be computed by looking at distances only---this
+        # is the case if a ``XXX_by_dist`` function is available in the kernel
+        # module.
 
         kernel_by_dist_func = lookup('%s_by_dist' % kernel, kernel_, None)
         stationary = kernel_by_dist_func is not None
@@ -73,8 +72,8 @@ class GaussianProcess(Model):
 
         if stationary:
             inpt_scaled = inpt * length_scales.dimshuffle('x', 0)
-            diff = exprs['diff'] = misc.pairwise_diff(inpt_scaled, inpt_scaled)
-            D2 = exprs['sqrd_dist'] = misc.distance_matrix_by_diff(diff, 'l2')
+            D2 = exprs['sqrd_dist'] = misc.distance_matrix(inpt_scaled, None,
+                                                           'l2')
             K = amplitude * kernel_by_dist_func(D2)
             exprs['D2'] = D2
         else:
@@ -5,28 +5,59 @@ import numpy as np
 
 import theano
 import theano.tensor as T
-from theano.tensor.extra_ops import repeat
 from theano.tensor.shared_randomstreams import RandomStreams
 
 from ...util import ParameterSet, Model, lookup
 from ...component import transfer, loss as loss_
 
 
-def recurrent_layer(hidden_inpt, hidden_to_hidden, f, initial_hidden):
+def carry_masked(new, old, m):
+    """Return ``new`` for the samples where the vector ``m`` is 1 and ``old``
+    where it is 0, i.e. carry the state ``old`` over padded time steps."""
+    m = m.dimshuffle(0, 'x')
+    return m * new + (1 - m) * old
+
+
+def masked_mean(loss, mask):
+    """Return the mean of the time step wise ``loss`` of shape ``(t, n)`` over
+    the time steps where ``mask`` is 1."""
+    return (loss * mask).sum() / mask.sum()
+
+
+def state_names(exprs):
+    """Return the sorted names of the recurrent states in ``exprs``.
+
+    For each such name ``n``, ``exprs['initial_' + n]`` is the matrix of
+    shape ``(n_samples, n_units)`` a recurrence starts from and
+    ``exprs['final_' + n]`` the matrix it ends with. Replacing the former
+    (e.g. via the ``givens`` of ``Model.function``) continues a sequence from
+    a given state."""
+    return sorted(k[len('initial_'):] for k in exprs
+                  if k.startswith('initial_')
+                  and 'final_' + k[len('initial_'):] in exprs)
+
+
+def recurrent_layer(hidden_inpt, hidden_to_hidden, f, initial_hidden,
+                    mask=None):
     def step(x, hi_tm1):
         h_tm1 = f(hi_tm1)
         hi = T.dot(h_tm1, hidden_to_hidden) + x
         return hi
 
-    # Modify the initial hidden state to obtain several copies of
-    # it, one per sample.
-    initial_hidden_b = repeat(initial_hidden, hidden_inpt.shape[1], axis=0)
-    initial_hidden_b = initial_hidden_b.reshape(
-        (hidden_inpt.shape[1], hidden_inpt.shape[2]))
+    def masked_step(x, m, hi_tm1):
+        return carry_masked(step(x, hi_tm1), hi_tm1, m)
+
+    if initial_hidden.ndim == 1:
+        # Modify the initial hidden state to obtain several copies of
+        # it, one per sample.
+        initial_hidden_b = T.alloc(initial_hidden, hidden_inpt.shape[1],
+                                   initial_hidden.shape[0])
+    else:
+        initial_hidden_b = initial_hidden
 
     hidden_in_rec, _ = theano.scan(
-        step,
-        sequences=hidden_inpt,
+        step if mask is None else masked_step,
+        sequences=hidden_inpt if mask is None else [hidden_inpt, mask],
         outputs_info=[initial_hidden_b])
 
     hidden_rec = f(hidden_in_rec)
@@ -36,33 +67,46 @@ def recurrent_layer(hidden_inpt, hidden_to_hidden, f, initial_hidden):
 
 def lstm_layer(hidden_inpt, hidden_to_hidden,
                ingate_peephole, outgate_peephole, forgetgate_peephole,
-               f):
+               f, mask=None, initial_state=None, initial_hidden=None):
+    """Return a pair ``(states, hidden)`` of the cell states and the outputs
+    of an LSTM layer over the sequence of input projections ``hidden_inpt``.
+
+    The input projections of all time steps are expected to be computed
+    beforehand with a single product (e.g. by ``feedforward_layer``), so that
+    the scan only does the recurrent product. The weights are passed to the
+    scan explicitly instead of being found in the step graph."""
     n_hidden_out = hidden_to_hidden.shape[0]
 
-    def lstm_step(x_t, s_tm1, h_tm1):
-        x_t += T.dot(h_tm1, hidden_to_hidden)
+    def lstm_step(x_t, s_tm1, h_tm1, hidden_to_hidden, ingate_peephole,
+                  forgetgate_peephole, outgate_peephole):
+        x_t = x_t + T.dot(h_tm1, hidden_to_hidden)
 
         inpt = T.tanh(x_t[:, :n_hidden_out])
         gates = x_t[:, n_hidden_out:]
-        inpeep = s_tm1 * ingate_peephole
-        outpeep = s_tm1 * outgate_peephole
-        forgetpeep = s_tm1 * forgetgate_peephole
-
-        ingate = f(gates[:, :n_hidden_out] + inpeep)
-        forgetgate = f(
-            gates[:, n_hidden_out:2 * n_hidden_out] + forgetpeep)
-        outgate = f(gates[:, 2 * n_hidden_out:] + outpeep)
+        ingate = f(gates[:, :n_hidden_out] + s_tm1 * ingate_peephole)
+        forgetgate = f(gates[:, n_hidden_out:2 * n_hidden_out]
+                       + s_tm1 * forgetgate_peephole)
+        outgate = f(gates[:, 2 * n_hidden_out:] + s_tm1 * outgate_peephole)
 
         s_t = inpt * ingate + s_tm1 * forgetgate
         h_t = f(s_t) * outgate
         return [s_t, h_t]
 
+    def masked_lstm_step(x_t, m_t, s_tm1, h_tm1, *non_sequences):
+        s_t, h_t = lstm_step(x_t, s_tm1, h_tm1, *non_sequences)
+        return [carry_masked(s_t, s_tm1, m_t), carry_masked(h_t, h_tm1, m_t)]
+
+    if initial_state is None:
+        initial_state = T.zeros_like(hidden_inpt[0, :, 0:n_hidden_out])
+    if initial_hidden is None:
+        initial_hidden = T.zeros_like(hidden_inpt[0, :, 0:n_hidden_out])
+
     (states, hidden_rec), _ = theano.scan(
-        lstm_step,
-        sequences=hidden_inpt,
-        outputs_info=[T.zeros_like(hidden_inpt[0, :, 0:n_hidden_out]),
-                      T.zeros_like(hidden_inpt[0, :, 0:n_hidden_out])
-                      ])
+        lstm_step if mask is None else masked_lstm_step,
+        sequences=hidden_inpt if mask is None else [hidden_inpt, mask],
+        outputs_info=[initial_state, initial_hidden],
+        non_sequences=[hidden_to_hidden, ingate_peephole,
+                       forgetgate_peephole, outgate_peephole])
 
     return states, hidden_rec
 
@@ -81,15 +125,22 @@ def feedforward_layer(inpt, weights, bias):
     return output
 
 
-def leaky_integration(inpt, coefficients):
+def leaky_integration(inpt, coefficients, mask=None, initial=None):
     def step(x, y_tm1):
         c = coefficients[np.newaxis]
         y = c * y_tm1 + (1 - c) * x
         return y
+
+    def masked_step(x, m, y_tm1):
+        return carry_masked(step(x, y_tm1), y_tm1, m)
+
+    if initial is None:
+        initial = T.zeros_like(inpt[0])
+
     output, _ = theano.scan(
-        step,
-        sequences=inpt,
-        outputs_info=[T.zeros_like(inpt[0])])
+        step if mask is None else masked_step,
+        sequences=inpt if mask is None else [inpt, mask],
+        outputs_info=[initial])
     return output
 
 
@@ -111,7 +162,9 @@ def weighted_pooling(inpt):
     return res_flat.reshape((inpt.shape[1], inpt.shape[2]))
 
 
-def pooling_layer(inpt, typ):
+def pooling_layer(inpt, typ, mask=None):
+    if mask is not None:
+        return masked_pooling_layer(inpt, typ, mask)
     if typ == 'mean':
         output = T.mean(inpt, axis=0)
     elif typ == 'sum':
@@ -131,6 +184,29 @@ def pooling_layer(inpt, typ):
     return output
 
 
+def masked_pooling_layer(inpt, typ, mask):
+    """Return the pooling of the sequence tensor ``inpt`` over the time steps
+    where the matrix ``mask`` of shape ``(t, n)`` is 1."""
+    m = mask.dimshuffle(0, 1, 'x')
+    present = T.gt(m, 0)
+    if typ == 'mean':
+        output = (inpt * m).sum(axis=0) / T.maximum(m.sum(axis=0), 1)
+    elif typ == 'sum':
+        output = (inpt * m).sum(axis=0)
+    elif typ == 'prod':
+        output = T.prod(T.switch(present, inpt, 1), axis=0)
+    elif typ == 'min':
+        output = T.min(T.switch(present, inpt, np.inf), axis=0)
+    elif typ == 'max':
+        output = T.max(T.switch(present, inpt, -np.inf), axis=0)
+    elif typ == 'last':
+        last = inpt.shape[0] - 1 - T.argmax(mask[::-1], axis=0)
+        output = inpt[last, T.arange(inpt.shape[1])]
+    else:
+        raise ValueError('pooling operator %s does not support masks' % typ)
+    return output
+
+
 def stochastic_pooling(inpt, rng=None):
     if rng is None:
         srng = RandomStreams()
@@ -157,19 +233,34 @@ def stochastic_pooling(inpt, rng=None):
 
 def rnn(inpt, in_to_hidden, hidden_to_hiddens, hidden_to_out,
         hidden_biases, initial_hiddens, recurrents, out_bias, hidden_transfers,
-        out_transfer, pooling, leaky_coeffs=None):
+        out_transfer, pooling, leaky_coeffs=None, mask=None):
     exprs = {}
 
     f_hiddens = [lookup(i, transfer) for i in hidden_transfers]
     f_output = lookup(out_transfer, transfer)
 
+    def layer(i, hidden_in, r, t, j, c):
+        # The initial states are kept in the expressions, so that they can be
+        # replaced to continue from a given state; see ``state_names``.
+        # Unlike ``repeat``, ``alloc`` supports the R operator needed for
+        # Gauss-Newton products.
+        j = exprs['initial_hidden_in_%i' % i] = T.alloc(
+            j, hidden_in.shape[1], j.shape[0])
+        hidden_in_rec, hidden_rec = recurrent_layer(hidden_in, r, t, j, mask)
+        exprs['final_hidden_in_%i' % i] = hidden_in_rec[-1]
+        if c is not None:
+            initial = exprs['initial_leaky_%i' % i] = T.zeros_like(
+                hidden_rec[0])
+            hidden_rec = leaky_integration(hidden_rec, c, mask, initial)
+            exprs['final_leaky_%i' % i] = hidden_rec[-1]
+        exprs['hidden_in_%i' % i] = hidden_in_rec
+        exprs['hidden_%i' % i] = hidden_rec
+        return hidden_rec
+
     hidden_in = feedforward_layer(inpt, in_to_hidden, hidden_biases[0])
-    hidden_in_rec, hidden_rec = recurrent_layer(
-        hidden_in, recurrents[0], f_hiddens[0], initial_hiddens[0])
-    exprs['hidden_in_0'] = hidden_in_rec
-    if leaky_coeffs is not None:
-        hidden_rec = leaky_integration(hidden_rec, leaky_coeffs[0])
-    exprs['hidden_0'] = hidden_rec
+    hidden_rec = layer(
+        0, hidden_in, recurrents[0], f_hiddens[0], initial_hiddens[0],
+        None if leaky_coeffs is None else leaky_coeffs[0])
 
     zipped = zip(hidden_to_hiddens, hidden_biases[1:], recurrents[1:],
                     f_hiddens[1:], initial_hiddens[1:])
@@ -177,18 +268,16 @@ def rnn(inpt, in_to_hidden, hidden_to_hiddens, hidden_to_out,
     for i, (w, b, r, t, j) in enumerate(zipped):
         hidden_m1 = hidden_rec
         hidden_in = feedforward_layer(hidden_m1, w, b)
-        hidden_in_rec, hidden_rec = recurrent_layer(hidden_in, r, t, j)
-        if leaky_coeffs is not None:
-            hidden_rec = leaky_integration(hidden_rec, leaky_coeffs[i])
-        exprs['hidden_in_%i' % (i + 1)] = hidden_in_rec
-        exprs['hidden_%i' % (i + 1)] = hidden_rec
+        hidden_rec = layer(
+            i + 1, hidden_in, r, t, j,
+            None if leaky_coeffs is None else leaky_coeffs[i + 1])
 
     unpooled = feedforward_layer(hidden_rec, hidden_to_out, out_bias)
 
     if pooling is None:
         output_in = unpooled
     else:
-        output_in = pooling_layer(unpooled, pooling)
+        output_in = pooling_layer(unpooled, pooling, mask)
 
     output = f_output(output_in)
 
@@ -205,28 +294,45 @@ def rnn(inpt, in_to_hidden, hidden_to_hiddens, hidden_to_out,
 def lstm_rnn(inpt, in_to_hidden, hidden_to_hiddens, hidden_to_out,
              hidden_biases, recurrents, out_bias,
              ingate_peepholes, outgate_peepholes, forgetgate_peepholes,
-             hidden_transfers, out_transfer, pooling, leaky_coeffs=None):
+             hidden_transfers, out_transfer, pooling, leaky_coeffs=None,
+             mask=None):
         exprs = {}
 
         f_hiddens = [lookup(i, transfer) for i in hidden_transfers]
         f_output = lookup(out_transfer, transfer)
 
+        def layer(i, hidden_in, r, ig, og, fg, t, c):
+            # The initial states are kept in the expressions, so that they can
+            # be replaced to continue from a given state; see ``state_names``.
+            n_hidden = r.shape[0]
+            initial_state = exprs['initial_state_%i' % i] = T.zeros_like(
+                hidden_in[0, :, :n_hidden])
+            initial_hidden = exprs['initial_lstm_hidden_%i' % i] = (
+                T.zeros_like(hidden_in[0, :, :n_hidden]))
+            state, hidden_rec = lstm_layer(
+                hidden_in, r, ig, og, fg, t, mask,
+                initial_state, initial_hidden)
+            exprs['final_state_%i' % i] = state[-1]
+            exprs['final_lstm_hidden_%i' % i] = hidden_rec[-1]
+
+            if c is not None:
+                initial = exprs['initial_leaky_%i' % i] = T.zeros_like(
+                    hidden_rec[0])
+                hidden_rec = leaky_integration(hidden_rec, c, mask, initial)
+                exprs['final_leaky_%i' % i] = hidden_rec[-1]
+
+            exprs['state_%i' % i] = state
+            exprs['hidden_%i' % i] = hidden_rec
+            return hidden_rec
+
         # First ordinary feedforward layer.
         hidden_in = feedforward_layer(inpt, in_to_hidden, hidden_biases[0])
 
         # First recurrent layer.
-        state, hidden_rec = lstm_layer(
-            hidden_in, recurrents[0],
+        hidden_rec = layer(
+            0, hidden_in, recurrents[0],
             ingate_peepholes[0], outgate_peepholes[0], forgetgate_peepholes[0],
-            f_hiddens[0])
-
-        exprs['state_0'] = state
-        exprs['hidden_0'] = hidden_rec
-
-        if leaky_coeffs is not None:
-            hidden_rec = leaky_integration(hidden_rec, leaky_coeffs[0])
-
-        exprs['hidden_0'] = hidden_rec
+            f_hiddens[0], None if leaky_coeffs is None else leaky_coeffs[0])
 
         # Optional further recurrent layers.
         zipped = zip(hidden_to_hiddens, hidden_biases[1:], recurrents[1:],
@@ -237,20 +343,16 @@ def lstm_rnn(inpt, in_to_hidden, hidden_to_hiddens, hidden_to_out,
             hidden_m1 = hidden_rec
             hidden_in = feedforward_layer(hidden_m1, w, b)
 
-            state, hidden_rec = lstm_layer(hidden_in, r, ig, og, fg, t)
-
-            if leaky_coeffs is not None:
-                hidden_rec = leaky_integration(hidden_rec, leaky_coeffs[i])
-
-            exprs['state_%i' % (i + 1)] = state
-            exprs['hidden_%i' % (i + 1)] = hidden_rec
+            hidden_rec = layer(
+                i + 1, hidden_in, r, ig, og, fg, t,
+                None if leaky_coeffs is None else leaky_coeffs[i + 1])
 
         unpooled = feedforward_layer(hidden_rec, hidden_to_out, out_bias)
 
         if pooling is None:
             output_in = unpooled
         else:
-            output_in = pooling_layer(unpooled, pooling)
+            output_in = pooling_layer(unpooled, pooling, mask)
 
         output = f_output(output_in)
 
@@ -265,10 +367,17 @@ def lstm_rnn(inpt, in_to_hidden, hidden_to_hiddens, hidden_to_out,
 
 
 class BaseRecurrentNetwork(Model):
+    """Base class for recurrent networks.
+
+    If ``use_mask`` is True, the expressions have an additional input
+    ``mask``, a matrix of shape ``(t, n)`` which is 1 for the time steps
+    present in the sequences of a batch and 0 for padding. Over padded time
+    steps, the hidden states are carried forward unchanged. Padded time steps
+    are excluded from pooling and from the loss."""
 
     def __init__(self, n_inpt, n_hiddens, n_output,
                  hidden_transfers, out_transfer='identity', loss='squared',
-                 pooling=None, leaky_coeffs=None):
+                 pooling=None, leaky_coeffs=None, use_mask=False):
         self.n_inpt = n_inpt
         self.n_output = n_output
 
@@ -285,6 +394,7 @@ class BaseRecurrentNetwork(Model):
         self.loss = loss
         self.pooling = pooling
         self.leaky_coeffs = leaky_coeffs
+        self.use_mask = use_mask
         super(BaseRecurrentNetwork, self).__init__()
 
     def init_pars(self):
@@ -292,6 +402,9 @@ class BaseRecurrentNetwork(Model):
             self.n_inpt, self.n_hiddens, self.n_output)
         self.parameters = ParameterSet(**parspec)
 
+    def _mask_input(self):
+        return T.matrix('mask') if getattr(self, 'use_mask', False) else None
+
 
 class LstmNetworkComponent(object):
 
@@ -312,8 +425,8 @@ class LstmNetworkComponent(object):
         for i, (inlayer, outlayer) in enumerate(zipped):
             spec.update({
                 'hidden_bias_%i' % (i + 1): 4 * outlayer,
-                'hidden_to_hidden_%i': (inlayer, 4 * outlayer),
-                'recurrent_%i': (outlayer, 4 * outlayer),
+                'hidden_to_hidden_%i' % i: (inlayer, 4 * outlayer),
+                'recurrent_%i' % (i + 1): (outlayer, 4 * outlayer),
                 'ingate_peephole_%i' % (i + 1): (outlayer,),
                 'outgate_peephole_%i' % (i + 1): (outlayer,),
                 'forgetgate_peephole_%i' % (i + 1): (outlayer,)
@@ -362,15 +475,16 @@ class UnsupervisedRecurrentNetwork(BaseRecurrentNetwork, SimpleRnnComponent):
             pars.in_to_hidden, hidden_to_hiddens, pars.hidden_to_out,
             hidden_biases, initial_hiddens, recurrents, pars.out_bias,
             self.hidden_transfers, self.out_transfer, self.loss,
-            self.pooling)
+            self.pooling, self._mask_input())
 
     @staticmethod
     def make_exprs(inpt, in_to_hidden, hidden_to_hiddens, hidden_to_out,
                    hidden_biases, initial_hiddens, recurrents, out_bias,
-                   hidden_transfers, out_transfer, loss, pooling):
+                   hidden_transfers, out_transfer, loss, pooling, mask=None):
         exprs = rnn(inpt, in_to_hidden, hidden_to_hiddens,
                     hidden_to_out, hidden_biases, initial_hiddens, recurrents,
-                    out_bias, hidden_transfers, out_transfer, pooling)
+                    out_bias, hidden_transfers, out_transfer, pooling,
+                    mask=mask)
         f_loss = lookup(loss, loss_)
         loss = f_loss(exprs['output'])
 
@@ -382,8 +496,13 @@ class UnsupervisedRecurrentNetwork(BaseRecurrentNetwork, SimpleRnnComponent):
             loss_row_wise = loss.sum(axis=sum_axis)
             exprs['loss_row_wise'] = loss_row_wise
 
-            loss = loss_row_wise.mean()
+            if mask is None or pooling:
+                loss = loss_row_wise.mean()
+            else:
+                loss = masked_mean(loss_row_wise, mask)
 
+        if mask is not None:
+            exprs['mask'] = mask
         exprs['loss'] = loss
         return exprs
 
@@ -413,20 +532,26 @@ class SupervisedRecurrentNetwork(BaseRecurrentNetwork, SimpleRnnComponent):
             pars.in_to_hidden, hidden_to_hiddens, pars.hidden_to_out,
             hidden_biases, initial_hiddens, recurrents, pars.out_bias,
             self.hidden_transfers, self.out_transfer, self.loss,
-            self.pooling, self.leaky_coeffs)
+            self.pooling, self.leaky_coeffs, self._mask_input())
 
     @staticmethod
     def make_exprs(inpt, target, in_to_hidden, hidden_to_hiddens, hidden_to_out,
                    hidden_biases, initial_hiddens, recurrents, out_bias,
-                   hidden_transfers, out_transfer, loss, pooling, leaky_coeffs):
+                   hidden_transfers, out_transfer, loss, pooling, leaky_coeffs,
+                   mask=None):
         exprs = rnn(inpt, in_to_hidden, hidden_to_hiddens,
                     hidden_to_out, hidden_biases, initial_hiddens, recurrents,
                     out_bias, hidden_transfers, out_transfer, pooling,
-                    leaky_coeffs)
+                    leaky_coeffs, mask)
         f_loss = lookup(loss, loss_)
         sum_axis = 2 if not pooling else 1
         loss_row_wise = f_loss(target, exprs['output']).sum(axis=sum_axis)
-        loss = loss_row_wise.mean()
+        if mask is None or pooling:
+            loss = loss_row_wise.mean()
+        else:
+            loss = masked_mean(loss_row_wise, mask)
+        if mask is not None:
+            exprs['mask'] = mask
         exprs['target'] = target
         exprs['loss'] = loss
         exprs['loss_row_wise'] = loss_row_wise
@@ -458,24 +583,31 @@ class UnsupervisedLstmRecurrentNetwork(BaseRecurrentNetwork, LstmNetworkComponen
             hidden_biases, recurrents, pars.out_bias,
             ingate_peepholes, outgate_peepholes, forgetgate_peepholes,
             self.hidden_transfers, self.out_transfer, self.loss, self.pooling,
-            self.leaky_coeffs)
+            self.leaky_coeffs, self._mask_input())
 
     @staticmethod
     def make_exprs(inpt,
                    in_to_hidden, hidden_to_hiddens, hidden_to_out,
                    hidden_biases, recurrents, out_bias,
                    ingate_peepholes, outgate_peepholes, forgetgate_peepholes,
-                   hidden_transfers, out_transfer, loss, pooling, leaky_coeffs):
+                   hidden_transfers, out_transfer, loss, pooling, leaky_coeffs,
+                   mask=None):
 
         exprs = lstm_rnn(
             inpt, in_to_hidden, hidden_to_hiddens, hidden_to_out,
             hidden_biases, recurrents, out_bias,
             ingate_peepholes, outgate_peepholes, forgetgate_peepholes,
-            hidden_transfers, out_transfer, pooling, leaky_coeffs)
+            hidden_transfers, out_transfer, pooling, leaky_coeffs, mask)
 
         f_loss = lookup(loss, loss_)
         sum_axis = 2 if not pooling else 1
-        loss = f_loss(exprs['output']).sum(axis=sum_axis).mean()
+        loss_row_wise = f_loss(exprs['output']).sum(axis=sum_axis)
+        if mask is None or pooling:
+            loss = loss_row_wise.mean()
+        else:
+            loss = masked_mean(loss_row_wise, mask)
+        if mask is not None:
+            exprs['mask'] = mask
         exprs['loss'] = loss
         return exprs
 
@@ -509,24 +641,31 @@ class SupervisedLstmRecurrentNetwork(BaseRecurrentNetwork, LstmNetworkComponent)
             hidden_biases, recurrents, pars.out_bias,
             ingate_peepholes, outgate_peepholes, forgetgate_peepholes,
             self.hidden_transfers, self.out_transfer, self.loss, self.pooling,
-            self.leaky_coeffs)
+            self.leaky_coeffs, self._mask_input())
 
     @staticmethod
     def make_exprs(inpt, target,
                    in_to_hidden, hidden_to_hiddens, hidden_to_out,
                    hidden_biases, recurrents, out_bias,
                    ingate_peepholes, outgate_peepholes, forgetgate_peepholes,
-                   hidden_transfers, out_transfer, loss, pooling, leaky_coeffs):
+                   hidden_transfers, out_transfer, loss, pooling, leaky_coeffs,
+                   mask=None):
 
         exprs = lstm_rnn(
             inpt, in_to_hidden, hidden_to_hiddens, hidden_to_out,
             hidden_biases, recurrents, out_bias,
             ingate_peepholes, outgate_peepholes, forgetgate_peepholes,
-            hidden_transfers, out_transfer, pooling, leaky_coeffs)
+            hidden_transfers, out_transfer, pooling, leaky_coeffs, mask)
 
         f_loss = lookup(loss, loss_)
         sum_axis = 2 if not pooling else 1
-        loss = f_loss(target, exprs['output']).sum(axis=sum_axis).mean()
+        loss_row_wise = f_loss(target, exprs['output']).sum(axis=sum_axis)
+        if mask is None or pooling:
+            loss = loss_row_wise.mean()
+        else:
+            loss = masked_mean(loss_row_wise, mask)
+        if mask is not None:
+            exprs['mask'] = mask
 
         exprs['loss'] = loss
         exprs['target'] = target
@@ -21,7 +21,8 @@ from theano.tensor.extra_ops import repeat
 
 from ...util import lookup
 from ...component.varprop import transfer, loss as loss_
-from ...model.sequential.rnn import BaseRecurrentNetwork, SimpleRnnComponent
+from ...model.sequential.rnn import (
+    BaseRecurrentNetwork, SimpleRnnComponent, carry_masked, masked_mean)
 import mlp
 
 
@@ -206,7 +207,7 @@ def int_forward_layer(in_mean, in_var, weights, mean_bias, var_bias_sqrt,
 
 
 def recurrent_layer(in_mean, in_var, weights, f, initial_hidden,
-                    p_dropout):
+                    p_dropout, mask=None):
     """Return a theano variable representing a recurrent layer.
 
     Parameters
@@ -234,6 +235,11 @@ def recurrent_layer(in_mean, in_var, weights, f, initial_hidden,
     p_dropout : Theano variable
         Scalar representing the probability that unit is dropped out.
 
+    mask : Theano variable, optional
+        Theano matrix of shape ``(t, n)`` which is 1 for time steps present
+        and 0 for padding. Over padded time steps, the hidden state is carried
+        forward unchanged.
+
 
     Returns
     -------
@@ -270,13 +276,19 @@ def recurrent_layer(in_mean, in_var, weights, f, initial_hidden,
 
         return hom, hov, fhom, fhov
 
+    def masked_step(inpt_mean, inpt_var, m, him_m1, hiv_m1, hom_m1, hov_m1):
+        new = step(inpt_mean, inpt_var, him_m1, hiv_m1, hom_m1, hov_m1)
+        old = him_m1, hiv_m1, hom_m1, hov_m1
+        return [carry_masked(i, j, m) for i, j in zip(new, old)]
+
     initial_hidden_mean = repeat(initial_hidden.dimshuffle('x', 0), in_mean.shape[1], axis=0)
 
     initial_hidden_var = T.zeros_like(initial_hidden_mean) + 1e-8
 
+    sequences = [in_mean, in_var] + ([] if mask is None else [mask])
     (hidden_in_mean_rec, hidden_in_var_rec, hidden_mean_rec, hidden_var_rec), _ = theano.scan(
-        step,
-        sequences=[in_mean, in_var],
+        step if mask is None else masked_step,
+        sequences=sequences,
         outputs_info=[T.zeros_like(initial_hidden_mean),
                       T.zeros_like(initial_hidden_var),
                       initial_hidden_mean,
@@ -291,7 +303,8 @@ def recurrent_layer(in_mean, in_var, weights, f, initial_hidden,
 
 def rnn(inpt_mean, inpt_var, in_to_hidden, hidden_to_hiddens, hidden_to_out,
         hidden_biases, hidden_var_biases_sqrt, initial_hiddens, recurrents,
-        out_bias, hidden_transfers, out_transfer, p_dropouts, hotk_inpt):
+        out_bias, hidden_transfers, out_transfer, p_dropouts, hotk_inpt,
+        mask=None):
     """Return a dictionary containing Theano expressions for various components
     of a recurrent network with variance propagation.
 
@@ -349,6 +362,13 @@ def rnn(inpt_mean, inpt_var, in_to_hidden, hidden_to_hiddens, hidden_to_out,
         drop out units from hidden to out, while the one before is used to drop
         out units from hidden to hidden.
 
+    hotk_inpt : boolean
+        Flag indicating whether the input is given as integer indices.
+
+    mask : Theano variable, optional
+        Matrix of shape ``(t, n)`` marking the time steps present in the
+        sequences, see ``recurrent_layer``.
+
     Returns
     -------
 
@@ -393,7 +413,7 @@ def rnn(inpt_mean, inpt_var, in_to_hidden, hidden_to_hiddens, hidden_to_out,
 
     hmi_rec, hvi_rec, hmo_rec, hvo_rec = recurrent_layer(
         hmi, hvi, recurrents[0], f_hiddens[0], initial_hiddens[0],
-        p_dropouts[1])
+        p_dropouts[1], mask)
 
     exprs.update({
         'hidden_in_mean_0': hmi_rec,
@@ -413,7 +433,7 @@ def rnn(inpt_mean, inpt_var, in_to_hidden, hidden_to_hiddens, hidden_to_out,
             hmo_rec_m1, hvo_rec_m1, w, b, vb, t, d)
 
         hmi_rec, hvi_rec, hmo_rec, hvo_rec = recurrent_layer(
-            hmi, hvi, r, t, j, d)
+            hmi, hvi, r, t, j, d, mask)
 
         exprs.update({
             'hidden_in_mean_%i' % (i + 1): hmi,
@@ -448,7 +468,7 @@ class SupervisedRecurrentNetwork(BaseRecurrentNetwork, SimpleRnnComponent):
                  p_dropout_inpt=.2, p_dropout_hidden=.5,
                  p_dropout_hidden_to_out=None,
                  use_varprop_at=None,
-                 hotk_inpt=False):
+                 hotk_inpt=False, use_mask=False):
         self.n_inpt = n_inpt
         self.n_output = n_output
 
@@ -487,7 +507,8 @@ class SupervisedRecurrentNetwork(BaseRecurrentNetwork, SimpleRnnComponent):
 
         super(SupervisedRecurrentNetwork, self).__init__(
             n_inpt, n_hiddens, n_output,
-            hidden_transfers, out_transfer, loss, pooling, leaky_coeffs)
+            hidden_transfers, out_transfer, loss, pooling, leaky_coeffs,
+            use_mask)
 
     def init_exprs(self):
         inpt_mean = T.tensor3('inpt_mean')
@@ -513,14 +534,14 @@ class SupervisedRecurrentNetwork(BaseRecurrentNetwork, SimpleRnnComponent):
             self.hidden_transfers, self.out_transfer, self.loss,
             self.pooling, self.leaky_coeffs,
             [self.p_dropout_inpt] + [self.p_dropout_hidden] * len(recurrents),
-            self.hotk_inpt)
+            self.hotk_inpt, self._mask_input())
 
     @staticmethod
     def make_exprs(inpt_mean, inpt_var, target, in_to_hidden, hidden_to_hiddens, hidden_to_out,
                    hidden_biases, hidden_var_biases_sqrt,
                    initial_hiddens, recurrents, out_bias,
                    hidden_transfers, out_transfer, loss, pooling, leaky_coeffs,
-                   p_dropouts, hotk_inpt):
+                   p_dropouts, hotk_inpt, mask=None):
         if pooling is not None:
             raise NotImplementedError("I don't know about pooling yet.")
         if leaky_coeffs is not None:
@@ -531,11 +552,15 @@ class SupervisedRecurrentNetwork(BaseRecurrentNetwork, SimpleRnnComponent):
                     hidden_to_out, hidden_biases, hidden_var_biases_sqrt,
                     initial_hiddens, recurrents,
                     out_bias, hidden_transfers, out_transfer, p_dropouts,
-                    hotk_inpt)
+                    hotk_inpt, mask)
         f_loss = lookup(loss, loss_)
         sum_axis = 2
         loss_row_wise = f_loss(target, exprs['output']).sum(axis=sum_axis)
-        loss = loss_row_wise.mean()
+        if mask is None:
+            loss = loss_row_wise.mean()
+        else:
+            loss = masked_mean(loss_row_wise, mask)
+            exprs['mask'] = mask
         exprs['target'] = target
         exprs['loss'] = loss
         exprs['loss_row_wise'] = loss_row_wise
@@ -585,6 +610,6 @@ class FastDropoutRnn(SupervisedRecurrentNetwork):
             initial_hiddens, recurrents, pars.out_bias,
             self.hidden_transfers, self.out_transfer, self.loss,
             self.pooling, self.leaky_coeffs, p_dropouts,
-            self.hotk_inpt)
+            self.hotk_inpt, self._mask_input())
 
         self.exprs['inpt'] = inpt_mean
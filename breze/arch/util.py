@@ -9,6 +9,8 @@ import theano.tensor as T
 import theano.sandbox.cuda
 import theano.misc.gnumpy_utils as gput
 
+from cache import cache_from_environ
+
 
 try:
     gpu_environ = os.environ['BREZE_PARAMETERSET_DEVICE']
@@ -26,6 +28,10 @@ if GPU:
     import gnumpy
 
 
+# Cache of compiled functions shared by all models of this process.
+function_cache = cache_from_environ()
+
+
 def flatten(nested):
     """Flatten nested tuples and/or lists into a flat list."""
     if isinstance(nested, (tuple, list)):
@@ -61,16 +67,26 @@ def theano_function_with_nested_exprs(variables, exprs, *args, **kwargs):
     and returns values for `exprs`, where again `exprs` may contain nested
     lists and/or tuples.
 
+    If a ``FunctionCache`` is given as keyword argument ``cache``, the
+    compiled function is retrieved from it if possible. Information on how the
+    function was obtained is then available as ``.cache_info`` of the result.
+
     All other arguments are passed to theano.function without modification."""
+    cache = kwargs.pop('cache', None)
 
     flat_variables = flatten(variables)
     flat_exprs = flatten(exprs)
 
-    flat_function = theano.function(
-        flat_variables, flat_exprs,
-        # HOTFIX
-        allow_input_downcast=True,
-        *args, **kwargs)
+    # HOTFIX
+    kwargs['allow_input_downcast'] = True
+
+    if cache is not None and not args:
+        flat_function, cache_info = cache.function(
+            flat_variables, flat_exprs, **kwargs)
+    else:
+        flat_function = theano.function(
+            flat_variables, flat_exprs, *args, **kwargs)
+        cache_info = None
 
     def wrapper(*fargs):
         flat_fargs = flatten(fargs)
@@ -81,6 +97,7 @@ def theano_function_with_nested_exprs(variables, exprs, *args, **kwargs):
     # Expose this to the outside so that fields of theano can be accessed, eg
     # for debug or graph information.
     wrapper.theano_func = flat_function
+    wrapper.cache_info = cache_info
 
     return wrapper
 
@@ -311,6 +328,7 @@ class ParameterSet(object):
 
         # Go through parameters and assign space and variable.
         self.views = {}
+        self._layout = []
         n_used = 0 	# Number of used parameters.
 
         for (key, shape), size in zip(kwargs.items(), sizes):
@@ -324,6 +342,7 @@ class ParameterSet(object):
             # Then shape it correctly and make it accessible from the outside.
             region = region.reshape(shape)
             self.views[key] = region
+            self._layout.append((key, shape, n_used, size))
 
             # Get the right variable as a subtensor.
             var = self.flat[n_used:n_used + size].reshape(shape)
@@ -332,6 +351,56 @@ class ParameterSet(object):
 
             n_used += size
 
+    def memmap(self, filename, mode='r+'):
+        """Back ``.data`` with the file ``filename`` via ``numpy.memmap``.
+
+        Afterwards, ``.data`` and all arrays in ``.views`` are views on the
+        mapped file. Previously obtained references to arrays of ``.views``
+        are not updated and should not be used anymore.
+
+        Parameters
+        ----------
+
+        filename : string
+            Path of the file holding the raw parameter vector.
+
+        mode : string, optional, default: 'r+'
+            One of ``r`` (read only, the pages can be shared among
+            processes), ``r+`` (read and write an existing file), ``c``
+            (copy on write) or ``w+`` (create or overwrite the file with the
+            current parameters).
+        """
+        if GPU:
+            raise ValueError('memory mapping is not supported on the GPU')
+        if mode not in ('r', 'r+', 'c', 'w+'):
+            raise ValueError('unknown mode %s' % mode)
+
+        dtype = np.dtype(theano.config.floatX)
+        if mode != 'w+':
+            expected = self.n_pars * dtype.itemsize
+            actual = os.path.getsize(filename)
+            if actual != expected:
+                raise ValueError('%s holds %i bytes, expected %i'
+                                 % (filename, actual, expected))
+
+        data = np.memmap(filename, dtype=dtype, mode=mode,
+                         shape=(self.n_pars,))
+        if mode == 'w+':
+            data[:] = self.data
+        self._rebind(data)
+
+    def flush(self):
+        """Write changes of the parameters to the file they are mapped to, if
+        any."""
+        if isinstance(self.data, np.memmap):
+            self.data.flush()
+
+    def _rebind(self, data):
+        self.data = data
+        self.flat.tag.test_value = data
+        for key, shape, start, size in self._layout:
+            self.views[key] = data[start:start + size].reshape(shape)
+
     def __contains__(self, key):
         return key in self.views
 
@@ -436,7 +505,7 @@ class Model(object):
 
     def function(self, variables, exprs, mode=None, explicit_pars=False,
                  givens=None,
-                 on_unused_input='raise', numpy_result=False):
+                 on_unused_input='raise', numpy_result=False, cache=True):
         """Return a compiled function for the given `exprs` given `variables`.
 
 
@@ -475,6 +544,15 @@ class Model(object):
         numpy_result : boolean, optional, default: False
             If set to True, a numpy array is always returned, even if the
             computation is done on the GPU and a gnumpy array was more natural.
+
+        cache : boolean, optional, default: True
+            If set to True, the compiled function is looked up in and stored
+            to ``breze.arch.util.function_cache``, whose tiers are configured
+            by environment variables, see ``breze.arch.cache``. Hits, misses
+            and the time spent are reported in ``.cache_info`` of the returned
+            function.
+            Set to False to always compile a function of its own, e.g. if it
+            is going to be called from another thread.
         """
         variables = self._unify_variables(variables)
         exprs = self._unify_exprs(exprs)
@@ -523,12 +601,14 @@ class Model(object):
 
         f = theano_function_with_nested_exprs(
             variables, exprs, givens=givens, mode=mode,
-            on_unused_input=on_unused_input, updates=updates)
+            on_unused_input=on_unused_input, updates=updates,
+            cache=function_cache if cache else None)
 
         if not explicit_pars:
             def f_implicit_pars(*args, **kwargs):
                 return f(self.parameters.data, *args, **kwargs)
             f_implicit_pars.theano_func = f.theano_func
+            f_implicit_pars.cache_info = f.cache_info
             return f_implicit_pars
 
         if GPU:
@@ -557,6 +637,10 @@ class Model(object):
         variables_flat = flatten(variables)
         gpu_var_flat = []
         for var in variables_flat:
+            if not var.dtype.startswith('float'):
+                # Integers, e.g. indices, stay on the host.
+                gpu_var_flat.append(var)
+                continue
             if var in self.gpu_variable_subs:
                 gpu_var = self.gpu_variable_subs[var]
             else:
@@ -572,7 +656,8 @@ class Model(object):
         for expr in exprs_flat:
             # (2)
             for v, gv in zip(variables_flat, gpu_var_flat):
-                expr = theano.clone(expr, {v: gv})
+                if v is not gv:
+                    expr = theano.clone(expr, {v: gv})
             # (3)
             if outputs:
                 expr = cpu_expr_to_gpu(expr)
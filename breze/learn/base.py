@@ -4,7 +4,9 @@
 learning algorithms."""
 
 
+import collections
 import itertools
+import multiprocessing.pool
 import warnings
 import signal
 
@@ -15,8 +17,12 @@ import numpy as np
 import theano
 import theano.tensor as T
 
+from sklearn.utils import check_random_state
 
-from data import iter_minibatches
+import checkpoint
+from hessianfree import HessianFree
+from data import (iter_minibatches, iter_block_minibatches, Prefetcher,
+                  WindowDataset, OutOfCoreDataset)
 
 GPU = theano.config.device == 'gpu'
 if GPU:
@@ -29,7 +35,12 @@ def cast_array_to_local_type(arr):
 
     That is, if the current device is GPU, make it a gnumpy.garry. If the
     current theano.config.floatX does not match the dtype of arr, return an
-    array that does."""
+    array that does.
+
+    A ``breze.learn.data.WindowDataset`` or
+    ``breze.learn.data.OutOfCoreDataset`` is materialized."""
+    if isinstance(arr, (WindowDataset, OutOfCoreDataset)):
+        arr = np.asarray(arr)
     res = arr
     if GPU and not isinstance(arr, gp.garray):
         warnings.warn('Implicilty converting numpy.ndarray to gnumpy.garray')
@@ -39,6 +50,12 @@ def cast_array_to_local_type(arr):
     return res
 
 
+def cast_arrays_to_local_type(arrs):
+    """Return a tuple of the arrays in ``arrs``, each passed through
+    ``cast_array_to_local_type``."""
+    return tuple(cast_array_to_local_type(i) for i in arrs)
+
+
 def assert_ndarray(arr):
     """If ``arr`` is a ``gnumpy.garray``, convert it to a ``numpy.ndarray``.
     Otherwise pass silently."""
@@ -47,17 +64,428 @@ def assert_ndarray(arr):
     return arr
 
 
+def _take_slice(arr, start, stop, axis):
+    return arr[(slice(None),) * axis + (slice(start, stop),)]
+
+
+def _row_bytes(arr, axis):
+    return arr.nbytes // max(arr.shape[axis], 1)
+
+
+def apply_in_chunks(f, X, max_rows=None, max_bytes=None, out=None,
+                    in_axis=0, out_axis=0):
+    """Return the result of ``f(X)``, computed by applying ``f`` to chunks of
+    ``X`` along ``in_axis`` and concatenating the results along ``out_axis``.
+
+    Each chunk is passed through ``cast_array_to_local_type`` before it is
+    given to ``f``, so that conversions happen chunk wise as well.
+
+    Parameters
+    ----------
+
+    f : callable
+        Function to apply; needs to treat the samples independently.
+
+    X : array_like or iterator
+        Input array. If it is an iterator over arrays instead (e.g. a
+        generator), a generator of the results for each of its items is
+        returned, so that arbitrarily large inputs can be processed in
+        constant memory. Lists and tuples are converted to arrays.
+
+    max_rows : integer, optional, default: None
+        Maximum number of samples passed to ``f`` at once.
+
+    max_bytes : integer, optional, default: None
+        Maximum number of bytes the input and output of a single chunk may
+        occupy. The output size is only known after the first chunk, which is
+        sized by the input only.
+
+    out : array_like, optional, default: None
+        Array to write the result to. Allocated if None. Not supported if
+        ``X`` is an iterator.
+
+    in_axis : integer, optional, default: 0
+        Axis of ``X`` along which the samples are arranged.
+
+    out_axis : integer, optional, default: 0
+        Axis of the result along which the samples are arranged.
+
+    Returns
+    -------
+
+    Y : array_like or generator
+        The result, or a generator of results if ``X`` is an iterator.
+    """
+    if max_rows is not None and max_rows < 1:
+        raise ValueError('need strictly positive number of rows')
+    if max_bytes is not None and max_bytes < 1:
+        raise ValueError('need strictly positive number of bytes')
+
+    if isinstance(X, collections.Iterator):
+        if out is not None:
+            raise ValueError('cannot write results of an iterator to out')
+        return (apply_in_chunks(f, i, max_rows, max_bytes, None,
+                                in_axis, out_axis)
+                for i in X)
+    if not hasattr(X, 'shape'):
+        X = np.asarray(X)
+
+    n_samples = X.shape[in_axis]
+    if max_rows is None and max_bytes is None:
+        max_rows = n_samples
+    if max_bytes is not None:
+        budget_rows = max(1, max_bytes // max(_row_bytes(X, in_axis), 1))
+        max_rows = budget_rows if max_rows is None else min(max_rows,
+                                                            budget_rows)
+
+    start = 0
+    while True:
+        stop = min(start + max_rows, n_samples)
+        chunk = cast_array_to_local_type(_take_slice(X, start, stop, in_axis))
+        res = assert_ndarray(f(chunk))
+        if out is None:
+            if stop == n_samples and start == 0:
+                # Everything fit into a single chunk, no need to copy.
+                return res
+            shape = list(res.shape)
+            shape[out_axis] = n_samples
+            out = np.empty(shape, dtype=res.dtype)
+        _take_slice(out, start, stop, out_axis)[...] = res
+
+        if start == 0 and max_bytes is not None:
+            row_bytes = _row_bytes(chunk, in_axis) + _row_bytes(res, out_axis)
+            max_rows = min(max_rows,
+                           max(1, max_bytes // max(row_bytes, 1)))
+        start = stop
+        if stop == n_samples:
+            break
+
+    return out
+
+
+class FusedLossAndGrad(object):
+    """Class providing loss and gradient functions for climin from a single
+    function which returns both at once.
+
+    Optimizers ask for the loss and the gradient separately, often at the same
+    point. The result of the last evaluation is kept, so that asking for the
+    gradient after the loss (or vice versa) for the same parameters and the
+    same batch does not lead to a second pass through the model.
+
+    Parameters
+    ----------
+
+    f_loss_and_grad : callable
+        Function which takes the parameters and the data arguments and returns
+        a pair ``(loss, gradient)``.
+
+    f_loss : callable, optional, default: None
+        Function which takes the same arguments and returns the loss only. If
+        given, it is used to evaluate the loss at points for which no result
+        is kept, e.g. during line searches, so that no gradient is computed.
+
+
+    Attributes
+    ----------
+
+    n_evals : integer
+        Number of times ``f_loss_and_grad`` was actually called.
+    """
+
+    def __init__(self, f_loss_and_grad, f_loss=None):
+        self.f_loss_and_grad = f_loss_and_grad
+        self.f_loss = f_loss
+        self.n_evals = 0
+
+        self._pars = None
+        self._args = None
+        self._result = None
+
+    def _is_cached(self, pars, args):
+        if self._pars is None or len(args) != len(self._args):
+            return False
+        # Batches are compared by identity, which is why we hold on to them.
+        # Scalars, e.g. batch indices, are compared by value.
+        if not all(i is j or (np.isscalar(i) and i == j)
+                   for i, j in zip(args, self._args)):
+            return False
+        return self._pars.shape == pars.shape and (self._pars == pars).all()
+
+    def __call__(self, pars, *args):
+        """Return a pair ``(loss, gradient)`` for the given parameters and
+        data arguments."""
+        if not self._is_cached(pars, args):
+            loss, grad = self.f_loss_and_grad(pars, *args)
+            self.n_evals += 1
+            if self._pars is None or self._pars.shape != pars.shape:
+                self._pars = pars.copy()
+            else:
+                self._pars[...] = pars
+            self._args = args
+            self._result = loss, grad
+        return self._result
+
+    def f(self, pars, *args):
+        """Return the loss for the given parameters and data arguments."""
+        if self.f_loss is not None and not self._is_cached(pars, args):
+            return self.f_loss(pars, *args)
+        return self(pars, *args)[0]
+
+    def fprime(self, pars, *args):
+        """Return the gradient for the given parameters and data arguments."""
+        # Hand out a copy, since some optimizers modify the gradient in place.
+        return self(pars, *args)[1].copy()
+
+
+class AsyncEvaluator(object):
+    """Class for scoring snapshots of parameters in a background thread.
+
+    Each snapshot is copied into one of ``max_in_flight`` preallocated
+    buffers, so that the optimizer can continue to modify the parameters
+    while the snapshot is scored. If all buffers are in use, submitting blocks
+    until the oldest evaluation has finished. Results are processed in the
+    order of submission.
+
+    Parameters
+    ----------
+
+    score : callable
+        Function taking a parameter array and a flag whether the training loss
+        should be computed. Returns a pair ``(train_loss, val_loss)``, where
+        the former may be None.
+
+    template : array_like
+        Array of the shape and type of the parameters.
+
+    max_in_flight : integer, optional, default: 2
+        Maximum number of snapshots that are scored or waiting to be.
+
+
+    Attributes
+    ----------
+
+    train_loss, val_loss : float
+        Losses of the most recently finished evaluation.
+
+    n_iter : integer or None
+        Tag of the most recently finished evaluation, typically the iteration
+        the snapshot was taken at.
+
+    best_loss : float
+        Lowest validation loss so far.
+
+    best_pars : array_like
+        Copy of the snapshot ``best_loss`` was obtained with.
+    """
+
+    def __init__(self, score, template, max_in_flight=2):
+        if max_in_flight < 1:
+            raise ValueError('need at least one evaluation in flight')
+        self.score = score
+        self._free = [np.empty_like(template) for _ in range(max_in_flight)]
+        self._pending = collections.deque()
+        self._pool = multiprocessing.pool.ThreadPool(1)
+
+        self.train_loss = float('inf')
+        self.val_loss = float('inf')
+        self.n_iter = None
+        self.best_loss = float('inf')
+        self.best_pars = None
+
+    @property
+    def n_pending(self):
+        return len(self._pending)
+
+    def submit(self, pars, tag, score_train=True):
+        """Schedule the evaluation of a copy of ``pars``."""
+        if not self._free:
+            self._collect_one()
+        buf = self._free.pop()
+        buf[...] = pars
+        result = self._pool.apply_async(self.score, (buf, score_train))
+        self._pending.append((tag, buf, result))
+
+    def collect(self):
+        """Process all evaluations that have finished, in order."""
+        while self._pending and self._pending[0][2].ready():
+            self._collect_one()
+
+    def drain(self):
+        """Wait for all pending evaluations and process them, in order."""
+        while self._pending:
+            self._collect_one()
+
+    def _collect_one(self):
+        tag, buf, result = self._pending.popleft()
+        train_loss, val_loss = result.get()
+        if train_loss is not None:
+            self.train_loss = ma.scalar(train_loss)
+        self.val_loss = ma.scalar(val_loss)
+        self.n_iter = tag
+        if self.val_loss < self.best_loss:
+            self.best_loss = self.val_loss
+            self.best_pars = buf.copy()
+        self._free.append(buf)
+
+    def close(self):
+        """Discard pending evaluations and stop the background thread."""
+        self._pool.terminate()
+        self._pool.join()
+        self._pending.clear()
+
+
 class BrezeWrapperBase(object):
     """Class that helps with wrapping Breze models."""
 
     mode = None
 
+    # If set to True, the loss and its gradient are obtained from a single
+    # compiled function. See ``FusedLossAndGrad``.
+    fuse_loss_and_grad = False
+
+    # If set to True and a batch size is given, the training data is stored
+    # once in shared variables and the loss functions are compiled against
+    # the index of a minibatch. See ``_store_resident``.
+    resident_data = False
+    _resident = None
+
+    # Seed or random number generator for the order of the minibatches of
+    # resident data and for other sampling during fitting.
+    random_state = None
+
+    # Either None, the number of minibatches to prepare ahead in a background
+    # thread or a callable like ``breze.learn.data.Prefetcher``.
+    prefetch = None
+
+    _optimizer = None
+    _optimizer_state = None
+
     def _d_loss(self):
         """Return a theano expression for the gradient of the loss wrt the
         flat parameters of the model."""
         return T.grad(self.exprs['loss'], self.parameters.flat)
 
-    def _make_optimizer(self, f, fprime, args, wrt=None, f_Hp=None):
+    def _make_loss_and_grad_function(self, variables, loss, d_loss, **kwargs):
+        """Return a function ``f_loss_and_grad`` which returns the pair
+        ``(loss, gradient)`` from a single evaluation of the model.
+
+        The function takes the parameters as first argument, followed by the
+        data for ``variables``. All keyword arguments are passed on to
+        ``.function``."""
+        return self.function(variables, [loss, d_loss], explicit_pars=True,
+                             **kwargs)
+
+    def _compile_loss_functions(self, variables, loss, d_loss, **kwargs):
+        """Return pair (f_loss, f_d_loss) of functions for the expressions
+        ``loss`` and ``d_loss`` given ``variables``.
+
+        If ``.fuse_loss_and_grad`` is True, both are backed by a single
+        function which evaluates the model once for the loss and the gradient.
+        All keyword arguments are passed on to ``.function``.
+
+        If the training data has been made resident via ``._store_resident``,
+        the functions take the index of a minibatch instead of ``variables``.
+        """
+        if self._resident is not None:
+            index, resident_givens, _ = self._resident
+            variables = [index]
+            givens = dict(kwargs.get('givens') or {})
+            givens.update(resident_givens)
+            kwargs['givens'] = givens
+
+        if self.fuse_loss_and_grad:
+            fused = FusedLossAndGrad(self._make_loss_and_grad_function(
+                variables, loss, d_loss, **kwargs))
+            return fused.f, fused.fprime
+
+        f_loss = self.function(variables, loss, explicit_pars=True, **kwargs)
+        f_d_loss = self.function(variables, d_loss, explicit_pars=True,
+                                 **kwargs)
+        return f_loss, f_d_loss
+
+    def _store_resident(self, data):
+        """Store the arrays in ``data`` as shared variables if
+        ``.resident_data`` is True and a batch size is given.
+
+        Afterwards, the functions from ``._compile_loss_functions`` take the
+        index of a minibatch as their only data argument, which is substituted
+        by slices of the shared variables within the graph; ``._make_args``
+        then only yields indices. That way, a minibatch is neither copied nor
+        cast on the host during training. If the device is a GPU, the data is
+        kept in device memory.
+
+        ``data`` is aligned with ``.data_arguments`` and ``.sample_dim``."""
+        batch_size = getattr(self, 'batch_size', None)
+        if (not self.resident_data or batch_size is None
+                or not all(hasattr(i, 'shape') for i in data)):
+            # E.g. lists of variable length sequences are not stored.
+            self._resident = None
+            return
+        if batch_size < 1:
+            raise ValueError('need strictly positive batch size')
+
+        index = T.lscalar('batch_index')
+        start = index * batch_size
+        givens = {}
+        n_samples = set()
+        for name, arr, dim in zip(self.data_arguments, data, self.sample_dim):
+            var = self.exprs[name]
+            arr = np.asarray(assert_ndarray(arr), dtype=var.dtype)
+            shared = theano.shared(arr, name='%s_resident' % name,
+                                   borrow=True)
+            slices = [slice(None)] * dim + [slice(start, start + batch_size)]
+            givens[var] = shared[tuple(slices)]
+            n_samples.add(arr.shape[dim])
+
+        if len(n_samples) != 1:
+            raise ValueError('containers to be batched have different lengths')
+        n_batches, rest = divmod(n_samples.pop(), batch_size)
+        if rest:
+            n_batches += 1
+
+        self._resident = index, givens, n_batches
+
+    def _release_resident(self):
+        """Drop the shared variables of ``._store_resident``, so that the
+        training data is neither kept in (device) memory nor pickled after
+        fitting."""
+        self._resident = None
+
+    def _make_resident_args(self):
+        """Return an infinite iterator over argument pairs holding the indices
+        of the minibatches of the resident data, in random order without
+        replacement within each pass."""
+        _, _, n_batches = self._resident
+        rng = check_random_state(self.random_state)
+        while True:
+            for i in rng.permutation(n_batches):
+                yield [int(i)], {}
+
+    def _iter_minibatches(self, data):
+        """Return an infinite iterator over aligned minibatches of the
+        containers in ``data``.
+
+        If any of them is a ``breze.learn.data.OutOfCoreDataset``, the
+        minibatches are read block wise, see
+        ``breze.learn.data.iter_block_minibatches``."""
+        if any(isinstance(i, OutOfCoreDataset) for i in data):
+            return iter_block_minibatches(data, self.batch_size,
+                                          self.sample_dim)
+        return iter_minibatches(data, self.batch_size, self.sample_dim)
+
+    def _prepare_batches(self, batches, prepare):
+        """Return an iterator over ``prepare(batch)`` for each item in
+        ``batches``, prefetched in the background according to
+        ``.prefetch``."""
+        prefetch = self.prefetch
+        if prefetch is None:
+            return itertools.imap(prepare, batches)
+        if isinstance(prefetch, (int, long)):
+            prefetch = Prefetcher(prefetch)
+        return prefetch(batches, prepare)
+
+    def _make_optimizer(self, f, fprime, args, wrt=None, f_Hp=None,
+                        curvature_args=None):
         if isinstance(self.optimizer, (str, unicode)):
             ident = self.optimizer
             kwargs = {}
@@ -72,16 +500,60 @@ class BrezeWrapperBase(object):
         kwargs['f'] = f
         kwargs['fprime'] = fprime
 
+        # Only optimizers of the model parameters take part in checkpointing.
+        track = wrt is None
         if wrt is None:
             wrt = self.parameters.data
 
         if f_Hp is not None:
             kwargs['f_Hp'] = f_Hp
+        if curvature_args is not None:
+            kwargs['curvature_args'] = curvature_args
 
         kwargs['args'] = args
-        return climin.util.optimizer(ident, wrt, **kwargs)
-
-    def powerfit(self, fit_data, eval_data, stop, report, eval_train_loss=True):
+        if ident == 'hf':
+            # Not known to climin.
+            opt = HessianFree(wrt, **kwargs)
+        else:
+            opt = climin.util.optimizer(ident, wrt, **kwargs)
+
+        if track:
+            state = self._optimizer_state
+            if state is not None:
+                # Left by ``.restore``; only applies to the next optimizer.
+                self._optimizer_state = None
+                for field, value in state.items():
+                    setattr(opt, field, value)
+
+            # Kept for ``.checkpoint``; excluded from pickling.
+            self._optimizer = opt
+        return opt
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_optimizer', None)
+        state.pop('_resident', None)
+        return state
+
+    def checkpoint(self, dirname):
+        """Write the parameters, the hyper parameters and the state of the
+        last optimizer of the model to the directory ``dirname``.
+
+        See ``breze.learn.checkpoint`` for the format."""
+        checkpoint.save(self, dirname)
+
+    def restore(self, dirname, mode='c'):
+        """Restore a checkpoint written by ``.checkpoint`` from the directory
+        ``dirname``.
+
+        The parameters are memory mapped with ``mode`` instead of being read,
+        and no functions are recompiled. The optimizer state is used by the
+        next call to ``.iter_fit``. Returns the meta information of the
+        checkpoint, including the hyper parameters it was written with."""
+        return checkpoint.restore(self, dirname, mode)
+
+    def powerfit(self, fit_data, eval_data, stop, report, eval_train_loss=True,
+                 eval_batch_size=None, train_subsample=None, async_evals=0):
         """Iteratively fit the model.
 
         This is a convenience function which combines iteratively fitting a
@@ -114,13 +586,44 @@ class BrezeWrapperBase(object):
             if the iterator should stop.
         :param report: A function receiving an info dictionary which should
             return True if the iterator should yield a value.
+        :param eval_batch_size: If not None, losses are evaluated on chunks of
+            at most this many samples and combined by a weighted mean, so
+            memory usage is bounded by the chunk size instead of the data set
+            size.
+        :param train_subsample: If not None, the training loss is evaluated on
+            a fixed random subset of this many samples of ``fit_data``, drawn
+            once at the start from ``.random_state``.
+        :param async_evals: If larger than zero, losses are evaluated in a
+            background thread on snapshots of the parameters while the
+            optimization continues, with at most this many evaluations in
+            flight. The losses of an evaluation are delivered in the info
+            dictionary of a later report, together with the iteration the
+            snapshot was taken at under the key ``val_n_iter``. ``best_pars``
+            is always the snapshot ``best_loss`` was obtained with. Reports
+            are skipped until the first evaluation has finished. Once the
+            iterator stops, the evaluations still in flight are waited for
+            and delivered in a final copy of the last reported dictionary.
         :returns: An iterator over info dictionaries.
         """
         self.CTRL_C_FLAG = False
         signal.signal(signal.SIGINT, self._ctrl_c_handler)
 
         loss_key = 'true_loss' if 'true_loss' in self.exprs else 'loss'
-        f_loss = self.function(self.data_arguments, loss_key)
+
+        train_eval_data = fit_data
+        if train_subsample is not None and eval_train_loss:
+            train_eval_data = self._subsample(fit_data, train_subsample,
+                                              self.random_state)
+
+        if async_evals:
+            itr = self._powerfit_async(
+                fit_data, eval_data, stop, report, eval_train_loss,
+                eval_batch_size, train_eval_data, loss_key, async_evals)
+            for info in itr:
+                yield info
+            return
+
+        f_loss = self._make_eval_loss_function(loss_key)
 
         best_pars = None
         best_loss = float('inf')
@@ -131,10 +634,12 @@ class BrezeWrapperBase(object):
                     # Not all optimizers, e.g. ilne and gd, do actually
                     # calculate the loss.
                     if eval_train_loss:
-                        info['loss'] = ma.scalar(f_loss(*fit_data))
+                        info['loss'] = self._chunked_loss(
+                            f_loss, train_eval_data, eval_batch_size)
                     else:
                         info['loss'] = 0.
-                info['val_loss'] = ma.scalar(f_loss(*eval_data))
+                info['val_loss'] = self._chunked_loss(
+                    f_loss, eval_data, eval_batch_size)
 
                 if info['val_loss'] < best_loss:
                     best_loss = info['val_loss']
@@ -148,6 +653,111 @@ class BrezeWrapperBase(object):
                 if stop(info) or self.CTRL_C_FLAG:
                     break
 
+    def _powerfit_async(self, fit_data, eval_data, stop, report,
+                        eval_train_loss, eval_batch_size, train_eval_data,
+                        loss_key, max_in_flight):
+        """Implementation of ``.powerfit`` where the losses are evaluated by
+        an ``AsyncEvaluator``."""
+        # The evaluations run concurrently with the optimization and thus need
+        # a compiled function of their own.
+        f_loss = self._make_eval_loss_function(
+            loss_key, explicit_pars=True, cache=False)
+
+        def score(pars, score_train):
+            f = lambda *data: f_loss(pars, *data)
+            train_loss = None
+            if score_train:
+                train_loss = self._chunked_loss(
+                    f, train_eval_data, eval_batch_size)
+            val_loss = self._chunked_loss(f, eval_data, eval_batch_size)
+            return train_loss, val_loss
+
+        evaluator = AsyncEvaluator(
+            score, assert_ndarray(self.parameters.data), max_in_flight)
+
+        def fill(info, has_loss):
+            if not has_loss:
+                info['loss'] = (evaluator.train_loss if eval_train_loss
+                                else 0.)
+            info['val_loss'] = evaluator.val_loss
+            info['val_n_iter'] = evaluator.n_iter
+            info['n_pending_evals'] = evaluator.n_pending
+            info['best_loss'] = evaluator.best_loss
+            info['best_pars'] = evaluator.best_pars
+            return info
+
+        last = None
+        try:
+            for info in self.iter_fit(*fit_data):
+                if report(info):
+                    has_loss = 'loss' in info
+                    evaluator.submit(
+                        assert_ndarray(self.parameters.data), info['n_iter'],
+                        not has_loss and eval_train_loss)
+                    evaluator.collect()
+                    last = info.copy(), has_loss
+
+                    if evaluator.n_iter is None:
+                        # No losses to report yet.
+                        continue
+
+                    yield fill(info, has_loss)
+
+                    if stop(info) or self.CTRL_C_FLAG:
+                        break
+
+            if evaluator.n_pending:
+                # Deliver the evaluations still in flight, so that the best
+                # parameters take all reported snapshots into account.
+                evaluator.drain()
+                yield fill(*last)
+        finally:
+            evaluator.close()
+
+    def _make_eval_loss_function(self, loss_key, **kwargs):
+        """Return a function computing the expression ``loss_key`` from the
+        data given to ``.powerfit``. All keyword arguments are passed on to
+        ``.function``."""
+        return self.function(self.data_arguments, loss_key, **kwargs)
+
+    def _chunked_loss(self, f_loss, data, chunk_size):
+        """Return the loss ``f_loss`` on ``data``.
+
+        If ``chunk_size`` is not None, the data is split into chunks of at most
+        that many samples along ``.sample_dim`` and the mean of the losses of
+        the chunks, weighted by their sizes, is returned. This assumes the
+        loss to be a mean over the samples. Data which does not fit into
+        memory is always split, into its blocks by default."""
+        if chunk_size is None:
+            out_of_core = [i for i in data if isinstance(i, OutOfCoreDataset)]
+            if not out_of_core:
+                return ma.scalar(f_loss(*data))
+            chunk_size = min(i.block_rows for i in out_of_core)
+        if chunk_size < 1:
+            raise ValueError('need strictly positive chunk size')
+
+        n_samples = data[0].shape[self.sample_dim[0]]
+        total = 0.
+        for start in range(0, n_samples, chunk_size):
+            stop = min(start + chunk_size, n_samples)
+            chunk = cast_arrays_to_local_type(
+                i[(slice(None),) * d + (slice(start, stop),)]
+                for i, d in zip(data, self.sample_dim))
+            total += ma.scalar(f_loss(*chunk)) * (stop - start)
+        return total / n_samples
+
+    def _subsample(self, data, n, random_state=None):
+        """Return copies of the arrays in ``data`` which consist of the same
+        ``n`` randomly chosen samples along ``.sample_dim``, in their original
+        order."""
+        rng = check_random_state(random_state)
+        n_samples = data[0].shape[self.sample_dim[0]]
+        if n >= n_samples:
+            return data
+        idxs = np.sort(rng.permutation(n_samples)[:n])
+        return [i[(slice(None),) * d + (idxs,)]
+                for i, d in zip(data, self.sample_dim)]
+
     def _ctrl_c_handler(self, signal, frame):
         self.CTRL_C_FLAG = True
 
@@ -170,16 +780,14 @@ class SupervisedBrezeWrapperBase(BrezeWrapperBase):
         d_loss = self._d_loss()
         givens = {} if givens is None else givens
 
-        f_loss = self.function(['inpt', 'target'], 'loss', explicit_pars=True,
-                               mode=mode, givens=givens,
-                               on_unused_input=on_unused_input)
-        f_d_loss = self.function(
-            ['inpt', 'target'], d_loss, explicit_pars=True, mode=mode,
-            givens=givens, on_unused_input=on_unused_input)
-
-        return f_loss, f_d_loss
+        return self._compile_loss_functions(
+            ['inpt', 'target'], 'loss', d_loss, mode=mode, givens=givens,
+            on_unused_input=on_unused_input)
 
     def _make_args(self, X, Z):
+        if self._resident is not None:
+            return self._make_resident_args()
+
         batch_size = getattr(self, 'batch_size', None)
         if batch_size is None:
             X, Z = cast_array_to_local_type(X), cast_array_to_local_type(Z)
@@ -187,9 +795,8 @@ class SupervisedBrezeWrapperBase(BrezeWrapperBase):
         elif batch_size < 1:
             raise ValueError('need strictly positive batch size')
         else:
-            data = iter_minibatches([X, Z], self.batch_size, self.sample_dim)
-            data = ((cast_array_to_local_type(x), cast_array_to_local_type(z))
-                    for x, z in data)
+            data = self._iter_minibatches([X, Z])
+            data = self._prepare_batches(data, cast_arrays_to_local_type)
 
         args = ((i, {}) for i in data)
         return args
@@ -207,13 +814,17 @@ class SupervisedBrezeWrapperBase(BrezeWrapperBase):
         :param X: Array representing the inputs.
         :param Z: Array representing the outputs.
         """
+        self._store_resident((X, Z))
         f_loss, f_d_loss = self._make_loss_functions()
 
         args = self._make_args(X, Z)
         opt = self._make_optimizer(f_loss, f_d_loss, args)
 
-        for i, info in enumerate(opt):
-            yield info
+        try:
+            for i, info in enumerate(opt):
+                yield info
+        finally:
+            self._release_resident()
 
     def fit(self, X, Z):
         """Fit the parameters of the model to the given data with the
@@ -239,26 +850,35 @@ class SupervisedBrezeWrapperBase(BrezeWrapperBase):
         """Return a function to predict targets from input sequences."""
         return self.function(['inpt'], 'output')
 
-    def predict(self, X):
+    def predict(self, X, max_rows=None, max_bytes=None, out=None):
         """Return the prediction of the model given the input.
 
         Parameters
         ----------
 
-        X : array_like
-            Input to the model.
+        X : array_like or iterator
+            Input to the model. If an iterator over arrays is given, a
+            generator over the corresponding predictions is returned.
+
+        max_rows : integer, optional, default: None
+            If given, at most that many samples are processed at once.
+
+        max_bytes : integer, optional, default: None
+            If given, the inputs and outputs of a single step are kept below
+            that many bytes.
+
+        out : array_like, optional, default: None
+            If given, the predictions are written to it.
 
         Returns
         -------
 
-        Y : array_like
+        Y : array_like or generator
         """
-        X = cast_array_to_local_type(X)
         if self.f_predict is None:
             self.f_predict = self._make_predict_functions()
-        Y = self.f_predict(X)
-
-        return Y
+        return apply_in_chunks(self.f_predict, X, max_rows, max_bytes, out,
+                               self.sample_dim[0], self.sample_dim[1])
 
 
 class UnsupervisedBrezeWrapperBase(BrezeWrapperBase):
@@ -277,13 +897,17 @@ class UnsupervisedBrezeWrapperBase(BrezeWrapperBase):
 
         :param X: Array representing the samples.
         """
+        self._store_resident((X,))
         f_loss, f_d_loss = self._make_loss_functions()
 
         args = self._make_args(X)
         opt = self._make_optimizer(f_loss, f_d_loss, args)
 
-        for i, info in enumerate(opt):
-            yield info
+        try:
+            for i, info in enumerate(opt):
+                yield info
+        finally:
+            self._release_resident()
 
     def fit(self, X):
         """Fit the parameters of the model.
@@ -304,13 +928,17 @@ class UnsupervisedBrezeWrapperBase(BrezeWrapperBase):
                 break
 
     def _make_args(self, X):
+        if self._resident is not None:
+            return self._make_resident_args()
+
         batch_size = getattr(self, 'batch_size', None)
         if batch_size is None:
             data = itertools.repeat([X])
         elif batch_size < 1:
             raise ValueError('need strictly positive batch size')
         else:
-            data = iter_minibatches([X], self.batch_size, self.sample_dim)
+            data = self._iter_minibatches([X])
+            data = self._prepare_batches(data, cast_arrays_to_local_type)
         args = ((i, {}) for i in data)
         return args
 
@@ -327,12 +955,9 @@ class UnsupervisedBrezeWrapperBase(BrezeWrapperBase):
         d_loss = self._d_loss()
         givens = {} if givens is None else givens
 
-        f_loss = self.function(['inpt'], 'loss', explicit_pars=True, mode=mode,
-                               givens=givens, on_unused_input=on_unused_input)
-        f_d_loss = self.function(
-            ['inpt'], d_loss, explicit_pars=True, givens=givens, mode=mode,
+        return self._compile_loss_functions(
+            ['inpt'], 'loss', d_loss, mode=mode, givens=givens,
             on_unused_input=on_unused_input)
-        return f_loss, f_d_loss
 
 
 class TransformBrezeWrapperMixin(object):
@@ -346,27 +971,38 @@ class TransformBrezeWrapperMixin(object):
         f_transform = self.function(['inpt'], self.transform_expr_name)
         return f_transform
 
-    def transform(self, X):
+    def transform(self, X, max_rows=None, max_bytes=None, out=None):
         """Return the feature representation of the model given X.
 
         Parameters
         ----------
 
-        X : array_like
-            Represents the inputs to be transformed.
+        X : array_like or iterator
+            Represents the inputs to be transformed. If an iterator over
+            arrays is given, a generator over the corresponding
+            transformations is returned.
+
+        max_rows : integer, optional, default: None
+            If given, at most that many samples are processed at once.
+
+        max_bytes : integer, optional, default: None
+            If given, the inputs and outputs of a single step are kept below
+            that many bytes.
+
+        out : array_like, optional, default: None
+            If given, the transformation is written to it.
 
         Returns
         -------
 
-        Y : array_like
+        Y : array_like or generator
             Transformation of X under the model.
         """
-        X = cast_array_to_local_type(X)
         if self.f_transform is None:
             self.f_transform = self._make_transform_function()
-        Y = self.f_transform(X)
-
-        return Y
+        axis = getattr(self, 'sample_dim', (0,))[0]
+        return apply_in_chunks(self.f_transform, X, max_rows, max_bytes, out,
+                               axis, axis)
 
 
 class ReconstructBrezeWrapperMixin(object):
@@ -377,12 +1013,21 @@ class ReconstructBrezeWrapperMixin(object):
         f_reconstruct = self.function(['inpt'], 'output')
         return f_reconstruct
 
-    def reconstruct(self, X):
+    def reconstruct(self, X, max_rows=None, max_bytes=None, out=None):
         """Return the input reconstruction of the model given X.
 
-        :param X: An array representing the inputs.
-        :returns: An array representing the reconstructions of the input.
+        :param X: An array representing the inputs, or an iterator over such
+            arrays.
+        :param max_rows: If given, at most that many samples are processed at
+            once.
+        :param max_bytes: If given, the inputs and outputs of a single step
+            are kept below that many bytes.
+        :param out: If given, an array the reconstructions are written to.
+        :returns: An array representing the reconstructions of the input, or
+            a generator over such arrays if ``X`` is an iterator.
         """
         if self.f_reconstruct is None:
             self.f_reconstruct = self._make_reconstruct_function()
-        return self.f_reconstruct(X)
+        axis = getattr(self, 'sample_dim', (0,))[0]
+        return apply_in_chunks(self.f_reconstruct, X, max_rows, max_bytes,
+                               out, axis, axis)
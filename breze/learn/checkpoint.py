@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+"""Module for checkpointing models during training.
+
+A checkpoint is a directory holding
+
+ - ``parameters.bin``, the raw flat parameter vector of the model,
+ - one ``optimizer_<field>.npy`` file for each array valued field of the
+   optimizer state and
+ - ``meta.pkl``, a pickled dictionary of plain Python values with the layout
+   of the parameters, the hyper parameters of the model and the scalar fields
+   of the optimizer state.
+
+Restoring a checkpoint maps the parameter vector into memory instead of reading
+it (see ``ParameterSet.memmap``) and does not recompile any functions, so
+restoring takes time independent of the size of the model.
+
+The optimizer state is made of the ``state_fields`` of the climin optimizer
+last created by the model. Optimizers which keep state in local variables of
+their iterator (e.g. the history of ``Lbfgs``) resume with that state reset.
+"""
+
+
+import cPickle
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import theano
+
+
+_plain_types = (bool, int, long, float, str, unicode, type(None))
+
+
+def _is_plain(value):
+    """Return True if ``value`` is made of numbers, strings, tuples, lists and
+    dictionaries only."""
+    if isinstance(value, _plain_types):
+        return True
+    if isinstance(value, (tuple, list)):
+        return all(_is_plain(i) for i in value)
+    if isinstance(value, dict):
+        return all(_is_plain(k) and _is_plain(v) for k, v in value.items())
+    return False
+
+
+def hyper_parameters(model):
+    """Return a dictionary of the public attributes of ``model`` which are
+    plain values."""
+    return dict((k, v) for k, v in model.__dict__.items()
+                if not k.startswith('_') and _is_plain(v))
+
+
+def optimizer_state(optimizer):
+    """Return a pair ``(scalars, arrays)`` of dictionaries holding the state of
+    a climin ``optimizer``."""
+    scalars, arrays = {'n_iter': optimizer.n_iter}, {}
+    for field in getattr(optimizer, 'state_fields', ()):
+        value = getattr(optimizer, field)
+        if isinstance(value, np.ndarray):
+            arrays[field] = value
+        elif _is_plain(value):
+            scalars[field] = value
+    return scalars, arrays
+
+
+def save(model, dirname):
+    """Write a checkpoint of ``model`` to the directory ``dirname``.
+
+    The checkpoint is written to a temporary directory first, which then
+    replaces ``dirname``, so that an interrupted write does not destroy a
+    previous checkpoint."""
+    dirname = os.path.abspath(dirname)
+    tmp_dirname = tempfile.mkdtemp(dir=os.path.dirname(dirname),
+                                   prefix='.checkpoint')
+
+    pars = model.parameters
+    np.asarray(pars.data).tofile(os.path.join(tmp_dirname, 'parameters.bin'))
+
+    meta = {
+        'n_pars': pars.n_pars,
+        'floatX': theano.config.floatX,
+        'layout': pars._layout,
+        'hyper_parameters': hyper_parameters(model),
+        'optimizer': None,
+    }
+
+    optimizer = getattr(model, '_optimizer', None)
+    if optimizer is not None:
+        scalars, arrays = optimizer_state(optimizer)
+        meta['optimizer'] = {
+            'class': type(optimizer).__name__,
+            'scalars': scalars,
+            'arrays': sorted(arrays),
+        }
+        for field, value in arrays.items():
+            np.save(os.path.join(tmp_dirname, 'optimizer_%s.npy' % field),
+                    value)
+
+    with open(os.path.join(tmp_dirname, 'meta.pkl'), 'wb') as fp:
+        cPickle.dump(meta, fp, protocol=cPickle.HIGHEST_PROTOCOL)
+
+    if os.path.exists(dirname):
+        old_dirname = tmp_dirname + '.old'
+        os.rename(dirname, old_dirname)
+        os.rename(tmp_dirname, dirname)
+        shutil.rmtree(old_dirname)
+    else:
+        os.rename(tmp_dirname, dirname)
+
+
+def restore(model, dirname, mode='c'):
+    """Restore the checkpoint in ``dirname`` into ``model``, which has to have
+    the same architecture as the model the checkpoint was written from.
+
+    The parameters are mapped into memory with the given ``mode`` (see
+    ``ParameterSet.memmap``); with the default ``c``, changes are not written
+    back to the checkpoint. The optimizer state is handed to the next
+    optimizer created by the model.
+
+    Returns the dictionary of meta information of the checkpoint."""
+    with open(os.path.join(dirname, 'meta.pkl'), 'rb') as fp:
+        meta = cPickle.load(fp)
+
+    pars = model.parameters
+    if meta['floatX'] != theano.config.floatX:
+        raise ValueError('checkpoint was written with floatX=%s'
+                         % meta['floatX'])
+    if meta['n_pars'] != pars.n_pars or meta['layout'] != pars._layout:
+        raise ValueError('parameter layout of checkpoint does not match model')
+
+    pars.memmap(os.path.join(dirname, 'parameters.bin'), mode=mode)
+
+    opt_meta = meta['optimizer']
+    if opt_meta is not None:
+        state = dict(opt_meta['scalars'])
+        for field in opt_meta['arrays']:
+            fn = os.path.join(dirname, 'optimizer_%s.npy' % field)
+            state[field] = np.load(fn, mmap_mode='c')
+        model._optimizer_state = state
+
+    return meta
@@ -1,8 +1,14 @@
 """Module for manipulating data."""
 
+import collections
 import itertools
 import math
+import multiprocessing
+import multiprocessing.pool
+import Queue
 import random
+import sys
+import threading
 
 import numpy as np
 import scipy.interpolate
@@ -11,6 +17,9 @@ from sklearn.utils import check_random_state
 
 from climin.util import minibatches, iter_minibatches
 
+import sequences
+from sequences import PackedSequences
+
 
 def one_hot(array, n_classes=None):
     """Return one of k vectors for an array of class indices.
@@ -28,29 +37,165 @@ def one_hot(array, n_classes=None):
     return arr
 
 
-def shuffle(data):
-    """Shuffle the first dimension of an indexable object in place."""
-    for i in range(len(data) - 2):
-        swappartner = random.randint(i + 1, len(data) - 1)
-        a, b = data[swappartner][:], data[i][:]
-        data[i][:], data[swappartner][:] = b, a
+def random_cycles(n, random_state=None):
+    """Return a pair ``(order, starts)`` describing the cycles of a uniformly
+    drawn random permutation of ``n`` elements.
 
+    Cycle ``i`` is ``order[starts[i]:starts[i + 1]]`` (with ``starts``
+    implicitly ended by ``n``) and maps each of its elements to the next one,
+    the last to the first.
 
-def shuffle_many(arrays, axes, random_state=None):
+    The cycle structure is drawn directly instead of being extracted from a
+    permutation, which would need a loop over all elements: walking along a
+    random ordering, the current cycle is closed after the ``j``'th element
+    with probability ``1 / (n - j)``."""
     rng = check_random_state(random_state)
-
+    order = rng.permutation(n)
+    closes = rng.random_sample(n) * (n - np.arange(n)) < 1
+    starts = np.concatenate([[0], np.flatnonzero(closes[:-1]) + 1])
+    return order, starts
+
+
+def _rotate_cycles(arrays, order, starts, chunk_size):
+    """Move the element of each of ``arrays`` at ``order[j + 1]`` to
+    ``order[j]`` within each cycle, at most ``chunk_size`` elements at
+    once."""
+    stops = np.concatenate([starts[1:], [len(order)]])
+    for start, stop in zip(starts, stops):
+        if stop - start < 2:
+            continue
+        firsts = [a[order[start]].copy() for a in arrays]
+        for i in range(start, stop - 1, chunk_size):
+            j = min(i + chunk_size, stop - 1)
+            targets, sources = order[i:j], order[i + 1:j + 1]
+            for a in arrays:
+                a[targets] = a[sources]
+        for a, first in zip(arrays, firsts):
+            a[order[stop - 1]] = first
+
+
+def shuffle(data, random_state=None, max_bytes=2 ** 26):
+    """Shuffle the first dimension of an indexable object in place.
+
+    See ``shuffle_many`` for the parameters."""
+    if isinstance(data, np.ndarray):
+        shuffle_many([data], [0], random_state, max_bytes)
+    else:
+        rng = check_random_state(random_state)
+        data[:] = [data[i] for i in rng.permutation(len(data))]
+
+
+def shuffle_many(arrays, axes, random_state=None, max_bytes=2 ** 26):
+    """Shuffle several arrays in place with the same permutation.
+
+    The permutation is applied cycle by cycle, moving blocks of elements with
+    fancy indexing. No more than about ``max_bytes`` of temporary memory are
+    used, independent of the size of the arrays.
+
+    Parameters
+    ----------
+
+    arrays : list of array_like
+        Arrays to shuffle.
+
+    axes : list of integers
+        Axis to shuffle along for each of the arrays.
+
+    random_state : integer, RandomState or None, optional, default: None
+        Source of randomness.
+
+    max_bytes : integer, optional, default: 64MB
+        Bound on the temporary memory used.
+    """
     # We need to swap the axes of the arrays so that the axes along to shuffle
     # is the first for each. We don't need to swap back, since these will be
     # views.
     arrays = [i.swapaxes(0, j) for i, j in zip(arrays, axes)]
 
-    assert all(i.shape[0] == arrays[0].shape[0] for i in arrays[1:])
+    n = arrays[0].shape[0]
+    if not all(i.shape[0] == n for i in arrays[1:]):
+        raise ValueError('arrays need to have the same number of samples')
+
+    row_bytes = sum(i.nbytes // max(n, 1) for i in arrays)
+    chunk_size = max(1, max_bytes // max(row_bytes, 1))
+
+    order, starts = random_cycles(n, random_state)
+    _rotate_cycles(arrays, order, starts, chunk_size)
 
-    permutation = rng.permutation(arrays[0].shape[0])
 
-    for old_index, new_index in enumerate(permutation):
-        for a in arrays:
-            a[old_index], a[new_index] = a[new_index], a[old_index]
+class PermutedArray(object):
+    """PermutedArray class.
+
+    View on an array with one axis permuted, without moving the data.
+    Indexing gathers the selected elements, so that e.g. slicing minibatches
+    from it only copies the minibatches.
+
+    Parameters
+    ----------
+
+    array : array_like
+        Array to permute.
+
+    permutation : array_like
+        Integer array with the order of the elements along ``axis``.
+
+    axis : integer, optional, default: 0
+        Axis to permute.
+    """
+
+    def __init__(self, array, permutation, axis=0):
+        if len(permutation) != array.shape[axis]:
+            raise ValueError('permutation does not match array shape')
+        self.array = array
+        self.permutation = permutation
+        self.axis = axis
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    @property
+    def ndim(self):
+        return self.array.ndim
+
+    @property
+    def dtype(self):
+        return self.array.dtype
+
+    def __len__(self):
+        return self.array.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = key,
+        key = key + (slice(None),) * (self.ndim - len(key))
+        indices = self.permutation[key[self.axis]]
+        gathered = np.take(self.array, indices, axis=self.axis)
+        if np.ndim(indices) == 0:
+            rest = key[:self.axis] + key[self.axis + 1:]
+        else:
+            rest = key[:self.axis] + (slice(None),) + key[self.axis + 1:]
+        return gathered[rest]
+
+    def __array__(self, dtype=None):
+        res = np.take(self.array, self.permutation, axis=self.axis)
+        return res if dtype is None else res.astype(dtype)
+
+
+def lazy_shuffle_many(arrays, axes, random_state=None):
+    """Return a list of ``PermutedArray`` objects, one for each of
+    ``arrays``, which share a random permutation along the corresponding
+    entry of ``axes``.
+
+    No data is moved; the arrays are only gathered when indexed. To reshuffle,
+    e.g. between epochs, it suffices to shuffle the ``permutation`` attribute,
+    which is shared by all returned objects, in place."""
+    n = arrays[0].shape[axes[0]]
+    if not all(i.shape[j] == n for i, j in zip(arrays, axes)):
+        raise ValueError('arrays need to have the same number of samples')
+    rng = check_random_state(random_state)
+    permutation = rng.permutation(n)
+    return [PermutedArray(i, permutation, j) for i, j in zip(arrays, axes)]
 
 
 def padzeros(lst):
@@ -58,21 +203,117 @@ def padzeros(lst):
     reach unit length.
 
     Each element of `lst` can have a different first dimension, but has to be
-    equal on the other dimensions.
+    equal on the other dimensions. The dtype is preserved. `lst` can also be a
+    ``PackedSequences``.
     """
-    n_items = len(lst)
-    # Get the longest item.
-    maxlength = max(len(i) for i in lst)
-    restshape = list(lst[0].shape)[1:]
-    item_shape = [maxlength] + restshape
-    total_shape = [n_items] + item_shape
+    return PackedSequences.cast(lst).pad()
+
+
+class BucketedSequences(object):
+    """BucketedSequences class.
+
+    Minibatches of variable length sequences, where each minibatch is only
+    padded to the longest sequence it contains.
+
+    The sequences are sorted by length once and split into ``n_buckets``
+    buckets of similar lengths. Each epoch, the sequences of a bucket are
+    shuffled and cut into minibatches, and the order of all minibatches is
+    shuffled. Thus a minibatch never mixes sequences of very different length.
 
-    data = scipy.zeros(total_shape)
-    for i in range(n_items):
-        thislength = lst[i].shape[0]
-        data[i][-thislength:] = lst[i]
+    Iterating over the object yields tuples with one array per container
+    given in ``data`` followed by a mask, forever.
 
-    return data
+    Parameters
+    ----------
+
+    data : list
+        Aligned containers. Each is either a list of sequences, i.e. of arrays
+        with time along the first axis, a ``PackedSequences`` or an array with
+        samples along the first axis (e.g. targets of a pooling network). The
+        lengths are taken from the first container, which has to hold
+        sequences.
+
+    batch_size : integer
+        Number of sequences per minibatch.
+
+    n_buckets : integer, optional, default: None
+        Number of buckets. If None, each bucket holds about eight minibatches.
+
+    front : boolean, optional, default: True
+        If True, sequences are padded with zeros up front, as with
+        ``padzeros``; otherwise at the end.
+
+    random_state : integer, RandomState or None, optional, default: None
+        Source of randomness.
+
+
+    Attributes
+    ----------
+
+    buckets : list of arrays
+        Indices of the sequences in each bucket.
+    """
+
+    def __init__(self, data, batch_size, n_buckets=None, front=True,
+                 random_state=None):
+        if batch_size < 1:
+            raise ValueError('need strictly positive batch size')
+        self.data = data
+        self.batch_size = batch_size
+        self.front = front
+        self.rng = check_random_state(random_state)
+
+        if isinstance(data[0], PackedSequences):
+            self.lengths = data[0].lengths
+        else:
+            self.lengths = np.array([len(i) for i in data[0]])
+        n = len(self.lengths)
+        if not all(len(i) == n for i in data[1:]):
+            raise ValueError('containers to be batched have different lengths')
+        if n_buckets is None:
+            n_buckets = int(math.ceil(n / (8. * batch_size)))
+        order = np.argsort(self.lengths, kind='mergesort')
+        self.buckets = [i for i in np.array_split(order, n_buckets) if len(i)]
+
+    def epoch(self):
+        """Return a list of index arrays, one for each minibatch of a new
+        epoch."""
+        batches = []
+        for bucket in self.buckets:
+            bucket = self.rng.permutation(bucket)
+            batches += [bucket[i:i + self.batch_size]
+                        for i in range(0, len(bucket), self.batch_size)]
+        return [batches[i] for i in self.rng.permutation(len(batches))]
+
+    def batch(self, indices):
+        """Return a tuple with the minibatch of each container and the mask of
+        shape ``(t, n)`` for the sequences given by ``indices``.
+
+        Sequences are padded to arrays of shape ``(t, n, ...)``; the mask is 1
+        for the time steps present and 0 for those padded."""
+        lengths = self.lengths[indices]
+        length = lengths.max()
+        res = []
+        for container in self.data:
+            if isinstance(container, np.ndarray):
+                res.append(container[indices])
+                continue
+            if isinstance(container, PackedSequences):
+                seqs = container.take(indices)
+            else:
+                seqs = PackedSequences.from_list([container[i]
+                                                  for i in indices])
+            res.append(seqs.pad(length, self.front, time_major=True))
+
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        res.append(sequences.mask(offsets, length, self.front,
+                                  time_major=True, dtype=res[0].dtype))
+        return tuple(res)
+
+    def __iter__(self):
+        while True:
+            for indices in self.epoch():
+                yield self.batch(indices)
 
 
 def collapse_seq_borders(arr):
@@ -125,14 +366,11 @@ def uninterleave(lst):
 def interpolate(X, n_intermediates, kind='linear'):
     """Given an array of shape (j, k), return an array of size
     (j * n_intermediates, k) where each i * n_intermediated element refers to
-    the i'th element in X while all the others are linearly interpolated."""
-    X_ = scipy.empty((X.shape[0] * n_intermediates, X.shape[1]))
-    grid = scipy.mgrid[0:X.shape[0]]
-
-    finegrid = scipy.linspace(0, X.shape[0] - 1, X.shape[0] * n_intermediates)
-    for i in range(X.shape[1]):
-        f = scipy.interpolate.interp1d(grid, X[:, i], kind=kind)
-        X_[:, i] = f(finegrid)
+    the i'th element in X while all the others are linearly interpolated.
+
+    See ``breze.learn.sequences.interpolate`` for many sequences at once."""
+    X_, _ = sequences.interpolate(X, np.array([0, X.shape[0]]),
+                                  n_intermediates, kind)
     return X_
 
 
@@ -142,15 +380,40 @@ def n_windows(X, size, offset):
     return int(math.ceil((X.shape[0] - size + 1.) / offset))
 
 
+def window_view(seq, size, offset=1, writeable=False):
+    """Return a view on the array `seq`, which represents a sequence along its
+    first axis, containing all windows of `size` with `offset` as an array of
+    shape ``(n_windows, size) + seq.shape[1:]``.
+
+    No data is copied; consecutive windows share memory. Hence, the view is
+    read-only unless `writeable` is True."""
+    n = max(n_windows(seq, size, offset), 0)
+    shape = (n, size) + seq.shape[1:]
+    strides = (seq.strides[0] * offset, ) + seq.strides
+    view = np.lib.stride_tricks.as_strided(seq, shape=shape, strides=strides)
+    view.flags.writeable = writeable
+    return view
+
+
 def windowify(X, size, offset=1):
     """Return a static array that represents a sliding window dataset of size
-    `size` given by the list of arrays `."""
-    # Calculate the amount of windows that fit into one array.
-    n_items = sum(n_windows(i, size, offset) for i in X)
+    `size` given by the list of arrays `.
+
+    This copies every sample `size / offset` times. See ``WindowDataset`` for
+    a representation that does not.
+
+    If `X` is a ``PackedSequences``, the windows of all sequences are gathered
+    at once and the dtype is preserved."""
+    if isinstance(X, PackedSequences):
+        return X.windows(size, offset)
+    views = [window_view(i, size, offset) for i in X]
+    n_items = sum(len(i) for i in views)
     dim = X[0].shape[1]
     X_ = scipy.empty((n_items, size, dim))
-    for i, window in enumerate(iter_windows(X, size, offset)):
-        X_[i] = window
+    start = 0
+    for view in views:
+        X_[start:start + len(view)] = view
+        start += len(view)
 
     return X_
 
@@ -160,73 +423,156 @@ def iter_windows(X, size, offset=1):
     time window.
 
     `X` is expected to be a list of arrays, where each array represents a
-    sequence along its first axis."""
-    x_count = itertools.count(0)
+    sequence along its first axis, or a ``PackedSequences``."""
     for seq in X:
-        for j in [k * offset for k in range(n_windows(seq, size, offset))]:
-            i = x_count.next()
-            yield seq[j:j + size]
+        for window in window_view(seq, size, offset):
+            yield window
+
+
+class WindowDataset(object):
+    """WindowDataset class.
+
+    Sliding window dataset which is never stored as a whole. It can be used
+    in place of the array returned by ``windowify``, e.g. as the input to the
+    ``fit`` methods of the models.
+
+    Slicing along the sample axis gives another WindowDataset, just as basic
+    slicing of numpy arrays gives views. Any other indexing materializes the
+    selected windows only. Hence, slicing minibatches from it is cheap and
+    each minibatch is materialized right before it is used, see
+    ``breze.learn.base.cast_array_to_local_type``.
+
+    Parameters
+    ----------
+
+    X : array_like, list of array_like or PackedSequences
+        Sequence or list of sequences, each along its first axis. A list of
+        several sequences is concatenated once; the data of a
+        ``PackedSequences`` is used as it is.
+
+    size : integer
+        Length of the windows.
+
+    offset : integer, optional, default: 1
+        Offset between the starts of two consecutive windows of a sequence.
+
+    axis : integer, optional, default: 0
+        Axis along which the windows are arranged; 0 gives shape
+        ``(n_windows, size, ...)``, 1 gives ``(size, n_windows, ...)`` as used
+        by the recurrent networks.
+    """
+
+    def __init__(self, X, size, offset=1, axis=0):
+        if axis not in (0, 1):
+            raise ValueError('axis has to be 0 or 1')
+        if isinstance(X, np.ndarray):
+            X = PackedSequences(X, [0, X.shape[0]])
+        elif not isinstance(X, PackedSequences):
+            X = list(X)
+            if len(X) == 1:
+                X = PackedSequences(X[0], [0, X[0].shape[0]])
+            else:
+                X = PackedSequences.from_list(X)
+        self.data = X.data
+        self.size = size
+        self.axis = axis
+
+        # Views on all windows with an offset of one; the windows of the
+        # dataset are given by their index into it.
+        self._windows = window_view(self.data, size)
+        self.starts = sequences.window_starts(X.offsets, size, offset)
+
+    def _with_starts(self, starts):
+        res = object.__new__(WindowDataset)
+        res.__dict__.update(self.__dict__)
+        res.starts = starts
+        return res
+
+    @property
+    def shape(self):
+        shape = [len(self.starts), self.size] + list(self.data.shape[1:])
+        if self.axis == 1:
+            shape[0], shape[1] = shape[1], shape[0]
+        return tuple(shape)
+
+    @property
+    def ndim(self):
+        return self.data.ndim + 1
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = key,
+        key = key + (slice(None),) * (self.ndim - len(key))
+        sel = key[self.axis]
+        rest = key[:self.axis] + key[self.axis + 1:]
+
+        if (isinstance(sel, slice)
+                and all(isinstance(i, slice) and i == slice(None)
+                        for i in rest)):
+            return self._with_starts(self.starts[sel])
+
+        windows = self._windows[self.starts[sel]]
+        if np.ndim(sel) == 0:
+            return windows[rest]
+        if self.axis == 1:
+            windows = windows.swapaxes(0, 1)
+        return windows[key[:self.axis] + (slice(None),)
+                       + key[self.axis + 1:]]
+
+    def __array__(self, dtype=None):
+        res = self._windows[self.starts]
+        if self.axis == 1:
+            res = res.swapaxes(0, 1)
+        return res if dtype is None else res.astype(dtype)
 
 
 def split(X, maxlength):
     """Return a list of sequences where each sequence has a length of at most
     `maxlength`.
 
-    Given a list of sequences `X`, the sequences are split accordingly."""
-    new_X = []
-    for seq in X:
-        n_new_seqs, rest = divmod(seq.shape[0], maxlength)
-        if rest:
-            n_new_seqs += 1
-        for i in range(n_new_seqs):
-            new_X.append(seq[i * maxlength:(i + 1) * maxlength])
-    return new_X
+    Given a list of sequences `X`, the sequences are split accordingly. Given
+    a ``PackedSequences``, a ``PackedSequences`` sharing its data is
+    returned."""
+    if isinstance(X, PackedSequences):
+        return X.split(maxlength)
+    return PackedSequences.from_list(X).split(maxlength).to_list()
 
 
 def collapse(X, n):
     """Return a list of sequences, where `n` consecutive timesteps have been
     collapsed into a single timestep by concatenation for each sequence.
 
-    Timesteps are cut off to ensure divisibility by `n`."""
-    dim = X[0].shape[1]
-    new_X = []
-    for seq in X:
-        seq = scipy.ascontiguousarray(seq)
-        length = seq.shape[0]
-        keep = length / n * n
-        seq = seq[:keep]
-        seq.shape = length / n, dim * n
-        new_X.append(seq)
-
-    return new_X
+    Timesteps are cut off to ensure divisibility by `n`. Given a
+    ``PackedSequences``, a ``PackedSequences`` is returned."""
+    if isinstance(X, PackedSequences):
+        return X.collapse(n)
+    return PackedSequences.from_list(X).collapse(n).to_list()
 
 
 def uncollapse(X, n):
     """Return a list of sequences, where each timestep is divided into `n`
-    consecutive timesteps."""
-    new_X = []
-    dim = X[0].shape[1]
-    for seq in X:
-        length = seq.shape[0]
-        new_X.append(seq.reshape((length * n, dim / n)))
-    return new_X
+    consecutive timesteps. Given a ``PackedSequences``, a ``PackedSequences``
+    is returned."""
+    if isinstance(X, PackedSequences):
+        return X.uncollapse(n)
+    return PackedSequences.from_list(X).uncollapse(n).to_list()
 
 
 def consecutify(seqs):
     """Given sequences of equal second dimension, put them into a consecutive
     memory block M and return it. Also return a list of views to that block that
-    represent the given sequences."""
-    n_rows = sum(i.shape[0] for i in seqs)
-    n = seqs[0].shape[1]
-    block = scipy.empty((n_rows, n))
-    new_seqs = []
-    start = 0
-    for seq in seqs:
-        stop = start + seq.shape[0]
-        block[start:stop] = seq
-        new_seqs.append(block[start:stop])
-        start = stop
-    return block, new_seqs
+    represent the given sequences.
+
+    See ``PackedSequences`` for a container of sequences in this form."""
+    packed = PackedSequences.cast(seqs)
+    return packed.data, packed.to_list()
 
 
 def sample(arr, n, axis=0, with_replacement=False):
@@ -236,3 +582,263 @@ def sample(arr, n, axis=0, with_replacement=False):
     slices = tuple(all_slice if i != axis else sampled_indices
                    for i in range(arr.ndim))
     return arr[slices]
+
+
+class Prefetcher(object):
+    """Prefetcher class.
+
+    Prepares the next items of an iterator in the background, e.g. minibatches
+    while the optimizer computes the gradient of the current one. Items are
+    always delivered in the order of the underlying iterator.
+
+    Calling a prefetcher with an iterator ``batches`` and a function
+    ``prepare`` returns an iterator over ``prepare(batch)`` for each ``batch``
+    in ``batches``. Any callable with that signature can be used in its place.
+
+    Parameters
+    ----------
+
+    n_ahead : integer, optional, default: 2
+        Maximum number of items that are prepared but not yet consumed.
+
+    pool : None, 'thread' or 'process', optional, default: None
+        If None, a single background thread iterates over ``batches`` and
+        applies ``prepare``. Otherwise ``batches`` is iterated over in the
+        calling thread and ``prepare`` is applied by a pool of threads or
+        processes. In the latter case, ``prepare`` and the items have to be
+        picklable.
+
+    n_workers : integer, optional, default: 1
+        Number of workers of the pool. Ignored if ``pool`` is None.
+    """
+
+    def __init__(self, n_ahead=2, pool=None, n_workers=1):
+        if n_ahead < 1:
+            raise ValueError('need to prepare at least one item ahead')
+        if pool not in (None, 'thread', 'process'):
+            raise ValueError('unknown pool type %s' % pool)
+        self.n_ahead = n_ahead
+        self.pool = pool
+        self.n_workers = n_workers
+
+    def __call__(self, batches, prepare):
+        if self.pool is None:
+            return self._iter_background(batches, prepare)
+        return self._iter_pool(batches, prepare)
+
+    def _iter_background(self, batches, prepare):
+        queue = Queue.Queue(self.n_ahead)
+        stop = threading.Event()
+
+        def put(item):
+            # Do not block forever, so that the thread notices if the
+            # consumer is gone.
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for batch in batches:
+                    if not put((True, prepare(batch))):
+                        return
+                put((False, None))
+            except Exception:
+                put((False, sys.exc_info()))
+
+        thread = threading.Thread(target=produce)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            while True:
+                ok, item = queue.get()
+                if ok:
+                    yield item
+                elif item is None:
+                    return
+                else:
+                    raise item[0], item[1], item[2]
+        finally:
+            # Reached if the iterator is exhausted, closed or garbage
+            # collected, e.g. because ``iter_fit`` was abandoned.
+            stop.set()
+            thread.join()
+
+    def _iter_pool(self, batches, prepare):
+        if self.pool == 'thread':
+            pool = multiprocessing.pool.ThreadPool(self.n_workers)
+        else:
+            pool = multiprocessing.Pool(self.n_workers)
+
+        pending = collections.deque()
+        try:
+            for batch in batches:
+                pending.append(pool.apply_async(prepare, (batch,)))
+                if len(pending) >= self.n_ahead:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+def _block_rows(source, axis, target_bytes=2 ** 24):
+    """Return the number of samples along ``axis`` of ``source`` to read at
+    once, a multiple of the HDF5 chunk size if ``source`` is chunked."""
+    shape = source.shape
+    row_bytes = np.dtype(source.dtype).itemsize * max(
+        int(np.prod(shape[:axis] + shape[axis + 1:])), 1)
+    rows = max(1, target_bytes // row_bytes)
+    chunks = getattr(source, 'chunks', None)
+    if chunks:
+        rows = chunks[axis] * max(1, rows // chunks[axis])
+    return int(rows)
+
+
+class OutOfCoreDataset(object):
+    """OutOfCoreDataset class.
+
+    Array like wrapper of an array which does not fit into memory, such as an
+    h5py dataset or a ``numpy.memmap``. It can be given to the ``fit``,
+    ``iter_fit`` and ``powerfit`` methods of the models in place of an array.
+
+    Slicing along the sample axis gives another OutOfCoreDataset without
+    reading anything. Any other indexing reads the selected samples; index
+    arrays are sorted before reading, as required by h5py.
+
+    Minibatches of it are served by ``iter_block_minibatches``, which reads
+    whole blocks of ``block_rows`` consecutive samples at once.
+
+    Parameters
+    ----------
+
+    source : array_like
+        h5py dataset, memory mapped or any other array supporting slicing.
+
+    axis : integer, optional, default: 0
+        Axis along which the samples are arranged.
+
+    block_rows : integer, optional, default: None
+        Number of samples read at once when iterating over minibatches. If
+        None, blocks of about 16MB are used, aligned with the chunks of an
+        HDF5 dataset.
+    """
+
+    def __init__(self, source, axis=0, block_rows=None):
+        self.source = source
+        self.axis = axis
+        self.start = 0
+        self.stop = source.shape[axis]
+        if block_rows is None:
+            block_rows = _block_rows(source, axis)
+        if block_rows < 1:
+            raise ValueError('need strictly positive number of rows')
+        self.block_rows = block_rows
+
+    def _with_range(self, start, stop):
+        res = object.__new__(OutOfCoreDataset)
+        res.__dict__.update(self.__dict__)
+        res.start, res.stop = start, stop
+        return res
+
+    @property
+    def shape(self):
+        shape = list(self.source.shape)
+        shape[self.axis] = self.stop - self.start
+        return tuple(shape)
+
+    @property
+    def ndim(self):
+        return len(self.source.shape)
+
+    @property
+    def dtype(self):
+        return self.source.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _read(self, sel):
+        return np.asarray(self.source[(slice(None),) * self.axis + (sel,)])
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = key,
+        key = key + (slice(None),) * (self.ndim - len(key))
+        sel = key[self.axis]
+        rest = key[:self.axis] + key[self.axis + 1:]
+        n = self.stop - self.start
+
+        if isinstance(sel, slice):
+            start, stop, step = sel.indices(n)
+            if step == 1 and all(isinstance(i, slice) and i == slice(None)
+                                 for i in rest):
+                return self._with_range(self.start + start,
+                                        self.start + max(start, stop))
+            sel = np.arange(start, stop, step)
+
+        sel = np.asarray(sel)
+        if sel.ndim == 0:
+            index = int(sel) + (n if sel < 0 else 0) + self.start
+            return self._read(index)[rest]
+
+        sel = np.where(sel < 0, sel + n, sel) + self.start
+        unique, inverse = np.unique(sel, return_inverse=True)
+        res = np.take(self._read(unique), inverse, axis=self.axis)
+        return res[key[:self.axis] + (slice(None),) + key[self.axis + 1:]]
+
+    def __array__(self, dtype=None):
+        res = self._read(slice(self.start, self.stop))
+        return res if dtype is None else res.astype(dtype)
+
+
+def iter_block_minibatches(lst, batch_size, dims, random_state=None,
+                           read_ahead=1):
+    """Return an iterator that successively yields tuples containing aligned
+    minibatches of size ``batch_size`` from the containers in ``lst``, read
+    block wise.
+
+    Each epoch, the blocks of the ``OutOfCoreDataset`` objects in ``lst`` are
+    visited in random order. A block is read at once from each container and
+    cut into minibatches, which are yielded in random order. Thus every sample
+    is read once per epoch with large, chunk aligned reads, while the
+    minibatches are still shuffled. If ``read_ahead`` is positive, that many
+    blocks are read in a background thread.
+
+    ``dims`` gives the sample axis of each container, as for
+    ``iter_minibatches``."""
+    rng = check_random_state(random_state)
+    n_samples = lst[0].shape[dims[0]]
+    if not all(i.shape[d] == n_samples for i, d in zip(lst, dims)):
+        raise ValueError('containers to be batched have different lengths')
+
+    block_rows = [i.block_rows for i in lst
+                  if isinstance(i, OutOfCoreDataset)]
+    block_rows = min(block_rows) if block_rows else n_samples
+    # Do not cut minibatches across blocks unnecessarily.
+    block_rows = max(batch_size, block_rows // batch_size * batch_size)
+    starts = range(0, n_samples, block_rows)
+
+    def read(start):
+        stop = min(start + block_rows, n_samples)
+        return [np.asarray(i[(slice(None),) * d + (slice(start, stop),)])
+                for i, d in zip(lst, dims)]
+
+    while True:
+        order = [starts[i] for i in rng.permutation(len(starts))]
+        if read_ahead:
+            blocks = Prefetcher(read_ahead)(order, read)
+        else:
+            blocks = itertools.imap(read, order)
+        for block in blocks:
+            n = block[0].shape[dims[0]]
+            for start in rng.permutation(range(0, n, batch_size)):
+                yield tuple(
+                    i[(slice(None),) * d + (slice(start, start + batch_size),)]
+                    for i, d in zip(block, dims))
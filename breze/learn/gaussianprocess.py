@@ -6,7 +6,7 @@ import theano
 
 from breze.arch.model.gaussianprocess import GaussianProcess as GaussianProcess_
 
-from breze.learn.base import SupervisedBrezeWrapperBase
+from breze.learn.base import SupervisedBrezeWrapperBase, apply_in_chunks
 from breze.learn.sampling import slice_
 
 
@@ -126,14 +126,8 @@ class GaussianProcess(GaussianProcess_, SupervisedBrezeWrapperBase):
     def iter_fit(self, X, Z, mode=None):
         self.store_dataset(X, Z)
 
-        if 'diff' in self.exprs:
-            f_diff = self.function(['inpt'], 'diff')
-            diff = f_diff(X)
-            givens = {self.exprs['diff']: diff}
-        else:
-            givens = {}
         f_loss, f_d_loss = self._make_loss_functions(
-            givens=givens, mode=mode, on_unused_input='warn')
+            mode=mode, on_unused_input='warn')
 
         args = self._make_args(self.stored_X, self.stored_Z)
         opt = self._make_optimizer(f_loss, f_d_loss, args)
@@ -192,10 +186,7 @@ class GaussianProcess(GaussianProcess_, SupervisedBrezeWrapperBase):
             Y_var = Y_var * self.std_z
             return Y, Y_var
         else:
-            Y = np.empty((X.shape[0], 1)).astype(theano.config.floatX)
-            for start, stop in steps:
-                this_x = X[start:stop]
-                Y[start:stop] = self.f_predict(this_x)
+            Y = apply_in_chunks(self.f_predict, X, max_rows)
             Y = (Y * self.std_z) + self.mean_z
             return Y
 
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+"""Module implementing Hessian-free optimization.
+
+Hessian-free optimization [martens2010]_ is a truncated Newton method. Each
+step minimizes a damped quadratic model of the loss around the current
+parameters with conjugate gradients, which only need products of the
+curvature matrix with vectors. As curvature matrix, the Gauss-Newton matrix is
+used, which is positive semi definite for convex losses of the outputs of a
+model (see e.g. ``breze.learn.rnn.BaseRnn._gauss_newton_product``).
+
+The gradient is evaluated on a minibatch, while the curvature products are
+evaluated on a smaller sub-batch of it, which is formed once per step and
+reused by all conjugate gradient iterations of that step.
+
+.. [martens2010] Martens, J. "Deep learning via Hessian-free optimization."
+   Proceedings of the 27th International Conference on Machine Learning, 2010.
+"""
+
+
+import numpy as np
+from climin.base import Minimizer
+
+
+class HessianFree(Minimizer):
+    """Minimizer implementing Hessian-free optimization.
+
+    Parameters
+    ----------
+
+    wrt : array_like
+        Parameters to optimize, updated in place.
+
+    f : callable
+        Loss function, taking the parameters and the items of the argument
+        pairs in ``args``.
+
+    fprime : callable
+        Gradient of ``f`` with respect to the parameters, with the same
+        signature.
+
+    f_Hp : callable
+        Function taking the parameters, a vector ``p`` and the curvature
+        arguments and returning the product of the curvature matrix with
+        ``p``.
+
+    args : iterator, optional, default: None
+        Iterator over pairs ``(args, kwargs)`` of minibatches.
+
+    curvature_args : callable, optional, default: None
+        Function taking the list of arguments of a minibatch and returning the
+        list of arguments for ``f_Hp``, e.g. a sub-batch of it. If None, the
+        whole minibatch is used.
+
+    initial_damping : float, optional, default: 1.
+        Initial value of the Tikhonov damping added to the curvature. It is
+        adapted with the Levenberg-Marquardt heuristic.
+
+    max_cg_iter : integer, optional, default: 250
+        Maximum number of conjugate gradient iterations per step.
+
+    cg_decay : float, optional, default: 0.95
+        Factor the direction of the previous step is multiplied with to start
+        the conjugate gradients of the next one.
+
+    cg_tolerance : float, optional, default: 5e-4
+        Relative progress of the quadratic model per conjugate gradient
+        iteration below which the conjugate gradients are stopped.
+
+    max_backtrack : integer, optional, default: 10
+        Maximum number of times the step length is reduced if the loss does
+        not decrease. If it still does not, the step is rejected.
+
+
+    Attributes
+    ----------
+
+    damping : float
+        Current damping.
+
+    direction : array_like
+        Direction found in the last step.
+    """
+
+    state_fields = 'n_iter damping direction'.split()
+
+    def __init__(self, wrt, f, fprime, f_Hp, args=None, curvature_args=None,
+                 initial_damping=1., max_cg_iter=250, cg_decay=0.95,
+                 cg_tolerance=5e-4, max_backtrack=10):
+        super(HessianFree, self).__init__(wrt, args=args)
+        if max_cg_iter < 1:
+            raise ValueError('need strictly positive number of iterations')
+
+        self.f = f
+        self.fprime = fprime
+        self.f_Hp = f_Hp
+        self.curvature_args = curvature_args
+        self.damping = initial_damping
+        self.max_cg_iter = max_cg_iter
+        self.cg_decay = cg_decay
+        self.cg_tolerance = cg_tolerance
+        self.max_backtrack = max_backtrack
+
+        self.direction = np.zeros(wrt.shape, dtype=wrt.dtype)
+
+    def _cg(self, gradient, f_Gp, x0):
+        """Return a pair ``(x, n_iter)``, where ``x`` approximately minimizes
+        the quadratic ``0.5 * x'Gx + gradient'x`` and ``n_iter`` is the number
+        of iterations taken.
+
+        The stopping criterion on the relative progress of the quadratic is
+        the one of [martens2010]_."""
+        x = x0.copy()
+        r = f_Gp(x) + gradient
+        p = -r
+        r_sq = np.dot(r, r)
+        # Values of the quadratic, which equals 0.5 * x'(r + gradient).
+        values = [0.5 * np.dot(x, r + gradient)]
+
+        for i in range(1, self.max_cg_iter + 1):
+            Gp = f_Gp(p)
+            curvature = np.dot(p, Gp)
+            if curvature <= 0:
+                # Only possible through numerical problems.
+                break
+            alpha = r_sq / curvature
+            x += alpha * p
+            r += alpha * Gp
+            r_sq_new = np.dot(r, r)
+            p *= r_sq_new / r_sq
+            p -= r
+            r_sq = r_sq_new
+
+            values.append(0.5 * np.dot(x, r + gradient))
+            k = max(10, i // 10)
+            if (i > k and values[-1] < 0
+                    and (values[-1] - values[-1 - k]) / values[-1]
+                    < k * self.cg_tolerance):
+                break
+            if r_sq == 0:
+                break
+
+        return x, i
+
+    def _iterate(self):
+        for args, kwargs in self.args:
+            # The gradient is asked for first: with
+            # ``breze.learn.base.FusedLossAndGrad``, the loss then comes from
+            # the same pass through the model.
+            gradient = self.fprime(self.wrt, *args, **kwargs)
+            loss = self.f(self.wrt, *args, **kwargs)
+
+            # Formed once, then reused for all products of this step.
+            if self.curvature_args is None:
+                c_args = args
+            else:
+                c_args = self.curvature_args(args)
+
+            damping = self.damping
+            f_Gp = lambda p: (self.f_Hp(self.wrt, p, *c_args, **kwargs)
+                              + damping * p)
+
+            direction, n_cg_iter = self._cg(
+                gradient, f_Gp, self.cg_decay * self.direction)
+            self.direction[...] = direction
+
+            # Change of the loss predicted by the quadratic model.
+            predicted = (np.dot(gradient, direction)
+                         + 0.5 * np.dot(direction, f_Gp(direction)))
+
+            old_wrt = self.wrt.copy()
+            self.wrt += direction
+            new_loss = self.f(self.wrt, *args, **kwargs)
+
+            # Levenberg-Marquardt adaption of the damping, based on how well
+            # the full step was predicted.
+            rho = 0.
+            if predicted < 0 and np.isfinite(new_loss):
+                rho = (new_loss - loss) / predicted
+            if rho < 0.25:
+                self.damping *= 1.5
+            elif rho > 0.75:
+                self.damping *= 2. / 3
+
+            # Shorten the step until it decreases the loss.
+            step_length = 1.
+            n_backtrack = 0
+            while not new_loss < loss:
+                if n_backtrack == self.max_backtrack:
+                    self.wrt[...] = old_wrt
+                    step_length, new_loss = 0., loss
+                    break
+                n_backtrack += 1
+                step_length *= 0.8
+                self.wrt[...] = old_wrt + step_length * direction
+                new_loss = self.f(self.wrt, *args, **kwargs)
+
+            self.n_iter += 1
+            yield {
+                'n_iter': self.n_iter,
+                'damping': self.damping,
+                'loss': new_loss,
+                'gradient': gradient,
+                'step_length': step_length,
+                'rho': rho,
+                'n_cg_iter': n_cg_iter,
+                'args': args,
+                'kwargs': kwargs,
+            }
@@ -207,11 +207,8 @@ class DropoutMlp(Mlp):
 
         d_loss = T.grad(loss, self.parameters.flat)
 
-        f_loss = self.function(['inpt', 'target'], loss, explicit_pars=True,
-                               mode=mode)
-        f_d_loss = self.function(['inpt', 'target'], d_loss, explicit_pars=True,
-                                 mode=mode)
-        return f_loss, f_d_loss
+        return self._compile_loss_functions(
+            ['inpt', 'target'], loss, d_loss, mode=mode)
 
     def iter_fit(self, X, Z):
         """Iteratively fit the parameters of the model to the given data with
@@ -235,23 +232,27 @@ class DropoutMlp(Mlp):
             defined as in ``X``, but ``l`` is the dimensionality of a single
             output.
         """
+        self._store_resident((X, Z))
         f_loss, f_d_loss = self._make_loss_functions()
 
         args = self._make_args(X, Z)
         opt = self._make_optimizer(f_loss, f_d_loss, args)
 
-        for i, info in enumerate(opt):
-            yield info
-            if self.max_length is not None:
-                W = self.parameters['in_to_hidden']
-                max_length_columns(W, self.max_length)
+        try:
+            for i, info in enumerate(opt):
+                yield info
+                if self.max_length is not None:
+                    W = self.parameters['in_to_hidden']
+                    max_length_columns(W, self.max_length)
 
-                n_layers = len(self.n_hiddens)
-                for i in range(n_layers - 1):
-                    W = self.parameters['hidden_to_hidden_%i' % i]
+                    n_layers = len(self.n_hiddens)
+                    for i in range(n_layers - 1):
+                        W = self.parameters['hidden_to_hidden_%i' % i]
+                        max_length_columns(W, self.max_length)
+                    W = self.parameters['hidden_to_out']
                     max_length_columns(W, self.max_length)
-                W = self.parameters['hidden_to_out']
-                max_length_columns(W, self.max_length)
+        finally:
+            self._release_resident()
 
 
 class FastDropoutNetwork(FastDropoutNetwork,
@@ -0,0 +1,490 @@
+# -*- coding: utf-8 -*-
+
+"""Module for inference with trained models in plain NumPy.
+
+Compiling the prediction functions of a model requires Theano and takes some
+time, which dominates the start up of short lived processes that only need to
+make predictions. The classes in this module reimplement the forward pass of
+trained models with NumPy only. They can be exported from a trained model,
+saved to disk and loaded without importing Theano.
+
+This module must not import Theano, directly or indirectly.
+"""
+
+
+import numpy as np
+
+
+def _identity(a):
+    return a
+
+
+def _tanh(a):
+    return np.tanh(a, out=a)
+
+
+def _tanhplus(a):
+    a += np.tanh(a)
+    return a
+
+
+def _sigmoid(a):
+    np.negative(a, out=a)
+    np.exp(a, out=a)
+    a += 1
+    return np.reciprocal(a, out=a)
+
+
+def _rectifier(a):
+    return np.maximum(a, 0, out=a)
+
+
+def _softplus(a):
+    # Numerically more stable than log(1 + exp(a)).
+    return np.logaddexp(0, a, out=a)
+
+
+def _logproduct_of_t(a):
+    np.square(a, out=a)
+    return np.log1p(a, out=a)
+
+
+def _softmax(a):
+    a -= a.max(axis=1)[:, np.newaxis]
+    np.exp(a, out=a)
+    a /= a.sum(axis=1)[:, np.newaxis]
+    return a
+
+
+def _logcosh(a):
+    np.cosh(a, out=a)
+    return np.log(a, out=a)
+
+
+def _softabs(a, eps=1E-5):
+    np.square(a, out=a)
+    a += eps
+    return np.sqrt(a, out=a)
+
+
+def _softsign(a):
+    a /= 1 + abs(a)
+    return a
+
+
+# In place counterparts of the functions in ``breze.arch.component.transfer``.
+transfers = {
+    'identity': _identity,
+    'tanh': _tanh,
+    'tanhplus': _tanhplus,
+    'sigmoid': _sigmoid,
+    'rectifier': _rectifier,
+    'softplus': _softplus,
+    'logproduct_of_t': _logproduct_of_t,
+    'softmax': _softmax,
+    'logcosh': _logcosh,
+    'softabs': _softabs,
+    'softsign': _softsign,
+}
+
+
+def lookup_transfer(name):
+    """Return the in place NumPy transfer function identified by ``name``."""
+    if not isinstance(name, (str, unicode)):
+        raise ValueError('can only export transfer functions given by name, '
+                         'not %r' % (name,))
+    try:
+        return transfers[name]
+    except KeyError:
+        raise ValueError('no NumPy implementation of transfer function %s'
+                         % name)
+
+
+class NumpyMlp(object):
+    """NumpyMlp class.
+
+    Forward pass of a multilayer perceptron as trained with
+    ``breze.learn.mlp.Mlp``, implemented with NumPy only.
+
+    The activations of each layer are kept in buffers which are allocated once
+    and reused across calls to ``.predict``.
+
+    Parameters
+    ----------
+
+    weights : list of arrays
+        Weight matrices of the layers, starting with the one from the inputs
+        to the first hidden layer and ending with the one to the outputs.
+
+    biases : list of arrays
+        Bias vectors aligned with ``weights``.
+
+    transfers : list of strings
+        Names of the transfer functions aligned with ``weights``, as found in
+        ``breze.arch.component.transfer``.
+
+    max_rows : integer, optional, default: 1024
+        Number of rows the buffers are allocated for. Larger inputs are
+        processed in chunks of this many rows.
+    """
+
+    def __init__(self, weights, biases, transfers, max_rows=1024):
+        if not len(weights) == len(biases) == len(transfers):
+            raise ValueError('weights, biases and transfers have to be of the '
+                             'same length')
+        if max_rows < 1:
+            raise ValueError('need strictly positive number of rows')
+
+        self.dtype = weights[0].dtype
+        self.weights = [np.ascontiguousarray(i, dtype=self.dtype)
+                        for i in weights]
+        self.biases = [np.asarray(i, dtype=self.dtype) for i in biases]
+        self.transfers = list(transfers)
+        self._f_transfers = [lookup_transfer(i) for i in self.transfers]
+
+        self.n_inpt = self.weights[0].shape[0]
+        self.n_output = self.weights[-1].shape[1]
+        self.max_rows = max_rows
+        self._buffers = [np.empty((max_rows, w.shape[1]), dtype=self.dtype)
+                         for w in self.weights]
+
+    @classmethod
+    def from_mlp(cls, mlp, max_rows=1024):
+        """Return a NumpyMlp with the current parameters of ``mlp``, an
+        instance of ``breze.learn.mlp.Mlp``."""
+        n_layers = len(mlp.n_hiddens)
+        pars = mlp.parameters
+        weights = ([pars['in_to_hidden']]
+                   + [pars['hidden_to_hidden_%i' % i]
+                      for i in range(n_layers - 1)]
+                   + [pars['hidden_to_out']])
+        biases = ([pars['hidden_bias_%i' % i] for i in range(n_layers)]
+                  + [pars['out_bias']])
+        transfers = list(mlp.hidden_transfers) + [mlp.out_transfer]
+        # Copy, so later training of ``mlp`` does not change the result.
+        return cls([np.array(i) for i in weights],
+                   [np.array(i) for i in biases],
+                   transfers, max_rows)
+
+    def save(self, fn):
+        """Save the network to the file ``fn`` in NumPy's ``.npz`` format."""
+        arrays = {}
+        for i, (w, b) in enumerate(zip(self.weights, self.biases)):
+            arrays['weights_%i' % i] = w
+            arrays['bias_%i' % i] = b
+        np.savez(fn, transfers=np.array(self.transfers), **arrays)
+
+    @classmethod
+    def load(cls, fn, max_rows=1024):
+        """Return a NumpyMlp loaded from the file ``fn`` written by
+        ``.save``."""
+        data = np.load(fn)
+        transfers = [str(i) for i in data['transfers']]
+        weights = [data['weights_%i' % i] for i in range(len(transfers))]
+        biases = [data['bias_%i' % i] for i in range(len(transfers))]
+        return cls(weights, biases, transfers, max_rows)
+
+    def _forward(self, X):
+        n = X.shape[0]
+        a = X
+        for w, b, f, buf in zip(self.weights, self.biases, self._f_transfers,
+                                self._buffers):
+            out = buf[:n]
+            np.dot(a, w, out=out)
+            out += b
+            a = f(out)
+        return a
+
+    def predict(self, X, out=None):
+        """Return the output of the network given the input.
+
+        Parameters
+        ----------
+
+        X : array_like
+            Array of shape ``(n, d)`` holding the inputs in its rows.
+
+        out : array_like, optional, default: None
+            Array of shape ``(n, k)`` to write the result to. If None, a new
+            array is allocated.
+
+        Returns
+        -------
+
+        Y : array_like
+            Array of shape ``(n, k)`` holding the outputs in its rows.
+        """
+        X = np.asarray(X, dtype=self.dtype)
+        if out is None:
+            out = np.empty((X.shape[0], self.n_output), dtype=self.dtype)
+        for start in range(0, X.shape[0], self.max_rows):
+            stop = start + self.max_rows
+            out[start:stop] = self._forward(X[start:stop])
+        return out
+
+
+def _last(a, axis=0):
+    return a[-1]
+
+
+# Poolings over time, as in ``breze.arch.model.sequential.rnn``.
+poolings = {
+    'sum': np.sum,
+    'mean': np.mean,
+    'prod': np.prod,
+    'min': np.min,
+    'max': np.max,
+    'last': _last,
+}
+
+
+class NumpyLstm(object):
+    """NumpyLstm class.
+
+    Forward pass of a recurrent network with LSTM cells as trained with
+    ``breze.learn.rnn.SupervisedLstm``, implemented with NumPy only.
+
+    The input projections of all time steps are done with a single matrix
+    product per layer before the recurrence. Each step then does one product
+    with the recurrent weights and applies the transfer function to the three
+    gates in a single call, writing to buffers which are reused across time
+    steps.
+
+    Parameters
+    ----------
+
+    in_weights : list of arrays
+        Weight matrices from the input of each layer (i.e. the inputs of the
+        network or the hidden units of the layer below) to its cell input and
+        gates, of shape ``(n_in, 4 * n_hidden)``.
+
+    biases : list of arrays
+        Bias vectors aligned with ``in_weights``.
+
+    recurrents : list of arrays
+        Recurrent weight matrices of shape ``(n_hidden, 4 * n_hidden)``.
+
+    peepholes : list of arrays
+        Arrays of shape ``(3, n_hidden)`` holding the peephole weights of the
+        input, forget and output gate of each layer.
+
+    hidden_transfers : list of strings
+        Names of the transfer functions of the layers, as found in
+        ``breze.arch.component.transfer``.
+
+    out_weights, out_bias : array_like
+        Weight matrix and bias of the output layer.
+
+    out_transfer : string
+        Name of the transfer function of the output layer.
+
+    leaky_coeffs : list of arrays, optional, default: None
+        Coefficients for leaky integration of each layer.
+
+    pooling : string, optional, default: None
+        One of ``sum``, ``mean``, ``prod``, ``min``, ``max``, ``last`` or
+        None.
+    """
+
+    def __init__(self, in_weights, biases, recurrents, peepholes,
+                 hidden_transfers, out_weights, out_bias, out_transfer,
+                 leaky_coeffs=None, pooling=None):
+        n_layers = len(in_weights)
+        if not (len(biases) == len(recurrents) == len(peepholes)
+                == len(hidden_transfers) == n_layers):
+            raise ValueError('parameters of the layers have to be of the '
+                             'same length')
+        if leaky_coeffs is not None and len(leaky_coeffs) != n_layers:
+            raise ValueError('need leaky coefficients for each layer')
+        if pooling is not None and pooling not in poolings:
+            raise ValueError('no NumPy implementation of pooling %s' % pooling)
+
+        self.dtype = in_weights[0].dtype
+        as_array = lambda a: np.ascontiguousarray(a, dtype=self.dtype)
+        self.in_weights = [as_array(i) for i in in_weights]
+        self.biases = [as_array(i) for i in biases]
+        self.recurrents = [as_array(i) for i in recurrents]
+        self.peepholes = [as_array(i) for i in peepholes]
+        self.hidden_transfers = list(hidden_transfers)
+        self.out_weights = as_array(out_weights)
+        self.out_bias = as_array(out_bias)
+        self.out_transfer = out_transfer
+        self.leaky_coeffs = (None if leaky_coeffs is None
+                             else [as_array(i) for i in leaky_coeffs])
+        self.pooling = pooling
+
+        self._f_hiddens = [lookup_transfer(i) for i in self.hidden_transfers]
+        self._f_output = lookup_transfer(out_transfer)
+
+        self.n_inpt = self.in_weights[0].shape[0]
+        self.n_hiddens = [i.shape[0] for i in self.recurrents]
+        self.n_output = self.out_weights.shape[1]
+
+    @classmethod
+    def from_lstm(cls, lstm):
+        """Return a NumpyLstm with the current parameters of ``lstm``, an
+        instance of ``breze.learn.rnn.SupervisedLstm``."""
+        n_layers = len(lstm.n_hiddens)
+        pars = lstm.parameters
+        in_weights = ([pars['in_to_hidden']]
+                      + [pars['hidden_to_hidden_%i' % i]
+                         for i in range(n_layers - 1)])
+        peepholes = [np.array([pars['ingate_peephole_%i' % i],
+                               pars['forgetgate_peephole_%i' % i],
+                               pars['outgate_peephole_%i' % i]])
+                     for i in range(n_layers)]
+        leaky_coeffs = lstm.leaky_coeffs
+        if leaky_coeffs is not None:
+            leaky_coeffs = [np.array(i) for i in leaky_coeffs]
+        # Copy, so later training of ``lstm`` does not change the result.
+        return cls([np.array(i) for i in in_weights],
+                   [np.array(pars['hidden_bias_%i' % i])
+                    for i in range(n_layers)],
+                   [np.array(pars['recurrent_%i' % i])
+                    for i in range(n_layers)],
+                   peepholes, lstm.hidden_transfers,
+                   np.array(pars['hidden_to_out']),
+                   np.array(pars['out_bias']), lstm.out_transfer,
+                   leaky_coeffs, lstm.pooling)
+
+    def save(self, fn):
+        """Save the network to the file ``fn`` in NumPy's ``.npz`` format."""
+        arrays = {
+            'out_weights': self.out_weights,
+            'out_bias': self.out_bias,
+        }
+        for i in range(len(self.n_hiddens)):
+            arrays['in_weights_%i' % i] = self.in_weights[i]
+            arrays['bias_%i' % i] = self.biases[i]
+            arrays['recurrent_%i' % i] = self.recurrents[i]
+            arrays['peepholes_%i' % i] = self.peepholes[i]
+            if self.leaky_coeffs is not None:
+                arrays['leaky_coeffs_%i' % i] = self.leaky_coeffs[i]
+        np.savez(fn, hidden_transfers=np.array(self.hidden_transfers),
+                 out_transfer=np.array(self.out_transfer),
+                 pooling=np.array('' if self.pooling is None
+                                  else self.pooling),
+                 **arrays)
+
+    @classmethod
+    def load(cls, fn):
+        """Return a NumpyLstm loaded from the file ``fn`` written by
+        ``.save``."""
+        data = np.load(fn)
+        hidden_transfers = [str(i) for i in data['hidden_transfers']]
+        layers = range(len(hidden_transfers))
+        leaky_coeffs = None
+        if 'leaky_coeffs_0' in data.files:
+            leaky_coeffs = [data['leaky_coeffs_%i' % i] for i in layers]
+        return cls([data['in_weights_%i' % i] for i in layers],
+                   [data['bias_%i' % i] for i in layers],
+                   [data['recurrent_%i' % i] for i in layers],
+                   [data['peepholes_%i' % i] for i in layers],
+                   hidden_transfers, data['out_weights'], data['out_bias'],
+                   str(data['out_transfer']), leaky_coeffs,
+                   str(data['pooling']) or None)
+
+    def initial_states(self, n):
+        """Return the states ``n`` sequences start from: for each layer a
+        list of the cell states, the cell outputs and, with leaky
+        integration, the integrated outputs, each of shape
+        ``(n, n_hidden)``."""
+        n_states = 2 if self.leaky_coeffs is None else 3
+        return [[np.zeros((n, h), dtype=self.dtype) for _ in range(n_states)]
+                for h in self.n_hiddens]
+
+    def _layer(self, i, inpt, states):
+        """Run layer ``i`` over the sequences ``inpt`` of shape
+        ``(t, n, n_in)``, updating ``states`` in place. Return the outputs of
+        shape ``(t, n, n_hidden)``."""
+        n_steps, n = inpt.shape[:2]
+        h = self.n_hiddens[i]
+        f = self._f_hiddens[i]
+        recurrent, peepholes = self.recurrents[i], self.peepholes[i]
+        coeffs = None if self.leaky_coeffs is None else self.leaky_coeffs[i]
+        cell, hidden = states[:2]
+
+        projected = np.dot(inpt.reshape((-1, inpt.shape[2])),
+                           self.in_weights[i])
+        projected += self.biases[i]
+        projected = projected.reshape((n_steps, n, 4 * h))
+
+        res = np.empty((n_steps, n, h), dtype=self.dtype)
+        pre = np.empty((n, 4 * h), dtype=self.dtype)
+        peep = np.empty((n, 3, h), dtype=self.dtype)
+        # Views on the cell input and the input, forget and output gates.
+        cell_inpt = pre[:, :h]
+        gates = pre.reshape((n, 4, h))[:, 1:]
+        for t in range(n_steps):
+            np.dot(hidden, recurrent, out=pre)
+            pre += projected[t]
+            np.tanh(cell_inpt, out=cell_inpt)
+
+            np.multiply(cell[:, np.newaxis], peepholes, out=peep)
+            gates += peep
+            f(gates)
+
+            cell *= gates[:, 1]
+            cell_inpt *= gates[:, 0]
+            cell += cell_inpt
+            hidden[...] = cell
+            f(hidden)
+            hidden *= gates[:, 2]
+
+            if coeffs is None:
+                res[t] = hidden
+            else:
+                leaky = states[2]
+                leaky *= coeffs
+                leaky += (1 - coeffs) * hidden
+                res[t] = leaky
+        return res
+
+    def predict(self, X, states=None):
+        """Return the output of the network given the input sequences.
+
+        Parameters
+        ----------
+
+        X : array_like
+            Array of shape ``(t, n, d)`` holding ``n`` sequences.
+
+        states : list, optional, default: None
+            States to continue the sequences from, as returned by
+            ``.initial_states`` or ``.step``. They are updated in place to
+            the states at the end of the sequences. If None, the sequences
+            start from the initial states.
+
+        Returns
+        -------
+
+        Y : array_like
+            Array of shape ``(t, n, k)``, or ``(n, k)`` if the network pools
+            over time.
+        """
+        X = np.asarray(X, dtype=self.dtype)
+        if states is None:
+            states = self.initial_states(X.shape[1])
+
+        inpt = X
+        for i in range(len(self.n_hiddens)):
+            inpt = self._layer(i, inpt, states[i])
+
+        n_steps, n = inpt.shape[:2]
+        out = np.dot(inpt.reshape((n_steps * n, -1)), self.out_weights)
+        out += self.out_bias
+        if self.pooling is None:
+            return self._f_output(out).reshape((n_steps, n, self.n_output))
+        pooled = poolings[self.pooling](out.reshape((n_steps, n, -1)), axis=0)
+        return self._f_output(np.array(pooled, dtype=self.dtype))
+
+    def step(self, x, states=None):
+        """Return a pair ``(y, states)`` of the output of the network for a
+        single time step ``x`` of shape ``(n, d)`` and the states to continue
+        from, see ``.predict``."""
+        if self.pooling is not None:
+            raise ValueError('cannot step through a pooling network')
+        x = np.asarray(x, dtype=self.dtype)
+        if states is None:
+            states = self.initial_states(x.shape[0])
+        return self.predict(x[np.newaxis], states)[0], states
@@ -3,14 +3,20 @@
 """Module for learning various types of recurrent networks."""
 
 
+import collections
+
 import breze.arch.model.sequential.rnn as rnn
 import numpy as np
 import theano
 import theano.tensor as T
 
+from sklearn.utils import check_random_state
+
 from breze.learn.base import (
     SupervisedBrezeWrapperBase, UnsupervisedBrezeWrapperBase,
-    TransformBrezeWrapperMixin)
+    TransformBrezeWrapperMixin, FusedLossAndGrad, cast_array_to_local_type,
+    cast_arrays_to_local_type)
+from breze.learn.data import BucketedSequences, PackedSequences
 from breze.arch.model.varprop import rnn as varprop_rnn
 from breze.arch.component.misc import project_into_l2_ball
 
@@ -60,7 +66,9 @@ class BaseRnn(object):
 
     optimizer : string, pair
         Argument is passed to ``climin.util.optimizer`` to construct an
-        optimizer.
+        optimizer. Additionally, ``hf`` selects Hessian-free optimization
+        with the Gauss-Newton matrix of the network, see
+        ``breze.learn.hessianfree.HessianFree`` for its options.
 
     batch_size : integer, None
         Number of examples per batch when calculting the loss
@@ -76,8 +84,53 @@ class BaseRnn(object):
 
     verbose : boolean
         Flag indicating whether to print out information during fitting.
+
+    use_mask : boolean, optional [default: False]
+        If True, the network takes a mask of shape ``(t, n)`` as an additional
+        data argument, which is 1 for the time steps present and 0 for
+        padding. Padded time steps do not change the hidden state and are
+        excluded from the loss and from pooling. Arrays given to the fit
+        methods are then completed with a mask of ones.
+
+    bptt_steps : integer, optional [default: None]
+        If given, training uses truncated backpropagation through time: each
+        minibatch is cut along the time axis into chunks of this many steps,
+        which are presented to the optimizer one after the other. Gradients
+        do not flow across chunk borders, so the memory needed for a step is
+        independent of the length of the sequences. Not available with
+        pooling.
+
+    bptt_carry : string, optional [default: 'state']
+        What the hidden states of a chunk start from if ``bptt_steps`` is
+        given. With ``state``, the recurrent states reached at the end of the
+        previous chunk of the same sequences are carried over (but treated as
+        constants); with ``reset``, each chunk starts from the initial states
+        as if it were a sequence of its own.
+
+
+    The data given to the fit methods can also be lists of variable length
+    sequences, i.e. of arrays of shape ``(t, d)``, or
+    ``breze.learn.data.PackedSequences``, if a batch size is given.
+    The sequences are then grouped into minibatches of similar length by
+    ``breze.learn.data.BucketedSequences`` with ``.n_buckets`` buckets, and
+    each minibatch is only padded to its longest sequence. If ``.use_mask`` is
+    True, the padding is masked out and does not influence the result.
+
+    With Hessian-free optimization, the curvature is evaluated on a random
+    subset of ``.curvature_batch_size`` samples of each minibatch, or on the
+    whole minibatch if it is None. The subsets are drawn from
+    ``.random_state``.
+
+    The states of the streams of ``.predict_stream`` are kept until they are
+    forgotten via ``.reset_streams``. If ``.max_streams`` is given, at most
+    that many are kept, and the least recently used ones are forgotten
+    first.
     """
 
+    n_buckets = None
+    curvature_batch_size = None
+    max_streams = None
+
     def __init__(self, n_inpt, n_hidden, n_output,
                  hidden_transfer='tanh', out_transfer='identity',
                  loss='squared', pooling=None,
@@ -86,17 +139,37 @@ class BaseRnn(object):
                  batch_size=None,
                  gradient_clip=False,
                  max_iter=1000,
-                 verbose=False):
+                 verbose=False,
+                 use_mask=False,
+                 bptt_steps=None,
+                 bptt_carry='state'):
+        if bptt_steps is not None:
+            if bptt_steps < 1:
+                raise ValueError('need strictly positive number of steps')
+            if pooling is not None:
+                raise ValueError('truncated backpropagation through time is '
+                                 'not available with pooling')
+        if bptt_carry not in ('state', 'reset'):
+            raise ValueError('unknown carry policy %s' % bptt_carry)
+        if use_mask:
+            self.data_arguments = tuple(self.data_arguments) + ('mask',)
+            self.sample_dim = tuple(self.sample_dim) + (1,)
         super(BaseRnn, self).__init__(
             n_inpt, n_hidden, n_output, hidden_transfer, out_transfer,
-            loss, pooling, leaky_coeffs)
+            loss, pooling, leaky_coeffs, use_mask=use_mask)
         self.optimizer = optimizer
         self.batch_size = batch_size
         self.gradient_clip = gradient_clip
         self.max_iter = max_iter
         self.verbose = verbose
+        self.bptt_steps = bptt_steps
+        self.bptt_carry = bptt_carry
+        if self._carries_states() and not rnn.state_names(self.exprs):
+            raise ValueError('model has no recurrent states to carry')
 
         self.f_predict = None
+        self._f_stream = None
+        self._stream_states = collections.OrderedDict()
         self.parameters.data[:] = np.random.standard_normal(
             self.parameters.data.shape).astype(theano.config.floatX)
 
@@ -118,6 +191,44 @@ class BaseRnn(object):
 
         return Hp
 
+    def _optimizer_ident(self):
+        if isinstance(self.optimizer, (str, unicode)):
+            return self.optimizer
+        return self.optimizer[0]
+
+    def _make_gauss_newton_function(self):
+        """Return a function ``f_Hp`` which takes the parameters, a vector
+        ``p`` and the data arguments and returns the product of the
+        Gauss-Newton matrix with ``p``."""
+        Hp = self._gauss_newton_product()
+        variables = ['some-vector'] + list(self.data_arguments)
+        return self.function(variables, Hp, explicit_pars=True)
+
+    def _curvature_args(self, args, random_state=None):
+        """Return the arguments of a minibatch reduced to a random subset of
+        ``.curvature_batch_size`` samples."""
+        n = self.curvature_batch_size
+        n_samples = args[0].shape[self.sample_dim[0]]
+        if n is None or n >= n_samples:
+            return args
+        rng = check_random_state(random_state)
+        idxs = np.sort(rng.permutation(n_samples)[:n])
+        return [np.take(i, idxs, axis=d) for i, d in zip(args, self.sample_dim)]
+
+    def _make_optimizer(self, f, fprime, args, wrt=None, f_Hp=None,
+                        curvature_args=None):
+        if wrt is None and f_Hp is None and self._optimizer_ident() == 'hf':
+            if self._carries_states():
+                raise ValueError('Hessian-free optimization cannot carry '
+                                 'states between chunks')
+            f_Hp = self._make_gauss_newton_function()
+            # A single generator for all steps, so that the sub-batches
+            # differ between steps even if the random state is a seed.
+            rng = check_random_state(self.random_state)
+            curvature_args = lambda args: self._curvature_args(args, rng)
+        return super(BaseRnn, self)._make_optimizer(
+            f, fprime, args, wrt, f_Hp, curvature_args)
+
     def _make_loss_functions(self, mode=None):
         """Return pair `f_loss, f_d_loss` of functions.
 
@@ -125,14 +236,254 @@ class BaseRnn(object):
          - f_d_loss returns the gradient of that loss wrt parameters,
            matrix of the loss.
         """
-        d_loss = self._d_loss()
+        args = list(self.data_arguments)
+        if self._carries_states():
+            # The loss has to be cloned before differentiating, otherwise
+            # the gradient would flow into the parameters the replaced
+            # initial states were computed from.
+            givens, state_inpts = self._state_givens()
+            loss = theano.clone(self.exprs['loss'], givens)
+            d_loss = T.grad(loss, self.parameters.flat)
+            args += state_inpts
+        else:
+            loss = 'loss'
+            d_loss = self._d_loss()
         if self.gradient_clip:
             d_loss = project_into_l2_ball(d_loss, self.gradient_clip)
 
-        args = list(self.data_arguments)
-        f_loss = self.function(args, 'loss', explicit_pars=True, mode=mode)
-        f_d_loss = self.function(args, d_loss, explicit_pars=True, mode=mode)
-        return f_loss, f_d_loss
+        if self._optimizer_ident() == 'hf':
+            # Hessian-free optimization asks for the gradient and then for
+            # the loss at the same point, which share a single pass. The
+            # losses of its trial steps are computed without gradients.
+            f_loss = self.function(args, loss, explicit_pars=True, mode=mode)
+            fused = FusedLossAndGrad(self._make_loss_and_grad_function(
+                args, loss, d_loss, mode=mode), f_loss)
+            return fused.f, fused.fprime
+
+        return self._compile_loss_functions(args, loss, d_loss, mode=mode)
+
+    def _carries_states(self):
+        return (getattr(self, 'bptt_steps', None) is not None
+                and self.bptt_carry == 'state')
+
+    def _state_givens(self):
+        """Return a pair ``(givens, inpts)``, where ``givens`` replaces the
+        initial recurrent states of the model by the new matrix variables
+        ``inpts``, ordered as ``breze.arch.model.sequential.rnn.state_names``.
+        """
+        givens, inpts = {}, []
+        for name in rnn.state_names(self.exprs):
+            inpt = T.matrix('carried_' + name)
+            givens[self.exprs['initial_' + name]] = inpt
+            inpts.append(inpt)
+        return givens, inpts
+
+    def _full_mask(self, X):
+        """Return a mask of ones for the sequence array ``X``."""
+        return np.ones(X.shape[:2], dtype=theano.config.floatX)
+
+    def _store_resident(self, data):
+        if self.bptt_steps is not None or self._optimizer_ident() == 'hf':
+            # Chunks and curvature batches are cut from the minibatches on the
+            # host.
+            self._resident = None
+            return
+        if self.use_mask and all(hasattr(i, 'shape') for i in data):
+            data = tuple(data) + (self._full_mask(data[0]),)
+        super(BaseRnn, self)._store_resident(data)
+
+    def _make_args(self, *data):
+        args = self._make_batch_args(*data)
+        if self.bptt_steps is None:
+            return args
+        return self._iter_chunks(args)
+
+    def _iter_chunks(self, args):
+        """Return an iterator over the argument pairs of the chunks of
+        ``.bptt_steps`` time steps of the minibatches in ``args``.
+
+        If states are carried, the states reached at the end of a chunk are
+        appended to the arguments of the next chunk of the same minibatch.
+        They are computed with the parameters at the time the next chunk is
+        requested, i.e. after the optimizer has taken its step on the
+        previous chunk."""
+        steps = self.bptt_steps
+        if not self._carries_states():
+            for batch, kwargs in args:
+                for start in range(0, batch[0].shape[0], steps):
+                    yield [i[start:start + steps] for i in batch], kwargs
+            return
+
+        # The states only depend on the inputs and the mask, not the targets.
+        inpt_names = [i for i in self.data_arguments if i != 'target']
+        inpt_idxs = [self.data_arguments.index(i) for i in inpt_names]
+        f_initial, f_final = self._make_state_functions(inpt_names)
+
+        for batch, kwargs in args:
+            n_steps = batch[0].shape[0]
+            states = list(f_initial(batch[0]))
+            for start in range(0, n_steps, steps):
+                chunk = [i[start:start + steps] for i in batch]
+                yield chunk + states, kwargs
+                if start + steps < n_steps:
+                    states = list(f_final(*([chunk[i] for i in inpt_idxs]
+                                            + states)))
+
+    def _make_state_functions(self, inpt_names, exprs=(), givens=None):
+        """Return a pair ``(f_initial, f_continue)`` of functions.
+
+         - f_initial takes an input sequence array and returns the initial
+           recurrent states for its samples,
+         - f_continue takes the data named by ``inpt_names`` followed by the
+           recurrent states to start from and returns the values of
+           ``exprs`` followed by the recurrent states reached at the end.
+
+        The states are ordered as
+        ``breze.arch.model.sequential.rnn.state_names``. ``givens`` are
+        additional substitutions for f_continue.
+        """
+        names = rnn.state_names(self.exprs)
+        if not names:
+            raise ValueError('model has no recurrent states to carry')
+        # Some initial states are shaped after the scan, which also depends
+        # on the mask; their values do not.
+        f_initial = self.function(
+            ['inpt'], ['initial_' + i for i in names],
+            givens=self._mask_givens(), on_unused_input='ignore')
+        state_givens, state_inpts = self._state_givens()
+        state_givens.update(givens or {})
+        f_continue = self.function(
+            list(inpt_names) + state_inpts,
+            list(exprs) + ['final_' + i for i in names],
+            givens=state_givens, on_unused_input='ignore')
+        return f_initial, f_continue
+
+    def _make_batch_args(self, *data):
+        if not isinstance(data[0], (list, tuple, PackedSequences)):
+            args = super(BaseRnn, self)._make_args(*data)
+            if not self.use_mask or self._resident is not None:
+                return args
+            return ((list(i) + [self._full_mask(i[0])], kwargs)
+                    for i, kwargs in args)
+
+        if self.batch_size is None:
+            raise ValueError('need a batch size for lists of sequences')
+        buckets = BucketedSequences(data, self.batch_size, self.n_buckets,
+                                    random_state=self.random_state)
+        if self.use_mask:
+            prepare = cast_arrays_to_local_type
+        else:
+            # The mask is the last item of each minibatch.
+            prepare = lambda batch: cast_arrays_to_local_type(batch[:-1])
+        batches = self._prepare_batches(iter(buckets), prepare)
+        return ((i, {}) for i in batches)
+
+    def _mask_givens(self):
+        """Return givens which replace the mask by ones, so that functions
+        of the input alone can be compiled."""
+        if not self.use_mask:
+            return {}
+        return {self.exprs['mask']: T.ones_like(self.exprs['inpt'][:, :, 0])}
+
+    def _make_eval_loss_function(self, loss_key, **kwargs):
+        # The data given to powerfit comes without a mask.
+        variables = [i for i in self.data_arguments if i != 'mask']
+        return self.function(variables, loss_key, givens=self._mask_givens(),
+                             **kwargs)
+
+    def _make_predict_functions(self):
+        """Return a function to predict targets from input sequences."""
+        return self.function(['inpt'], 'output', givens=self._mask_givens())
+
+    def _make_transform_function(self):
+        """Return a callable f which does the feature transform of this model.
+        """
+        return self.function(['inpt'], self.transform_expr_name,
+                             givens=self._mask_givens())
+
+    def predict_stream(self, X, stream_ids=None):
+        """Return the output of the network for the next time steps of
+        several streams, continuing each stream from where the last call for
+        it left off.
+
+        The recurrent states reached at the end of each stream are kept in a
+        cache under its id, so the cost of a call only depends on the number
+        of new time steps, not on the length of the history. The streams of a
+        call are processed as one minibatch. Streams which have ended should
+        be removed via ``.reset_streams``, unless ``.max_streams`` bounds
+        the cache.
+
+        Parameters
+        ----------
+
+        X : array_like
+            Array of shape ``(t, n, d)`` holding the next ``t`` time steps of
+            ``n`` streams.
+
+        stream_ids : list, optional, default: None
+            List of ``n`` distinct hashable ids of the streams. Streams not
+            seen before start from the initial states. If None, the ids are
+            ``0, ..., n - 1``.
+
+        Returns
+        -------
+
+        Y : array_like
+            Array of shape ``(t, n, k)`` holding the outputs.
+        """
+        if self.pooling is not None:
+            raise ValueError('cannot stream through a pooling network')
+        X = cast_array_to_local_type(X)
+        if stream_ids is None:
+            stream_ids = range(X.shape[1])
+        if len(stream_ids) != X.shape[1]:
+            raise ValueError('need one stream id per sample')
+        if len(set(stream_ids)) != len(stream_ids):
+            raise ValueError('stream ids are not distinct')
+
+        if self._f_stream is None:
+            self._f_stream = self._make_state_functions(
+                ['inpt'], ['output'], self._mask_givens())
+        f_initial, f_continue = self._f_stream
+
+        known = [(i, self._stream_states[k]) for i, k in enumerate(stream_ids)
+                 if k in self._stream_states]
+        if len(known) == len(stream_ids):
+            states = [np.array(i) for i in zip(*[s for _, s in known])]
+        else:
+            states = f_initial(X[:1])
+            for i, stored in known:
+                for state, row in zip(states, stored):
+                    state[i] = row
+
+        res = f_continue(X, *states)
+        for i, k in enumerate(stream_ids):
+            # Copies, so that the cache does not keep the results alive. The
+            # stream is reinserted to mark it as recently used.
+            self._stream_states.pop(k, None)
+            self._stream_states[k] = [state[i].copy() for state in res[1:]]
+        if self.max_streams is not None:
+            while len(self._stream_states) > self.max_streams:
+                self._stream_states.popitem(last=False)
+        return res[0]
+
+    def step(self, X, stream_ids=None):
+        """Return the output of the network for a single new time step of
+        several streams, see ``.predict_stream``.
+
+        ``X`` is an array of shape ``(n, d)``, the result is of shape
+        ``(n, k)``."""
+        X = np.asarray(X)
+        return self.predict_stream(X[np.newaxis], stream_ids)[0]
+
+    def reset_streams(self, stream_ids=None):
+        """Forget the states of the given streams, or of all streams if
+        ``stream_ids`` is None, so that they start over."""
+        if stream_ids is None:
+            self._stream_states.clear()
+            return
+        for i in stream_ids:
+            self._stream_states.pop(i, None)
 
 
 class SupervisedRnn(BaseRnn, rnn.SupervisedRecurrentNetwork,
@@ -151,7 +502,10 @@ class SupervisedRnn(BaseRnn, rnn.SupervisedRecurrentNetwork,
                  batch_size=None,
                  gradient_clip=False,
                  max_iter=1000,
-                 verbose=False):
+                 verbose=False,
+                 use_mask=False,
+                 bptt_steps=None,
+                 bptt_carry='state'):
         if pooling is None:
             self.sample_dim = 1, 1
         else:
@@ -159,7 +513,8 @@ class SupervisedRnn(BaseRnn, rnn.SupervisedRecurrentNetwork,
         super(SupervisedRnn, self).__init__(
             n_inpt, n_hidden, n_output, hidden_transfers, out_transfer, loss,
             pooling, leaky_coeffs,
-            optimizer, batch_size, gradient_clip, max_iter, verbose)
+            optimizer, batch_size, gradient_clip, max_iter, verbose, use_mask,
+            bptt_steps, bptt_carry)
 
 
 class UnsupervisedRnn(BaseRnn, rnn.UnsupervisedRecurrentNetwork,
@@ -187,13 +542,17 @@ class UnsupervisedRnn(BaseRnn, rnn.UnsupervisedRecurrentNetwork,
             _n_ is the number of data samples and _d_ is the dimensionality of
             a data sample at a single time step.
         """
+        self._store_resident((X,))
         f_loss, f_d_loss = self._make_loss_functions()
 
         args = self._make_args(X)
         opt = self._make_optimizer(f_loss, f_d_loss, args)
 
-        for i, info in enumerate(opt):
-            yield info
+        try:
+            for i, info in enumerate(opt):
+                yield info
+        finally:
+            self._release_resident()
 
 
 class SupervisedLstm(BaseRnn, rnn.SupervisedLstmRecurrentNetwork,
@@ -205,6 +564,28 @@ class SupervisedLstm(BaseRnn, rnn.SupervisedLstmRecurrentNetwork,
     sklearn like methods.
     """
 
+    def __init__(self, n_inpt, n_hidden, n_output,
+                 hidden_transfer='tanh', out_transfer='identity',
+                 loss='squared', pooling=None,
+                 leaky_coeffs=None,
+                 optimizer='rprop',
+                 batch_size=None,
+                 gradient_clip=False,
+                 max_iter=1000,
+                 verbose=False,
+                 use_mask=False,
+                 bptt_steps=None,
+                 bptt_carry='state'):
+        if pooling is None:
+            self.sample_dim = 1, 1
+        else:
+            self.sample_dim = 1, 0
+        super(SupervisedLstm, self).__init__(
+            n_inpt, n_hidden, n_output, hidden_transfer, out_transfer, loss,
+            pooling, leaky_coeffs,
+            optimizer, batch_size, gradient_clip, max_iter, verbose, use_mask,
+            bptt_steps, bptt_carry)
+
 
 class UnsupervisedLstm(BaseRnn, rnn.UnsupervisedLstmRecurrentNetwork,
                        UnsupervisedBrezeWrapperBase,
@@ -215,7 +596,9 @@ class UnsupervisedLstm(BaseRnn, rnn.UnsupervisedLstmRecurrentNetwork,
     The class inherits from breze's RecurrentNetwork class and adds several
     sklearn like methods.
     """
+
     transform_expr_name = 'output'
+    sample_dim = 1,
 
 
 class SupervisedFastDropoutRnn(BaseRnn, varprop_rnn.FastDropoutRnn,
@@ -235,7 +618,8 @@ class SupervisedFastDropoutRnn(BaseRnn, varprop_rnn.FastDropoutRnn,
                  use_varprop_at=None,
                  hotk_inpt=False,
                  max_iter=1000,
-                 verbose=False):
+                 verbose=False,
+                 use_mask=False):
         # TODO: this is code duplication from breze/arch/model/varprop/rnn.py
         # Should be done more elegantly.
         if p_dropout_hidden_to_out is None:
@@ -252,4 +636,4 @@ class SupervisedFastDropoutRnn(BaseRnn, varprop_rnn.FastDropoutRnn,
         super(SupervisedFastDropoutRnn, self).__init__(
             n_inpt, n_hidden, n_output, hidden_transfer, out_transfer,
             loss, pooling, leaky_coeffs,
-            optimizer, batch_size, gradient_clip, max_iter, verbose)
+            optimizer, batch_size, gradient_clip, max_iter, verbose, use_mask)
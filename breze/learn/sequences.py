@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+
+"""Module for transforming many sequences of different lengths at once.
+
+Instead of lists of arrays, the functions of this module work on sequences in
+packed form: a single array ``data`` holding all sequences one after the other
+along its first axis, and an integer array ``offsets`` of length ``n + 1``
+such that sequence ``i`` is ``data[offsets[i]:offsets[i + 1]]``.
+
+Unless noted otherwise, the functions work in a constant number of vectorized
+passes over the data, independent of the number of sequences, and preserve the
+dtype of the data.
+"""
+
+
+import numpy as np
+import scipy.interpolate
+
+
+def pack(seqs):
+    """Return a pair ``(data, offsets)`` holding the sequences of the list
+    ``seqs`` in packed form."""
+    lengths = np.array([len(i) for i in seqs], dtype='int64')
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype('int64')
+    if len(seqs) == 0:
+        return np.empty((0,)), offsets
+    return np.concatenate(seqs), offsets
+
+
+def unpack(data, offsets):
+    """Return a list of views on ``data``, one for each packed sequence."""
+    return np.split(data, offsets[1:-1])[:len(offsets) - 1]
+
+
+def lengths(offsets):
+    """Return the lengths of the packed sequences."""
+    return np.diff(offsets)
+
+
+def segment_ids(offsets):
+    """Return an array giving for each row of the packed data the index of
+    the sequence it belongs to."""
+    return np.repeat(np.arange(len(offsets) - 1), lengths(offsets))
+
+
+def positions(offsets):
+    """Return an array giving for each row of the packed data its time step
+    within its sequence."""
+    return np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths(offsets))
+
+
+def pad(data, offsets, length=None, front=True, time_major=False):
+    """Return an array holding the packed sequences padded with zeros to
+    ``length`` time steps.
+
+    Parameters
+    ----------
+
+    data, offsets : array_like
+        Packed sequences.
+
+    length : integer, optional, default: None
+        Length to pad to; the length of the longest sequence if None. Longer
+        sequences are not allowed.
+
+    front : boolean, optional, default: True
+        If True, the zeros are put in front of the sequences, otherwise
+        after them.
+
+    time_major : boolean, optional, default: False
+        If True, the result has shape ``(length, n, ...)``, otherwise
+        ``(n, length, ...)``.
+    """
+    lens = lengths(offsets)
+    n = len(lens)
+    if length is None:
+        length = lens.max() if n else 0
+    elif n and lens.max() > length:
+        raise ValueError('sequences longer than %i' % length)
+
+    ids = segment_ids(offsets)
+    steps = positions(offsets)
+    if front:
+        steps = steps + (length - lens)[ids]
+
+    if time_major:
+        res = np.zeros((length, n) + data.shape[1:], dtype=data.dtype)
+        res[steps, ids] = data
+    else:
+        res = np.zeros((n, length) + data.shape[1:], dtype=data.dtype)
+        res[ids, steps] = data
+    return res
+
+
+def mask(offsets, length=None, front=True, time_major=False, dtype='float64'):
+    """Return an array of shape ``(n, length)`` (or ``(length, n)`` if
+    ``time_major`` is True) which is 1 where ``pad`` puts the sequences and
+    0 where it puts the padding."""
+    lens = lengths(offsets)
+    if length is None:
+        length = lens.max() if len(lens) else 0
+    steps = np.arange(length)[np.newaxis]
+    if front:
+        res = steps >= (length - lens)[:, np.newaxis]
+    else:
+        res = steps < lens[:, np.newaxis]
+    if time_major:
+        res = res.T
+    return res.astype(dtype)
+
+
+def interpolate(data, offsets, n_intermediates, kind='linear'):
+    """Return the packed sequences resampled to ``n_intermediates`` times
+    their length.
+
+    A sequence of length ``l`` is evaluated at ``l * n_intermediates`` evenly
+    spaced points from its first to its last time step. Integer data is
+    converted to floats.
+
+    Linear interpolation is done for all sequences at once; any other
+    ``kind`` understood by ``scipy.interpolate.interp1d`` is done sequence by
+    sequence."""
+    dtype = data.dtype if data.dtype.kind == 'f' else np.dtype('float64')
+    lens = lengths(offsets)
+    new_lens = lens * n_intermediates
+    new_offsets = np.concatenate([[0], np.cumsum(new_lens)]).astype('int64')
+
+    if kind != 'linear':
+        res = np.empty((new_offsets[-1],) + data.shape[1:], dtype=dtype)
+        for i, l in enumerate(lens):
+            seq = data[offsets[i]:offsets[i + 1]]
+            if l < 2:
+                res[new_offsets[i]:new_offsets[i + 1]] = seq
+                continue
+            fine = np.linspace(0, l - 1, l * n_intermediates)
+            f = scipy.interpolate.interp1d(np.arange(l), seq, kind=kind,
+                                           axis=0)
+            res[new_offsets[i]:new_offsets[i + 1]] = f(fine)
+        return res, new_offsets
+
+    ids = segment_ids(new_offsets)
+    steps = positions(new_offsets)
+    # Position of each new time step on the grid of its original sequence.
+    scale = ((lens - 1.) / np.maximum(new_lens - 1, 1))[ids]
+    pos = steps * scale
+    lower = np.minimum(np.floor(pos).astype('int64'), (lens - 1)[ids])
+    upper = np.minimum(lower + 1, (lens - 1)[ids])
+    frac = (pos - lower).reshape((-1,) + (1,) * (data.ndim - 1))
+
+    base = offsets[:-1][ids]
+    res = data[base + lower] * (1 - frac) + data[base + upper] * frac
+    return res.astype(dtype), new_offsets
+
+
+def collapse(data, offsets, n):
+    """Return the packed sequences with ``n`` consecutive time steps
+    concatenated into one.
+
+    Time steps are cut off at the end of each sequence to ensure
+    divisibility by ``n``."""
+    lens = lengths(offsets)
+    keep = lens // n * n
+    rows = positions(offsets) < keep[segment_ids(offsets)]
+    kept = data if rows.all() else data[rows]
+    new_offsets = np.concatenate([[0], np.cumsum(keep // n)]).astype('int64')
+    return kept.reshape((-1, data.shape[1] * n)), new_offsets
+
+
+def uncollapse(data, offsets, n):
+    """Return the packed sequences with each time step divided into ``n``
+    consecutive time steps."""
+    return data.reshape((-1, data.shape[1] // n)), offsets * n
+
+
+def split(data, offsets, maxlength):
+    """Return the offsets of the packed sequences cut into pieces of at most
+    ``maxlength`` time steps each. The data stays the same."""
+    lens = lengths(offsets)
+    n_pieces = -(-lens // maxlength)
+    piece_offsets = np.concatenate([[0], np.cumsum(n_pieces)])
+    piece_ids = np.repeat(np.arange(len(lens)), n_pieces)
+    starts = (offsets[:-1][piece_ids]
+              + (np.arange(piece_offsets[-1]) - piece_offsets[:-1][piece_ids])
+              * maxlength)
+    return np.concatenate([starts, offsets[-1:]]).astype('int64')
+
+
+def diff(data, offsets):
+    """Return the packed differences of consecutive time steps of each
+    sequence, together with their offsets.
+
+    Each sequence loses one time step; empty sequences stay empty."""
+    keep = positions(offsets)[1:] > 0
+    res = (data[1:] - data[:-1])[keep]
+    new_lens = np.maximum(lengths(offsets) - 1, 0)
+    return res, np.concatenate([[0], np.cumsum(new_lens)]).astype('int64')
+
+
+def window_starts(offsets, size, offset=1):
+    """Return the rows of the packed data at which the windows of ``size``
+    time steps start, with ``offset`` time steps between two windows of a
+    sequence. Windows do not cross sequence borders."""
+    n = np.maximum(-(-(lengths(offsets) - size + 1) // offset), 0)
+    ids = np.repeat(np.arange(len(n)), n)
+    first = np.concatenate([[0], np.cumsum(n)])[:-1]
+    return offsets[:-1][ids] + (np.arange(n.sum()) - first[ids]) * offset
+
+
+class PackedSequences(object):
+    """PackedSequences class.
+
+    Container of sequences of different lengths in packed form, i.e. one
+    contiguous array ``data`` and an array of ``offsets`` (see the module
+    documentation). It can be used instead of a list of arrays with the
+    sequence utilities of ``breze.learn.data`` and the recurrent networks of
+    ``breze.learn.rnn``.
+
+    Indexing with an integer gives a view on a single sequence, indexing with
+    a slice or an array of indices a PackedSequences. Iterating gives views
+    on the sequences.
+
+    Parameters
+    ----------
+
+    data : array_like
+        Array holding the time steps of all sequences along its first axis.
+
+    offsets : array_like
+        Integer array of length ``n + 1``, starting with 0 and ending with
+        ``len(data)``.
+    """
+
+    def __init__(self, data, offsets):
+        offsets = np.asarray(offsets, dtype='int64')
+        if (offsets.ndim != 1 or len(offsets) == 0 or offsets[0] != 0
+                or offsets[-1] != len(data) or (np.diff(offsets) < 0).any()):
+            raise ValueError('offsets do not describe sequences of data')
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_list(cls, seqs):
+        """Return a PackedSequences holding a copy of the list of arrays
+        ``seqs``."""
+        return cls(*pack(seqs))
+
+    @classmethod
+    def cast(cls, X):
+        """Return ``X`` if it is a PackedSequences, otherwise a packed copy of
+        the list of arrays ``X``."""
+        return X if isinstance(X, cls) else cls.from_list(X)
+
+    @property
+    def lengths(self):
+        return lengths(self.offsets)
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, long, np.integer)):
+            if key < 0:
+                key += len(self)
+            return self.data[self.offsets[key]:self.offsets[key + 1]]
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                stop = max(start, stop)
+                offsets = self.offsets[start:stop + 1]
+                return PackedSequences(
+                    self.data[offsets[0]:offsets[-1]], offsets - offsets[0])
+            key = np.arange(start, stop, step)
+        return self.take(key)
+
+    def take(self, indices):
+        """Return a PackedSequences with a copy of the sequences given by
+        ``indices``, in that order."""
+        indices = np.asarray(indices, dtype='int64')
+        lens = self.lengths[indices]
+        offsets = np.concatenate([[0], np.cumsum(lens)]).astype('int64')
+        ids = np.repeat(np.arange(len(indices)), lens)
+        rows = self.offsets[:-1][indices][ids] + positions(offsets)
+        return PackedSequences(self.data[rows], offsets)
+
+    def to_list(self):
+        """Return a list of views on the sequences."""
+        return unpack(self.data, self.offsets)
+
+    def split(self, maxlength):
+        """Return the sequences cut into pieces of at most ``maxlength`` time
+        steps, sharing the data."""
+        return PackedSequences(self.data,
+                               split(self.data, self.offsets, maxlength))
+
+    def collapse(self, n):
+        """Return the sequences with ``n`` consecutive time steps concatenated,
+        see ``collapse``."""
+        return PackedSequences(*collapse(self.data, self.offsets, n))
+
+    def uncollapse(self, n):
+        """Return the sequences with each time step divided into ``n``, see
+        ``uncollapse``."""
+        return PackedSequences(*uncollapse(self.data, self.offsets, n))
+
+    def diff(self):
+        """Return the differences of consecutive time steps of each sequence,
+        see ``diff``."""
+        return PackedSequences(*diff(self.data, self.offsets))
+
+    def interpolate(self, n_intermediates, kind='linear'):
+        """Return the resampled sequences, see ``interpolate``."""
+        return PackedSequences(*interpolate(self.data, self.offsets,
+                                            n_intermediates, kind))
+
+    def windows(self, size, offset=1):
+        """Return an array of shape ``(n_windows, size, ...)`` holding all
+        windows of ``size`` time steps, ``offset`` apart, of all sequences."""
+        starts = window_starts(self.offsets, size, offset)
+        rows = starts[:, np.newaxis] + np.arange(size)
+        return self.data[rows]
+
+    def pad(self, length=None, front=True, time_major=False):
+        """Return the sequences padded with zeros to a single array, see
+        ``pad``."""
+        return pad(self.data, self.offsets, length, front, time_major)
+
+    def mask(self, length=None, front=True, time_major=False):
+        """Return the mask aligned with ``.pad``, see ``mask``."""
+        return mask(self.offsets, length, front, time_major, self.data.dtype)
@@ -11,6 +11,8 @@ is hosted at
 import numpy as np
 import scipy.linalg
 
+from breze.learn.sequences import PackedSequences
+
 
 class SlowFeatureAnalysis(object):
     """Class for performing Slow feature analysis.
@@ -47,6 +49,8 @@ class SlowFeatureAnalysis(object):
             array of shape `(*, d)` where `*` is the number of
             data points and may vary from item to item in the list.
             `d` is the input dimensionality and has to be consistent.
+            A ``breze.learn.sequences.PackedSequences`` is accepted as
+            well.
 
         Returns
         -------
@@ -56,8 +60,9 @@ class SlowFeatureAnalysis(object):
             corresponds to the sequence in ``X``. It is of the same shape,
             except that ``d`` is replaced by ``n_components``.
         """
-        n_components = X.shape[1] if self.n_components is None else self.n_components
-        diff = np.vstack([i[1:] - i[:-1] for i in X])
+        X = PackedSequences.cast(X)
+        n_components = X.data.shape[1] if self.n_components is None else self.n_components
+        diff = X.diff().data
         cov = scipy.cov(diff, rowvar=0)
         u, _, _ = scipy.linalg.svd(cov, full_matrices=False)
         u = u[:, -n_components:][:, ::-1]
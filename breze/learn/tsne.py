@@ -6,15 +6,28 @@ of tSNE favors solutions which represent the data locally.
 
 For details, see Laurens van der Maaten's page on tSNE at
 http://homepage.tudelft.nl/19j49/t-SNE.html.
+
+Besides the exact method, which needs time and memory quadratic in the number
+of points, an approximation based on the Barnes-Hut algorithm is available
+[1]_. It uses sparse neighbour probabilities for the attractive forces and
+a space partitioning tree (a quadtree in 2D, an octree in 3D) for the
+repulsive forces, taking time ``O(n log n)`` per iteration.
+
+References
+----------
+.. [1] L.J.P. van der Maaten. Accelerating t-SNE using Tree-Based Algorithms.
+   Journal of Machine Learning Research 15(Oct):3221-3245, 2014.
 """
 
 import itertools
 
 import numpy as np
+import scipy.sparse
+import scipy.spatial
 import theano
 import theano.tensor as T
 
-from breze.arch.component.misc import distance_matrix
+from breze.arch.component.misc import distance_matrix, numpy_distance_matrix
 from climin.base import Minimizer
 
 
@@ -65,20 +78,105 @@ def euc_dist(X, Y, squared=True):
     ----------
     .. [1] http://blog.smola.org/post/969195661/in-praise-of-the-second-binomial-formula
     """
-    if X is Y:
-        Xsq = (X ** 2).sum(axis=1)
-        Ysq = Xsq[np.newaxis, :]
-        Xsq = Xsq[:, np.newaxis]
-    else:
-        Xsq = (X ** 2).sum(axis=1)[:, np.newaxis]
-        Ysq = (Y ** 2).sum(axis=1)[np.newaxis, :]
-    distances = Xsq + Ysq - 2 * np.dot(X, Y.T)
+    distances = numpy_distance_matrix(X, None if X is Y else Y, 'l2')
     if squared:
         return distances
     else:
         return np.sqrt(distances)
 
 
+def conditional_probabilities(dists, precisions):
+    """Return the probabilities of the Gaussian neighbourhoods of points.
+
+    The smallest finite distance of each row is subtracted before
+    exponentiating, which leaves the probabilities unchanged but keeps the
+    largest term of each row at one, so that no row underflows to zero.
+
+    Parameters
+    ----------
+
+    dists : array_like
+        2D array of shape ``(n, k)`` of squared distances as given to
+        ``bisect_precisions``.
+
+    precisions : array_like
+        1D array of shape ``(n,)``.
+
+    Returns
+    -------
+
+    p_cond : array_like
+        2D array of shape ``(n, k)`` whose rows sum up to one.
+    """
+    finite = np.isfinite(dists)
+    offsets = np.where(finite, dists, np.inf).min(axis=1)
+    offsets[~np.isfinite(offsets)] = 0
+    top = np.exp(-(dists - offsets[:, np.newaxis])
+                 * precisions[:, np.newaxis])
+    return top / np.maximum(top.sum(axis=1), 1E-12)[:, np.newaxis]
+
+
+def bisect_precisions(dists, target_pplx, n_iter=50, tol=1e-5):
+    """Return the precisions of the Gaussian neighbourhoods of points, found
+    by bisection such that their perplexities match ``target_pplx``.
+
+    All points are searched for at once.
+
+    Parameters
+    ----------
+
+    dists : array_like
+        2D array of shape ``(n, k)``, where row ``i`` holds the squared
+        distances of point ``i`` to its ``k`` candidate neighbours. Entries
+        of ``np.inf`` are ignored.
+
+    target_pplx : float
+        Desired perplexity.
+
+    n_iter : integer, optional [default: 50]
+        Number of bisection rounds.
+
+    tol : float, optional [default: 1e-5]
+        Tolerance on the entropy; rows within it are not changed anymore.
+
+    Returns
+    -------
+
+    precisions : array_like
+        1D array of shape ``(n,)``.
+    """
+    n = dists.shape[0]
+    precisions = np.ones(n)
+    lower = np.zeros(n)
+    upper = np.empty(n)
+    upper[...] = np.inf
+    target_entropy = np.log(target_pplx)
+
+    for i in range(n_iter):
+        p_cond = conditional_probabilities(dists, precisions)
+        # If we don't add a small term, the logarithm will make NaNs.
+        p_cond = np.maximum(1E-12, p_cond)
+        entropy = -(p_cond * np.log(p_cond)).sum(axis=1)
+
+        diff = entropy - target_entropy
+        if (abs(diff) < tol).all():
+            break
+        # Too high entropy means too wide neighbourhoods. Non finite
+        # entropies are taken as too narrow ones.
+        finite = np.isfinite(diff)
+        wider = finite & (diff > tol)
+        narrower = ~finite | (diff < -tol)
+        lower[wider] = precisions[wider]
+        upper[narrower] = precisions[narrower]
+        precisions = np.where(
+            wider,
+            np.where(np.isinf(upper), precisions * 2,
+                     (precisions + upper) / 2),
+            np.where(narrower, (precisions + lower) / 2, precisions))
+
+    return precisions
+
+
 def neighbour_probabilities(X, target_pplx):
     """Return a square matrix containing probabilities that points given by `X`
     in the data are neighbours.
@@ -101,53 +199,14 @@ def neighbour_probabilities(X, target_pplx):
     """
     N = X.shape[0]
 
-    # Calculate the distances.
+    # Calculate the distances, excluding each point from its neighbours.
     dists = euc_dist(X, X)
+    dists[range(N), range(N)] = np.inf
 
-    # Parametrize in the log domain for positive standard deviations.
-    precisions = np.ones(X.shape[0]).astype(theano.config.floatX)
-
-    # Do a binary search for good logstds leading to the desired perplexities.
-    minimums = np.empty(X.shape[0]).astype(theano.config.floatX)
-    minimums[...] = -np.inf
-    maximums = np.empty(X.shape[0]).astype(theano.config.floatX)
-    maximums[...] = np.inf
-
-    target_entropy = np.log(target_pplx)
-    for i in range(50):
-        # Calculate perplexities.
-        inpt_top = np.exp(-dists * precisions)
-        inpt_top[range(N), range(N)] = 0
-        inpt_bottom = inpt_top.sum(axis=0)
-
-        p_inpt_nb_cond = inpt_top / inpt_bottom
-        # If we don't add a small term, the logarithm will make NaNs.
-        p_inpt_nb_cond = np.maximum(1E-12, p_inpt_nb_cond)
-        entropy = -(p_inpt_nb_cond * np.log(p_inpt_nb_cond)).sum(axis=0)
-
-        diff = entropy - target_entropy
-        for j in range(N):
-            if abs(diff[j]) < 1e-5:
-                continue
-            elif diff[j] > 0:
-                if maximums[j] == -np.inf or maximums[j] == np.inf:
-                    precisions[j] *= 2
-                else:
-                    precisions[j] = (precisions[j] + maximums[j]) / 2
-                minimums[j] = precisions[j]
-            else:
-                if minimums[j] == -np.inf or minimums[j] == np.inf:
-                    precisions[j] /= 2
-                else:
-                    precisions[j] = (precisions[j] + minimums[j]) / 2
-                maximums[j] = precisions[j]
+    precisions = bisect_precisions(dists, target_pplx)
 
     # Calculcate p matrix once more and return it.
-    inpt_top = np.exp(-dists * precisions)
-    inpt_top[range(N), range(N)] = 0
-    inpt_bottom = inpt_top.sum(axis=0)
-    # Add a small constant to the denominator against numerical issues.
-    p_inpt_nb_cond = inpt_top / (inpt_bottom + 1e-4)
+    p_inpt_nb_cond = conditional_probabilities(dists, precisions)
 
     # Symmetrize.
     p_ji = (p_inpt_nb_cond + p_inpt_nb_cond.T)
@@ -157,7 +216,126 @@ def neighbour_probabilities(X, target_pplx):
     p_ji /= p_ji.sum()
     p_ji = np.maximum(1E-12, p_ji)
 
-    return p_ji
+    return p_ji.astype(theano.config.floatX)
+
+
+def nearest_neighbours(X, n_neighbours, chunk_size=1024, reference=None):
+    """Return a pair ``(dists, indices)`` of the ``n_neighbours`` nearest
+    neighbours of each point in ``X``, excluding the point itself, or of
+    each point in ``X`` among the points in ``reference``, if given.
+
+    A KD-tree is used for up to 16 dimensions; above, the search is exact and
+    brute force over chunks of ``chunk_size`` points, taking memory
+    ``O(chunk_size * n)``.
+
+    Parameters
+    ----------
+
+    X : array_like
+        2D array of shape ``(n, d)``.
+
+    n_neighbours : integer
+        Number of neighbours; has to be smaller than ``n``.
+
+    chunk_size : integer, optional [default: 1024]
+        Number of points searched for at once by the brute force search.
+
+    reference : array_like, optional [default: None]
+        2D array of shape ``(m, d)`` holding the points to search; ``X`` if
+        None.
+
+    Returns
+    -------
+
+    dists : array_like
+        2D array of shape ``(n, n_neighbours)`` holding squared Euclidean
+        distances.
+
+    indices : array_like
+        2D integer array of shape ``(n, n_neighbours)``.
+    """
+    X = np.asarray(X, dtype='float64')
+    n, d = X.shape
+    k = n_neighbours
+    if reference is not None:
+        reference = np.asarray(reference, dtype='float64')
+        if not 0 < k <= reference.shape[0]:
+            raise ValueError('need between 1 and %i neighbours'
+                             % reference.shape[0])
+    elif not 0 < k < n:
+        raise ValueError('need between 1 and %i neighbours' % (n - 1))
+
+    if d <= 16:
+        if reference is not None:
+            dists, indices = scipy.spatial.cKDTree(reference).query(X, k)
+            dists, indices = dists.reshape((n, k)), indices.reshape((n, k))
+            return dists ** 2, indices
+        dists, indices = scipy.spatial.cKDTree(X).query(X, k + 1)
+        dists **= 2
+        # Remove the point itself, which need not come first if there are
+        # duplicates, or else the farthest neighbour.
+        is_self = indices == np.arange(n)[:, np.newaxis]
+        is_self[~is_self.any(axis=1), -1] = True
+        return (dists[~is_self].reshape((n, k)),
+                indices[~is_self].reshape((n, k)))
+
+    dists = np.empty((n, k))
+    indices = np.empty((n, k), dtype='int64')
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        rows = np.arange(stop - start)
+        if reference is not None:
+            chunk = euc_dist(X[start:stop], reference)
+        else:
+            chunk = euc_dist(X[start:stop], X)
+            chunk[rows, rows + start] = np.inf
+        idx = np.argpartition(chunk, k - 1, axis=1)[:, :k]
+        dists[start:stop] = np.maximum(chunk[rows[:, np.newaxis], idx], 0)
+        indices[start:stop] = idx
+    return dists, indices
+
+
+def sparse_neighbour_probabilities(X, target_pplx, n_neighbours=None):
+    """Return a sparse matrix containing probabilities that points given by
+    `X` in the data are neighbours.
+
+    Only the nearest neighbours of each point are considered, so time and
+    memory are ``O(n * n_neighbours)`` apart from the neighbour search.
+
+    Parameters
+    ----------
+
+    X : array_like
+        2D array containing data points in rows of shape ``(n, d)``.
+
+    target_pplx : float
+        Desired perplexity.
+
+    n_neighbours : integer, optional [default: None]
+        Number of neighbours per point; ``3 * target_pplx`` if None.
+
+    Returns
+    -------
+
+    P : scipy.sparse.csr_matrix
+        Sparse matrix of shape ``(n, n)``, which is symmetric and sums up to
+        one.
+    """
+    n = X.shape[0]
+    if n_neighbours is None:
+        n_neighbours = int(3 * target_pplx)
+    k = min(n_neighbours, n - 1)
+
+    dists, indices = nearest_neighbours(X, k)
+    precisions = bisect_precisions(dists, target_pplx)
+    p_cond = conditional_probabilities(dists, precisions)
+
+    rows = np.repeat(np.arange(n), k)
+    res = scipy.sparse.csr_matrix(
+        (p_cond.ravel(), (rows, indices.ravel())), shape=(n, n))
+    res = res + res.T
+    res.data /= res.data.sum()
+    return res
 
 
 def build_loss(embeddings):
@@ -187,17 +365,265 @@ def build_loss(embeddings):
     return loss, p_ji_var
 
 
+def sparsify_probabilities(p, n_neighbours):
+    """Return a sparse version of the dense neighbour probabilities ``p``,
+    keeping the ``n_neighbours`` largest entries of each row.
+
+    The result is symmetrized and normalized to sum up to one again.
+
+    Parameters
+    ----------
+
+    p : array_like
+        2D array of shape ``(n, n)``, as returned by
+        ``neighbour_probabilities``.
+
+    n_neighbours : integer
+        Number of entries to keep per row.
+
+    Returns
+    -------
+
+    P : scipy.sparse.csr_matrix
+        Sparse matrix of shape ``(n, n)``.
+    """
+    n = p.shape[0]
+    k = min(n_neighbours, n - 1)
+    p = np.array(p)
+    p[range(n), range(n)] = -np.inf
+    cols = np.argpartition(-p, k - 1, axis=1)[:, :k]
+    rows = np.repeat(np.arange(n), k)
+    cols = cols.ravel()
+    res = scipy.sparse.csr_matrix((p[rows, cols], (rows, cols)), shape=(n, n))
+    res = res + res.T
+    res.data /= res.data.sum()
+    return res
+
+
+class SpaceTree(object):
+    """SpaceTree class.
+
+    Space partitioning tree over a set of points, i.e. a quadtree for 2D
+    points, an octree for 3D points and so on. The root cell is the bounding
+    box of the points, and each cell is split into ``2 ** d`` equally sized
+    children until it holds a single point or the maximum depth is reached.
+
+    The tree is built level by level from the Morton codes of the points, so
+    that it is stored in flat arrays and built and traversed without a
+    Python loop over points or cells.
+
+    Parameters
+    ----------
+
+    points : array_like
+        2D array of shape ``(n, d)``.
+
+    max_depth : integer, optional, default: 20
+        Maximum depth of the tree. It is reduced such that the Morton codes
+        fit into 62 bits.
+
+
+    Attributes
+    ----------
+
+    levels : list of dictionaries
+        One dictionary per depth, holding arrays for the cells at that depth:
+        ``counts`` (number of points), ``centers`` (centers of mass),
+        ``leaf`` (whether the cell is not split further), ``children``
+        (start and stop of the range of the children in the next level)
+        and ``cell_of_point`` (the cell of each point).
+
+    width : float
+        Side length of the root cell.
+
+    order : array_like
+        Indices of the points sorted by their Morton codes.
+    """
+
+    def __init__(self, points, max_depth=20):
+        n, d = points.shape
+        max_depth = max(min(max_depth, 62 // d), 1)
+        points = np.asarray(points, dtype='float64')
+
+        lower = points.min(axis=0)
+        width = (points.max(axis=0) - lower).max()
+        self.width = width * (1 + 1e-6) if width > 0 else 1.
+        grid = ((points - lower) / self.width * 2 ** max_depth).astype('int64')
+        grid = np.clip(grid, 0, 2 ** max_depth - 1)
+
+        # Interleave the bits of the grid coordinates.
+        codes = np.zeros(n, dtype='int64')
+        for bit in range(max_depth):
+            for dim in range(d):
+                codes |= ((grid[:, dim] >> bit) & 1) << (bit * d + dim)
+
+        order = self.order = np.argsort(codes, kind='mergesort')
+        codes = codes[order]
+        sorted_points = points[order]
+
+        self.levels = []
+        for depth in range(max_depth + 1):
+            cell_codes = codes >> (d * (max_depth - depth))
+            is_start = np.ones(n, dtype=bool)
+            is_start[1:] = cell_codes[1:] != cell_codes[:-1]
+            starts = np.flatnonzero(is_start)
+            counts = np.diff(np.append(starts, n))
+            cell_of_point = np.empty(n, dtype='int64')
+            cell_of_point[order] = np.cumsum(is_start) - 1
+
+            level = {
+                'codes': cell_codes[starts],
+                'counts': counts,
+                'centers': (np.add.reduceat(sorted_points, starts)
+                            / counts[:, np.newaxis]),
+                'leaf': (counts == 1) | (depth == max_depth),
+                'cell_of_point': cell_of_point,
+            }
+            if self.levels:
+                parent = self.levels[-1]
+                parent_codes = level['codes'] >> d
+                parent['children'] = (
+                    np.searchsorted(parent_codes, parent['codes'], 'left'),
+                    np.searchsorted(parent_codes, parent['codes'], 'right'))
+            self.levels.append(level)
+            if level['leaf'].all():
+                break
+
+    def repulsion(self, points, theta=0.5, chunk_size=4096, members=True):
+        """Return a pair ``(z, force)`` of the approximate t-SNE repulsion of
+        the points the tree was built from, or of other ``points`` by the
+        points of the tree if ``members`` is False.
+
+        ``z[i]`` approximates ``sum_j 1 / (1 + |y_i - y_j|^2)`` and
+        ``force[i]`` approximates ``sum_j (y_i - y_j) / (1 + |y_i - y_j|^2)^2``
+        over all ``j != i``. A cell is summarized by its center of mass if
+        it does not hold ``y_i`` and its width divided by its distance to
+        ``y_i`` is below ``theta``; ``theta=0`` gives the exact result. For
+        non-members, a cell is never known to hold ``y_i``, which is
+        harmless for ``theta`` below ``1 / sqrt(d)``.
+        """
+        n, d = points.shape
+        points = np.asarray(points, dtype='float64')
+        z = np.zeros(n)
+        force = np.zeros((n, d))
+        theta2 = theta ** 2
+
+        # Chunks of points which are close in space visit the same cells.
+        for start in range(0, n, chunk_size):
+            if members:
+                idx = self.order[start:start + chunk_size]
+            else:
+                idx = np.arange(start, min(start + chunk_size, n))
+            m = len(idx)
+            chunk_points = points[idx]
+            z_chunk = np.zeros(m)
+            force_chunk = np.zeros((m, d))
+            query = np.arange(m)
+            cell = np.zeros(m, dtype='int64')
+
+            for depth, level in enumerate(self.levels):
+                diff = chunk_points[query] - level['centers'][cell]
+                dist2 = (diff ** 2).sum(axis=1)
+                if members:
+                    contains = level['cell_of_point'][idx[query]] == cell
+                else:
+                    contains = np.zeros(len(query), dtype=bool)
+                cell_width2 = (self.width / 2 ** depth) ** 2
+                accept = level['leaf'][cell] | (
+                    ~contains & (cell_width2 < theta2 * dist2))
+
+                q = 1 / (1 + dist2[accept])
+                counts = level['counts'][cell[accept]] - contains[accept]
+                z_chunk += np.bincount(query[accept], counts * q, minlength=m)
+                weights = counts * q ** 2
+                for dim in range(d):
+                    force_chunk[:, dim] += np.bincount(
+                        query[accept], weights * diff[accept, dim],
+                        minlength=m)
+
+                # Descend into the children of the remaining cells.
+                query, cell = query[~accept], cell[~accept]
+                if not len(query):
+                    break
+                child_start = level['children'][0][cell]
+                n_children = level['children'][1][cell] - child_start
+                first = np.cumsum(n_children) - n_children
+                query = np.repeat(query, n_children)
+                cell = (np.repeat(child_start - first, n_children)
+                        + np.arange(n_children.sum()))
+
+            z[idx] = z_chunk
+            force[idx] = force_chunk
+
+        return z, force
+
+
+def barnes_hut_loss_and_gradient(embeddings, p, theta=0.5):
+    """Return a pair ``(loss, gradient)`` of the t-SNE loss of ``embeddings``
+    and its gradient, approximated with the Barnes-Hut algorithm.
+
+    Parameters
+    ----------
+
+    embeddings : array_like
+        2D array of shape ``(n, d)``.
+
+    p : scipy.sparse matrix
+        Sparse matrix of shape ``(n, n)`` holding the neighbour
+        probabilities.
+
+    theta : float, optional, default: 0.5
+        Accuracy of the approximation of the repulsive forces, see
+        ``SpaceTree.repulsion``. Smaller is more accurate and slower.
+
+    Returns
+    -------
+
+    loss : float
+        Kullback-Leibler divergence between ``p`` and the neighbour
+        probabilities in the embedding.
+
+    gradient : array_like
+        2D array of shape ``(n, d)``.
+    """
+    embeddings = np.asarray(embeddings, dtype='float64')
+    n, d = embeddings.shape
+    p = p.tocoo()
+    rows, cols, p_vals = p.row, p.col, p.data.astype('float64')
+
+    # Attractive forces only act between neighbours.
+    diff = embeddings[rows] - embeddings[cols]
+    q = 1 / (1 + (diff ** 2).sum(axis=1))
+    attraction = np.empty((n, d))
+    for dim in range(d):
+        attraction[:, dim] = np.bincount(rows, p_vals * q * diff[:, dim],
+                                         minlength=n)
+
+    z, repulsion = SpaceTree(embeddings).repulsion(embeddings, theta)
+    z_total = z.sum()
+
+    gradient = 4 * (attraction - repulsion / z_total)
+    p_floored = np.maximum(p_vals, 1E-12)
+    loss = ((p_vals * np.log(p_floored)).sum() - (p_vals * np.log(q)).sum()
+            + p_vals.sum() * np.log(z_total))
+    return loss, gradient
+
+
 class TsneMinimizer(Minimizer):
-    """Custom Minimizer for TSNE using a learning rate schedule."""
+    """Custom Minimizer for TSNE using a learning rate schedule.
+
+    If ``center`` is True, the mean is subtracted from the parameters after
+    each step."""
 
     def __init__(self, wrt, fprime, steprate, momentum, min_gain=1E-2,
-                 args=None):
+                 args=None, center=True):
         super(TsneMinimizer, self).__init__(wrt, args=args)
 
         self.fprime = fprime
         self.steprate = steprate
         self.momentum = momentum
         self.min_gain = min_gain
+        self.center = center
 
     def __iter__(self):
         step_m1 = np.zeros(self.wrt.shape[0]).astype(theano.config.floatX)
@@ -212,13 +638,14 @@ class TsneMinimizer(Minimizer):
             step -= self.steprate * gradient * gain
             self.wrt += step
             step_m1 = step
-            self.wrt -= self.wrt.mean(axis=0)
+            if self.center:
+                self.wrt -= self.wrt.mean(axis=0)
             yield dict(gradient=gradient, gain=gain, args=args, kwargs=kwargs,
                        n_iter=i, step=step)
 
 
 def tsne(X, low_dim, perplexity=40, early_exaggeration=50, max_iter=1000,
-         verbose=False):
+         verbose=False, method='exact', theta=0.5):
     """Return low dimensional representations for the given data set.
 
     Parameters
@@ -242,6 +669,14 @@ def tsne(X, low_dim, perplexity=40, early_exaggeration=50, max_iter=1000,
     max_iter : integer, optional, [default: 1000]
         Maximum number of iterations to perform.
 
+    method : string, optional [default: 'exact']
+        Either ``exact`` for the exact gradient or ``barnes_hut`` for the
+        approximation by ``barnes_hut_loss_and_gradient``.
+
+    theta : float, optional [default: 0.5]
+        Accuracy of the Barnes-Hut approximation; ignored for the exact
+        method.
+
 
     Returns
     -------
@@ -254,6 +689,11 @@ def tsne(X, low_dim, perplexity=40, early_exaggeration=50, max_iter=1000,
         raise ValueError("early_exaggeration has to be non negative")
     if max_iter < 0:
         raise ValueError("max_iter has to be non negative")
+    if method == 'barnes_hut':
+        return _tsne_barnes_hut(X, low_dim, perplexity, early_exaggeration,
+                                max_iter, verbose, theta)
+    elif method != 'exact':
+        raise ValueError('unknown method %s' % method)
 
     # Define embeddings shared variable and initialize randomly.
     embeddings_flat = theano.shared(
@@ -299,6 +739,119 @@ def tsne(X, low_dim, perplexity=40, early_exaggeration=50, max_iter=1000,
     return embeddings_data.reshape(X.shape[0], low_dim)
 
 
+def _tsne_barnes_hut(X, low_dim, perplexity, early_exaggeration, max_iter,
+                     verbose, theta):
+    n = X.shape[0]
+    # Since the probabilities are normalized differently from the exact
+    # method, the initialization and step rate are the ones of [1].
+    embeddings_data = np.random.normal(0, 1E-4, n * low_dim).astype(
+        theano.config.floatX)
+
+    p_ji = sparse_neighbour_probabilities(X, perplexity)
+
+    def f_loss_and_grad(flat, p):
+        return barnes_hut_loss_and_gradient(flat.reshape((n, low_dim)), p,
+                                            theta)
+
+    def f_d_loss(flat, p):
+        _, gradient = f_loss_and_grad(flat, p)
+        return gradient.ravel().astype(theano.config.floatX)
+
+    ee_args = [p_ji * 4] * early_exaggeration
+    no_ee_args = itertools.repeat(p_ji)
+    args = (([i], {}) for i in itertools.chain(ee_args, no_ee_args))
+
+    opt = TsneMinimizer(embeddings_data, f_d_loss, args=args, momentum=0.5,
+                        steprate=200, min_gain=0.01)
+    for i, info in enumerate(opt):
+        opt.momentum = 0.5 if i < 20 else 0.8
+        if verbose:
+            print 'loss #%i' % i, f_loss_and_grad(embeddings_data, p_ji)[0]
+            if i == early_exaggeration - 1:
+                print 'stopping early exaggeration'
+        if i + 1 == max_iter:
+            break
+
+    return embeddings_data.reshape(n, low_dim)
+
+
+def embed_out_of_sample(X, reference, reference_embeddings, perplexity=40,
+                        max_iter=100, theta=0.5):
+    """Return low dimensional representations for new data points, given an
+    existing embedding which is kept fixed.
+
+    Each new point is placed such that its neighbour probabilities in the
+    embedding match its neighbour probabilities among the reference points.
+    The new points do not influence each other, so they are optimized all at
+    once. Attractive forces are computed from the ``3 * perplexity`` nearest
+    reference points only, and repulsive forces with the Barnes-Hut
+    approximation.
+
+    Parameters
+    ----------
+
+    X : array_like
+        New points in the original space, one per row.
+
+    reference : array_like
+        Points in the original space the embedding was found for, one per
+        row.
+
+    reference_embeddings : array_like
+        Embedding of ``reference``, one point per row.
+
+    perplexity : float, optional [default: 40]
+        Perplexity parameter, as used for the reference embedding.
+
+    max_iter : integer, optional [default: 100]
+        Number of iterations to perform.
+
+    theta : float, optional [default: 0.5]
+        Accuracy of the Barnes-Hut approximation, see
+        ``SpaceTree.repulsion``.
+
+
+    Returns
+    -------
+
+    E : array_like
+        Array of the shape ``(n, low_dim)`` holding the embeddings of ``X``.
+    """
+    if max_iter < 0:
+        raise ValueError("max_iter has to be non negative")
+    n = X.shape[0]
+    reference_embeddings = np.asarray(reference_embeddings, dtype='float64')
+    low_dim = reference_embeddings.shape[1]
+
+    k = min(int(3 * perplexity), reference.shape[0])
+    dists, indices = nearest_neighbours(X, k, reference=reference)
+    precisions = bisect_precisions(dists, perplexity)
+    p = conditional_probabilities(dists, precisions)
+    neighbours = reference_embeddings[indices]
+    tree = SpaceTree(reference_embeddings)
+
+    def f_d_loss(flat):
+        embeddings = flat.reshape((n, low_dim))
+        diff = embeddings[:, np.newaxis] - neighbours
+        q = 1 / (1 + (diff ** 2).sum(axis=2))
+        attraction = ((p * q)[:, :, np.newaxis] * diff).sum(axis=1)
+        z, repulsion = tree.repulsion(embeddings, theta, members=False)
+        gradient = 2 * (attraction - repulsion / z[:, np.newaxis])
+        return gradient.ravel().astype(theano.config.floatX)
+
+    # Start at the average embedding of the neighbours.
+    embeddings_data = (p[:, :, np.newaxis] * neighbours).sum(axis=1)
+    embeddings_data = embeddings_data.ravel().astype(theano.config.floatX)
+
+    args = itertools.repeat(([], {}))
+    opt = TsneMinimizer(embeddings_data, f_d_loss, args=args, momentum=0.8,
+                        steprate=1, min_gain=0.01, center=False)
+    for i, info in itertools.islice(enumerate(opt), max_iter):
+        pass
+
+    return embeddings_data.reshape(n, low_dim)
+
+
 class Tsne(object):
     """TSNE class.
 
@@ -323,10 +876,22 @@ class Tsne(object):
 
     verbose : boolean
         Flag indicating whether information should be printed.
+
+    method : string
+        Either ``exact`` or ``barnes_hut``.
+
+    theta : float
+        Accuracy of the Barnes-Hut approximation.
+
+    reference : array_like
+        Points the embedding was last fit for, or None.
+
+    embeddings : array_like
+        Embeddings of ``reference``, or None.
     """
 
     def __init__(self, n_inpt, n_lowdim, perplexity=40, early_exaggeration=50,
-                 max_iter=1000, verbose=False):
+                 max_iter=1000, verbose=False, method='exact', theta=0.5):
         """Create a Tsne object.
 
         Parameters
@@ -352,6 +917,15 @@ class Tsne(object):
         verbose : boolean
             Flag that indicates whether to print out information during the
             optimization.
+
+        method : string
+            Either ``exact`` for the exact gradient, which takes quadratic
+            time and memory, or ``barnes_hut`` for an approximation which
+            takes ``O(n log n)`` time per iteration.
+
+        theta : float
+            Accuracy of the Barnes-Hut approximation; smaller is more
+            accurate and slower. Ignored for the exact method.
         """
         self.n_inpt = n_inpt
         self.n_lowdim = n_lowdim
@@ -359,6 +933,10 @@ class Tsne(object):
         self.early_exaggeration = early_exaggeration
         self.max_iter = max_iter
         self.verbose = verbose
+        self.method = method
+        self.theta = theta
+        self.reference = None
+        self.embeddings = None
 
     def fit_transform(self, X):
         """Fit embeddings for `X` and return them.
@@ -377,5 +955,34 @@ class Tsne(object):
             ``(n, n_lowdim)`` shape array with low dimensional representations,
             where ``n_lowdim`` has been specified during construction.
         """
-        return tsne(X, self.n_lowdim, self.perplexity, self.early_exaggeration,
-                    self.max_iter, self.verbose)
+        E = tsne(X, self.n_lowdim, self.perplexity, self.early_exaggeration,
+                 self.max_iter, self.verbose, self.method, self.theta)
+        self.reference, self.embeddings = X, E
+        return E
+
+    def transform(self, X, max_iter=100):
+        """Return embeddings for new points `X`, keeping the embeddings found
+        by the last call to ``.fit_transform`` fixed.
+
+        See ``embed_out_of_sample`` for details.
+
+        Parameters
+        ----------
+
+        X : array_like
+            ``(n, d)`` shaped array where ``n`` is the number of samples and
+            ``d`` is the dimensionality.
+
+        max_iter : integer, optional [default: 100]
+            Number of iterations to perform.
+
+        Returns
+        -------
+
+        E : array_like
+            ``(n, n_lowdim)`` shape array with low dimensional representations.
+        """
+        if self.embeddings is None:
+            raise ValueError('need to fit embeddings first')
+        return embed_out_of_sample(X, self.reference, self.embeddings,
+                                   self.perplexity, max_iter, self.theta)
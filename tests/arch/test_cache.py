@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import theano
+import theano.tensor as T
+
+from breze.arch.cache import FunctionCache
+from breze.arch.util import theano_function_with_nested_exprs
+
+
+def test_function_cache():
+    cache = FunctionCache()
+
+    def make():
+        # Build a structurally identical graph from scratch every time.
+        X, W = T.matrix('X'), T.matrix('W')
+        return theano_function_with_nested_exprs(
+            [W, X], T.tanh(T.dot(X, W)), cache=cache)
+
+    f1 = make()
+    f2 = make()
+    assert f1.cache_info['source'] == 'compile'
+    assert f2.cache_info['source'] == 'memory'
+    assert f1.cache_info['key'] == f2.cache_info['key']
+    assert cache.stats['misses'] == 1
+    assert cache.stats['memory_hits'] == 1
+
+    W = np.random.standard_normal((2, 3)).astype(theano.config.floatX)
+    X = np.random.random((10, 2)).astype(theano.config.floatX)
+    assert np.allclose(f1(W, X), f2(W, X))
+
+
+def test_function_cache_disk():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = FunctionCache(directory)
+        X = T.matrix('X')
+        f1 = theano_function_with_nested_exprs(
+            [X], (X ** 2).sum(axis=1), cache=cache)
+
+        # Simulate a fresh process.
+        cache = FunctionCache(directory)
+        X = T.matrix('X')
+        f2 = theano_function_with_nested_exprs(
+            [X], (X ** 2).sum(axis=1), cache=cache)
+        assert f2.cache_info['source'] == 'disk'
+        assert cache.stats['disk_hits'] == 1
+
+        x = np.random.random((10, 2)).astype(theano.config.floatX)
+        assert np.allclose(f1(x), f2(x))
+
+        # A different graph must not be served from the cache.
+        f3 = theano_function_with_nested_exprs(
+            [X], (X ** 3).sum(axis=1), cache=cache)
+        assert f3.cache_info['source'] == 'compile'
+
+        # Evict everything but the most recently used entry.
+        cache.max_disk_bytes = max(
+            os.path.getsize(os.path.join(directory, i))
+            for i in os.listdir(directory))
+        cache._evict()
+        assert len(os.listdir(directory)) == 1
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_function_cache_shared_variables():
+    cache = FunctionCache()
+    s1 = theano.shared(np.ones(2).astype(theano.config.floatX))
+    s2 = theano.shared(np.ones(2).astype(theano.config.floatX))
+    X = T.vector('X')
+    f1 = theano_function_with_nested_exprs([X], X * s1, cache=cache)
+    f2 = theano_function_with_nested_exprs([X], X * s2, cache=cache)
+    assert f1.cache_info['key'] != f2.cache_info['key']
+    assert f2.cache_info['source'] == 'compile'
+
+
+def test_function_cache_pins_keyed_objects():
+    cache = FunctionCache()
+    X = T.vector('X')
+    f = theano_function_with_nested_exprs(
+        [X], X * theano.shared(np.ones(2).astype(theano.config.floatX)),
+        cache=cache)
+    # The key embeds the id of the shared variable, which thus has to stay
+    # alive as long as the entry does.
+    _, pinned = cache._memory[f.cache_info['key']]
+    shared = [i for i in theano.gof.graph.inputs(pinned[1])
+              if isinstance(i, theano.compile.SharedVariable)]
+    assert len(shared) == 1
+
+
+def test_function_cache_no_memory_tier():
+    cache = FunctionCache(max_memory_items=0)
+
+    def make():
+        X = T.matrix('X')
+        return theano_function_with_nested_exprs(
+            [X], (X ** 2).sum(axis=1), cache=cache)
+
+    make()
+    assert make().cache_info['source'] == 'compile'
+    assert len(cache._memory) == 0
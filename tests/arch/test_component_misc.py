@@ -5,7 +5,9 @@ import theano
 import theano.tensor as T
 import numpy as np
 
-from breze.arch.component.misc import distance_matrix, project_into_l2_ball
+from breze.arch.component.misc import (
+    distance_matrix, numpy_distance_matrix, pairwise_diff,
+    distance_matrix_by_diff, project_into_l2_ball)
 
 
 def test_distance_matrix():
@@ -19,6 +21,29 @@ def test_distance_matrix():
     assert correct, 'distance matrix not working right'
 
 
+def test_distance_matrix_norms():
+    X, Y = T.matrix(), T.matrix()
+    x = np.random.standard_normal((20, 3)).astype(theano.config.floatX)
+    y = np.random.standard_normal((7, 3)).astype(theano.config.floatX)
+
+    for norm in ['l1', 'soft_l1', 'l2', 'root_l2']:
+        desired = theano.function(
+            [X, Y], distance_matrix_by_diff(pairwise_diff(X, Y), norm))(x, y)
+        for max_bytes in [None, 100]:
+            D = distance_matrix(X, Y, norm, max_bytes=max_bytes)
+            f = theano.function([X, Y], D, mode='FAST_COMPILE')
+            assert np.allclose(f(x, y), desired, atol=1e-5), norm
+        D = numpy_distance_matrix(x, y, norm, max_bytes=100)
+        assert np.allclose(D, desired, atol=1e-5), norm
+
+
+def test_numpy_distance_matrix_zero_diagonal():
+    x = np.random.standard_normal((20, 3)) * 1e3
+    D = numpy_distance_matrix(x, max_bytes=100)
+    assert (np.diag(D) == 0).all()
+    assert np.allclose(D, D.T)
+
+
 def test_project_into_l2_ball_single():
     x = T.vector()
     x_projected = project_into_l2_ball(x, 1)
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
 
+import os
+import tempfile
+
 import numpy as np
 import theano
 import theano.tensor as T
@@ -37,6 +40,31 @@ def test_parameter_set_data_change():
     pars.data.sum() == 60
 
 
+def test_parameter_set_memmap():
+    fn = os.path.join(tempfile.mkdtemp(), 'pars.bin')
+    pars = ParameterSet(matrix=(10, 10), vector=10)
+    pars.data[...] = np.arange(110)
+    pars.memmap(fn, mode='w+')
+    assert isinstance(pars.data, np.memmap)
+
+    pars['vector'] += 1
+    pars.flush()
+
+    other = ParameterSet(matrix=(10, 10), vector=10)
+    other.memmap(fn, mode='r')
+    assert np.allclose(pars.data, other.data)
+    assert np.allclose(pars['vector'], other['vector'])
+    assert np.may_share_memory(other['matrix'], other.data)
+
+    small = ParameterSet(vector=10)
+    try:
+        small.memmap(fn, mode='r')
+    except ValueError:
+        pass
+    else:
+        assert False, 'size mismatch not detected'
+
+
 def test_model_function():
     pars = ParameterSet(weights=(2, 3))
     inpt = T.matrix()
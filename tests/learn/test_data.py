@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import itertools
+import os
+import tempfile
+import threading
+
 import numpy as np
 import scipy
 import nose.tools
+import h5py
 
-from breze.learn.data import (shuffle, padzeros, minibatches, windowify,
-    interpolate, skip, one_hot)
+from breze.learn.data import (shuffle, shuffle_many, lazy_shuffle_many,
+    padzeros, BucketedSequences, minibatches, windowify, window_view, WindowDataset, interpolate,
+    skip, one_hot, Prefetcher, OutOfCoreDataset, iter_block_minibatches)
 
 
 @nose.tools.nottest
@@ -24,6 +31,27 @@ def test_shuffle():
     assert after == before, "Shuffle mutated data."
 
 
+def test_shuffle_many():
+    X = np.arange(60, dtype='float32').reshape((20, 3))
+    Z = np.arange(20).reshape((1, 20, 1))
+    shuffle_many([X, Z], [0, 1], random_state=1, max_bytes=40)
+    assert (X[:, 0] == Z[0, :, 0] * 3).all(), 'arrays not aligned'
+    assert sorted(Z.ravel()) == range(20), 'shuffle mutated data'
+    assert (Z.ravel() != np.arange(20)).any(), 'not shuffled'
+
+
+def test_lazy_shuffle_many():
+    X = np.arange(60, dtype='float32').reshape((20, 3))
+    Z = np.arange(20).reshape((1, 20, 1))
+    PX, PZ = lazy_shuffle_many([X, Z], [0, 1], random_state=1)
+    assert (PX[5:9][:, 0] == PZ[:, 5:9][0, :, 0] * 3).all()
+    assert (np.asarray(PX) == X[PX.permutation]).all()
+
+    batches = minibatches(PZ, 8, 1)
+    assert [i.shape for i in batches] == [(1, 8, 1), (1, 8, 1), (1, 4, 1)]
+    assert sorted(np.concatenate(batches, axis=1).ravel()) == range(20)
+
+
 def test_padzeros():
     """Test if padding with zeros works fine."""
     seqs = [
@@ -62,6 +90,31 @@ def test_skip():
     assert (X_ == des).all(), 'wrong result'
 
 
+def test_bucketed_sequences():
+    lengths = [1, 9, 2, 8, 3, 7, 4, 6, 5, 5]
+    X = [np.ones((i, 2)) * i for i in lengths]
+    Z = np.arange(10)
+    buckets = BucketedSequences([X, Z], 2, n_buckets=5, random_state=1)
+    assert len(buckets.buckets) == 5
+
+    seen = []
+    for indices in buckets.epoch():
+        x, z, mask = buckets.batch(indices)
+        assert x.shape == (max(lengths[i] for i in indices), len(indices), 2)
+        batch_lengths = [lengths[i] for i in indices]
+        assert (mask.sum(axis=0) == batch_lengths).all()
+        assert (x[:, :, 0] == mask * batch_lengths).all()
+        assert (z == indices).all()
+        # Buckets hold sequences of neighbouring lengths only.
+        assert abs(lengths[indices[0]] - lengths[indices[1]]) <= 1
+        seen += list(z)
+    assert sorted(seen) == range(10)
+
+    buckets = BucketedSequences([X], 3, front=False)
+    x, mask = next(iter(buckets))
+    assert (x[:, :, 0] == mask * x[0, :, 0]).all()
+
+
 def test_windowify():
     """Test if windowifying sequences works."""
     x1 = scipy.array([[1], [2], [3], [4]])
@@ -78,6 +131,36 @@ def test_windowify():
     assert (W == desired).all(), "result has wrong entries"
 
 
+def test_window_view():
+    x = np.arange(10).reshape((5, 2))
+    W = window_view(x, 3, 2)
+    assert W.shape == (2, 3, 2)
+    assert (W[1] == x[2:5]).all()
+    assert np.may_share_memory(W, x)
+    assert not W.flags.writeable
+
+
+def test_window_dataset():
+    x1 = scipy.array([[1], [2], [3], [4]])
+    x2 = scipy.array([[10], [11], [12]])
+    W = WindowDataset([x1, x2], 2)
+    desired = windowify([x1, x2], 2)
+    assert W.shape == desired.shape
+    assert (np.asarray(W) == desired).all()
+    assert (W[[4, 0]] == desired[[4, 0]]).all()
+    assert (W[3] == desired[3]).all()
+
+    batches = minibatches(W, 2)
+    assert all(isinstance(i, WindowDataset) for i in batches)
+    assert (np.concatenate([np.asarray(i) for i in batches]) == desired).all()
+
+    W = WindowDataset([x1, x2], 2, offset=2, axis=1)
+    desired = windowify([x1, x2], 2, 2).swapaxes(0, 1)
+    assert W.shape == desired.shape
+    assert (np.asarray(W) == desired).all()
+    assert (np.asarray(minibatches(W, 2, 1)[1]) == desired[:, 2:]).all()
+
+
 def test_windowify_offset():
     """Test if windowifying sequences works with an offset."""
     x1 = scipy.array([[1], [2], [3], [4], [5]])
@@ -117,3 +200,69 @@ def test_one_hot():
     assert np.allclose(desired, one_hot(arr))
     assert np.allclose(desired, one_hot(arr, 4))
 
+
+
+def _square(x):
+    return x ** 2
+
+
+def test_prefetcher_order():
+    for prefetcher in (Prefetcher(3),
+                       Prefetcher(3, pool='thread', n_workers=2),
+                       Prefetcher(3, pool='process', n_workers=2)):
+        res = list(prefetcher(iter(range(20)), _square))
+        assert res == [i ** 2 for i in range(20)]
+
+
+def test_prefetcher_error():
+    def prepare(x):
+        if x == 3:
+            raise ZeroDivisionError()
+        return x
+
+    itr = Prefetcher(2)(iter(range(5)), prepare)
+    assert [itr.next() for _ in range(3)] == [0, 1, 2]
+    nose.tools.assert_raises(ZeroDivisionError, itr.next)
+
+
+def test_prefetcher_close():
+    n_threads = threading.active_count()
+    itr = Prefetcher(2)(itertools.count(), _square)
+    assert itr.next() == 0
+    itr.close()
+    assert threading.active_count() == n_threads
+
+
+def test_out_of_core_dataset():
+    fn = os.path.join(tempfile.mkdtemp(), 'data.h5')
+    X = np.arange(200, dtype='float32').reshape((50, 4))
+    with h5py.File(fn, 'w') as fp:
+        fp.create_dataset('X', data=X, chunks=(8, 4))
+
+    with h5py.File(fn, 'r') as fp:
+        D = OutOfCoreDataset(fp['X'])
+        assert D.block_rows % 8 == 0
+        assert D.shape == X.shape
+
+        V = D[10:20]
+        assert isinstance(V, OutOfCoreDataset) and V.shape == (10, 4)
+        assert (np.asarray(V) == X[10:20]).all()
+        assert (V[[7, 2, 2]] == X[[17, 12, 12]]).all()
+        assert (V[-1] == X[19]).all()
+        assert (D[5:15, 1] == X[5:15, 1]).all()
+
+
+def test_iter_block_minibatches():
+    X = np.memmap(os.path.join(tempfile.mkdtemp(), 'X.bin'), mode='w+',
+                  dtype='float32', shape=(4, 50))
+    X[...] = np.arange(50)
+    Z = np.arange(50)
+    D = OutOfCoreDataset(X, axis=1, block_rows=20)
+
+    batches = iter_block_minibatches([D, Z], 5, [1, 0], random_state=1)
+    seen = []
+    for x, z in itertools.islice(batches, 10):
+        assert x.shape == (4, 5)
+        assert (x[0] == z).all()
+        seen += list(z)
+    assert sorted(seen) == range(50)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import itertools
+
+import numpy as np
+
+from breze.learn.hessianfree import HessianFree
+
+
+def test_hessianfree_quadratic():
+    rng = np.random.RandomState(1010)
+    A = rng.standard_normal((10, 10))
+    A = np.dot(A, A.T) + np.eye(10)
+    b = rng.standard_normal(10)
+
+    f = lambda x: 0.5 * np.dot(x, np.dot(A, x)) - np.dot(b, x)
+    fprime = lambda x: np.dot(A, x) - b
+    f_Hp = lambda x, p: np.dot(A, p)
+
+    wrt = np.zeros(10)
+    opt = HessianFree(wrt, f, fprime, f_Hp, initial_damping=1e-8)
+    info = next(iter(opt))
+
+    # The damping is negligible, so a single step solves the quadratic.
+    assert np.allclose(wrt, np.linalg.solve(A, b), atol=1e-5)
+    assert info['n_iter'] == 1
+    assert info['step_length'] == 1.
+    # The quadratic model is exact, so the damping decreases.
+    assert info['damping'] < 1e-8
+
+
+def test_hessianfree_curvature_args():
+    sub_batches = []
+
+    def curvature_args(args):
+        sub_batches.append(args[0][:1])
+        return [sub_batches[-1]]
+
+    def f_Hp(x, p, a):
+        # The same sub-batch is used within a step.
+        assert a is sub_batches[-1]
+        return p
+
+    args = ((([np.ones(2) * i], {}) for i in itertools.count()))
+    wrt = np.ones(3)
+    opt = HessianFree(wrt, lambda x, a: np.dot(x, x), lambda x, a: 2 * x,
+                      f_Hp, args=args, curvature_args=curvature_args)
+    for info in itertools.islice(opt, 4):
+        pass
+    assert len(sub_batches) == 4
@@ -1,7 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import cPickle
+import os
+import tempfile
+
+import h5py
 import numpy as np
+import theano
 
+from breze.learn.data import OutOfCoreDataset
 from breze.learn.mlp import Mlp, FastDropoutNetwork, AwnNetwork
 
 from breze.arch.component.loss import squared
@@ -29,6 +36,20 @@ def test_mlp_predict():
     mlp.predict(X)
 
 
+def test_mlp_predict_chunked():
+    X = np.random.standard_normal((10, 2)).astype(theano.config.floatX)
+    mlp = Mlp(2, [10], 1, ['tanh'], 'identity', 'squared', max_iter=10)
+    Y = mlp.predict(X)
+    assert np.allclose(Y, mlp.predict(X, max_rows=3))
+    assert np.allclose(Y, mlp.predict(X, max_bytes=20))
+
+    chunks = iter([X[:4], X[4:]])
+    assert np.allclose(Y, np.concatenate(list(mlp.predict(chunks))))
+
+    # Lists are arrays, not streams of chunks.
+    assert np.allclose(Y, mlp.predict(X.tolist(), max_rows=3))
+
+
 def test_fd_fit():
     X = np.random.standard_normal((10, 2))
     Z = np.random.standard_normal((10, 1))
@@ -83,3 +104,149 @@ def test_awn_predict():
     mlp = AwnNetwork(
         2, [10], 1, ['rectifier'], 'identity', loss, max_iter=10)
     mlp.predict(X)
+
+
+def test_mlp_fit_fused_loss_and_grad():
+    X = np.random.standard_normal((10, 2))
+    Z = np.random.standard_normal((10, 1))
+    mlp = Mlp(2, [10], 1, ['tanh'], 'identity', 'squared', max_iter=10)
+    mlp.fuse_loss_and_grad = True
+    mlp.fit(X, Z)
+
+
+def test_mlp_fused_loss_and_grad():
+    X = np.random.standard_normal((10, 2)).astype(theano.config.floatX)
+    Z = np.random.standard_normal((10, 1)).astype(theano.config.floatX)
+    mlp = Mlp(2, [10], 1, ['tanh'], 'identity', 'squared', max_iter=10)
+    f_loss, f_d_loss = mlp._make_loss_functions()
+
+    mlp.fuse_loss_and_grad = True
+    f_loss_fused, f_d_loss_fused = mlp._make_loss_functions()
+    fused = f_loss_fused.im_self
+
+    pars = mlp.parameters.data
+    assert np.allclose(f_loss(pars, X, Z), f_loss_fused(pars, X, Z))
+    assert np.allclose(f_d_loss(pars, X, Z), f_d_loss_fused(pars, X, Z))
+    assert fused.n_evals == 1
+
+    pars = pars + 1
+    assert np.allclose(f_d_loss(pars, X, Z), f_d_loss_fused(pars, X, Z))
+    assert np.allclose(f_loss(pars, X, Z), f_loss_fused(pars, X, Z))
+    assert fused.n_evals == 2
+
+
+def test_mlp_fit_resident_data():
+    X = np.random.standard_normal((10, 2)).astype(theano.config.floatX)
+    Z = np.random.standard_normal((10, 1)).astype(theano.config.floatX)
+    mlp = Mlp(2, [10], 1, ['tanh'], 'identity', 'squared', max_iter=10,
+              batch_size=4, optimizer='rprop')
+    mlp.resident_data = True
+    mlp.random_state = 1
+    mlp.fit(X, Z)
+
+    # The data is released after fitting and never pickled.
+    assert mlp._resident is None
+    cPickle.dumps(mlp)
+
+    mlp._store_resident((X, Z))
+    assert '_resident' not in mlp.__getstate__()
+    f_loss, _ = mlp._make_loss_functions()
+    pars = mlp.parameters.data
+    loss = mlp.function(['inpt', 'target'], 'loss')
+    assert np.allclose(f_loss(pars, 0), loss(X[:4], Z[:4]))
+    assert np.allclose(f_loss(pars, 2), loss(X[8:], Z[8:]))
+
+
+def test_mlp_powerfit_chunked():
+    X = np.random.standard_normal((10, 2)).astype(theano.config.floatX)
+    Z = np.random.standard_normal((10, 1)).astype(theano.config.floatX)
+    VX = np.random.standard_normal((7, 2)).astype(theano.config.floatX)
+    VZ = np.random.standard_normal((7, 1)).astype(theano.config.floatX)
+    mlp = Mlp(2, [10], 1, ['tanh'], 'identity', 'squared', max_iter=10,
+              optimizer='rprop')
+    f_loss = mlp.function(['inpt', 'target'], 'loss')
+
+    stop = lambda info: info['n_iter'] >= 3
+    report = lambda info: True
+    mlp.random_state = 1
+    SX, SZ = mlp._subsample((X, Z), 5, 1)
+    for info in mlp.powerfit((X, Z), (VX, VZ), stop, report,
+                             eval_batch_size=3, train_subsample=5):
+        assert np.allclose(info['val_loss'], f_loss(VX, VZ))
+        # The training loss is taken on the subsample of the random state.
+        assert np.allclose(info['loss'], f_loss(SX, SZ))
+
+
+def test_mlp_powerfit_async():
+    X = np.random.standard_normal((10, 2)).astype(theano.config.floatX)
+    Z = np.random.standard_normal((10, 1)).astype(theano.config.floatX)
+    VX = np.random.standard_normal((7, 2)).astype(theano.config.floatX)
+    VZ = np.random.standard_normal((7, 1)).astype(theano.config.floatX)
+    mlp = Mlp(2, [10], 1, ['tanh'], 'identity', 'squared', max_iter=10,
+              optimizer='rprop')
+    f_loss = mlp.function(['inpt', 'target'], 'loss', explicit_pars=True)
+
+    stop = lambda info: info['n_iter'] >= 20
+    report = lambda info: True
+    infos = list(mlp.powerfit((X, Z), (VX, VZ), stop, report, async_evals=2))
+    assert infos[-1]['n_iter'] == 20
+    for info in infos:
+        assert info['n_pending_evals'] <= 2
+        assert info['val_n_iter'] is not None
+        assert np.allclose(info['best_loss'],
+                           f_loss(info['best_pars'], VX, VZ))
+
+    # All reported snapshots have been evaluated in the end.
+    assert infos[-1]['val_n_iter'] == 20
+    assert infos[-1]['n_pending_evals'] == 0
+
+
+def test_mlp_checkpoint_restore():
+    X = np.random.standard_normal((10, 2)).astype(theano.config.floatX)
+    Z = np.random.standard_normal((10, 1)).astype(theano.config.floatX)
+    dirname = os.path.join(tempfile.mkdtemp(), 'checkpoint')
+
+    def make():
+        mlp = Mlp(2, [10], 1, ['tanh'], 'identity', 'squared',
+                  optimizer=('rmsprop', {'step_rate': 1e-2, 'momentum': 0.9}))
+        return mlp
+
+    mlp = make()
+    for i, info in enumerate(mlp.iter_fit(X, Z)):
+        if i + 1 == 5:
+            mlp.checkpoint(dirname)
+        if i + 1 == 10:
+            break
+    expected = mlp.parameters.data.copy()
+    cPickle.dumps(mlp)
+
+    other = make()
+    meta = other.restore(dirname)
+    assert meta['hyper_parameters']['n_hiddens'] == [10]
+    assert isinstance(other.parameters.data, np.memmap)
+    for i, info in enumerate(other.iter_fit(X, Z)):
+        if i + 1 == 5:
+            break
+    assert info['n_iter'] == 10
+    assert np.allclose(expected, other.parameters.data)
+
+
+def test_mlp_fit_out_of_core():
+    fn = os.path.join(tempfile.mkdtemp(), 'data.h5')
+    with h5py.File(fn, 'w') as fp:
+        fp.create_dataset('X', data=np.random.standard_normal((100, 2)),
+                          chunks=(10, 2))
+        fp.create_dataset('Z', data=np.random.standard_normal((100, 1)),
+                          chunks=(10, 1))
+
+    with h5py.File(fn, 'r') as fp:
+        X = OutOfCoreDataset(fp['X'], block_rows=30)
+        Z = OutOfCoreDataset(fp['Z'], block_rows=30)
+        mlp = Mlp(2, [10], 1, ['tanh'], 'identity', 'squared', batch_size=10,
+                  max_iter=10)
+        mlp.fit(X, Z)
+
+        stop = lambda info: info['n_iter'] >= 5
+        infos = list(mlp.powerfit((X, Z), (X[:50], Z[:50]), stop,
+                                  lambda info: True, train_subsample=20))
+        assert np.isfinite(infos[-1]['val_loss'])
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+import theano
+
+from breze.learn.mlp import Mlp
+from breze.learn.rnn import SupervisedLstm
+from breze.learn.numpy_inference import NumpyMlp, NumpyLstm
+
+
+def make_mlp(hidden_transfers, out_transfer):
+    n_hiddens = [5] * len(hidden_transfers)
+    mlp = Mlp(3, n_hiddens, 4, hidden_transfers, out_transfer, 'squared')
+    mlp.parameters.data[...] = np.random.standard_normal(
+        mlp.parameters.data.shape)
+    return mlp
+
+
+def test_numpy_mlp_matches_mlp():
+    X = np.random.standard_normal((20, 3)).astype(theano.config.floatX)
+    for hiddens, out in [(['tanh'], 'identity'),
+                         (['sigmoid', 'rectifier'], 'softmax'),
+                         (['softplus', 'tanhplus', 'softsign'], 'sigmoid')]:
+        mlp = make_mlp(hiddens, out)
+        nmlp = NumpyMlp.from_mlp(mlp, max_rows=7)
+        assert np.allclose(mlp.predict(X), nmlp.predict(X), atol=1e-5), \
+            'results differ for %s, %s' % (hiddens, out)
+
+
+def test_numpy_mlp_save_load_without_theano():
+    X = np.random.standard_normal((10, 3)).astype(theano.config.floatX)
+    mlp = make_mlp(['tanh', 'rectifier'], 'sigmoid')
+    expected = mlp.predict(X)
+
+    d = tempfile.mkdtemp()
+    fn = os.path.join(d, 'mlp.npz')
+    NumpyMlp.from_mlp(mlp).save(fn)
+    np.save(os.path.join(d, 'X.npy'), X)
+
+    # Loading and predicting has to work with Theano being unavailable.
+    code = '\n'.join([
+        'import sys',
+        'sys.modules["theano"] = None',
+        'import numpy as np',
+        'from breze.learn.numpy_inference import NumpyMlp',
+        'nmlp = NumpyMlp.load(%r)' % fn,
+        'np.save(%r, nmlp.predict(np.load(%r)))' % (
+            os.path.join(d, 'Y.npy'), os.path.join(d, 'X.npy')),
+    ])
+    subprocess.check_call([sys.executable, '-c', code])
+    assert np.allclose(expected, np.load(os.path.join(d, 'Y.npy')), atol=1e-5)
+
+
+def test_numpy_mlp_rejects_callable_transfer():
+    mlp = make_mlp([lambda x: x], 'identity')
+    try:
+        NumpyMlp.from_mlp(mlp)
+    except ValueError:
+        pass
+    else:
+        assert False, 'callable transfer should not be exportable'
+
+
+def test_numpy_lstm_matches_lstm():
+    X = np.random.standard_normal((6, 4, 3)).astype(theano.config.floatX)
+    for n_hiddens, transfer, kwargs in [
+            (5, 'sigmoid', {}),
+            ([5, 4], ['tanh', 'sigmoid'], {'leaky_coeffs': [np.ones(5) * .3,
+                                               np.ones(4) * .6]}),
+            (5, 'sigmoid', {'pooling': 'mean', 'out_transfer': 'softmax'})]:
+        lstm = SupervisedLstm(3, n_hiddens, 2, transfer, **kwargs)
+        nlstm = NumpyLstm.from_lstm(lstm)
+        assert np.allclose(lstm.predict(X), nlstm.predict(X), atol=1e-5), \
+            'results differ for %s, %s' % (n_hiddens, kwargs)
+
+
+def test_numpy_lstm_step():
+    X = np.random.standard_normal((6, 4, 3)).astype(theano.config.floatX)
+    nlstm = NumpyLstm.from_lstm(SupervisedLstm(3, 5, 2, 'sigmoid'))
+    Y = nlstm.predict(X)
+
+    states = None
+    for t in range(6):
+        y, states = nlstm.step(X[t], states)
+        assert np.allclose(Y[t], y)
+
+    fn = os.path.join(tempfile.mkdtemp(), 'lstm.npz')
+    nlstm.save(fn)
+    assert np.allclose(Y, NumpyLstm.load(fn).predict(X))
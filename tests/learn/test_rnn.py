@@ -10,6 +10,9 @@ from breze.learn.rnn import (
     SupervisedRnn, UnsupervisedRnn,
     SupervisedLstm, UnsupervisedLstm)
 
+from breze.learn.data import WindowDataset, PackedSequences
+from breze.arch.model.sequential.rnn import state_names
+
 from nose.plugins.skip import SkipTest
 
 
@@ -35,6 +38,275 @@ def test_srnn_predict():
     rnn.predict(X)
 
 
+def test_srnn_predict_chunked():
+    X = np.random.standard_normal((10, 5, 2)).astype(theano.config.floatX)
+    rnn = SupervisedRnn(2, 10, 3, max_iter=10)
+    Y = rnn.predict(X)
+
+    assert np.allclose(Y, rnn.predict(X, max_rows=2))
+    out = np.empty_like(Y)
+    res = rnn.predict(X, max_bytes=X.nbytes // 3, out=out)
+    assert res is out
+    assert np.allclose(Y, out)
+
+    chunks = (X[:, i:i + 2] for i in range(0, 5, 2))
+    assert np.allclose(Y, np.concatenate(list(rnn.predict(chunks)), axis=1))
+
+    rnn = SupervisedRnn(2, 10, 3, pooling='mean', max_iter=10)
+    Y = rnn.predict(X)
+    assert Y.shape == (5, 3)
+    assert np.allclose(Y, rnn.predict(X, max_rows=2))
+
+
+def test_srnn_fit_window_dataset():
+    seq = np.random.standard_normal((50, 2)).astype(theano.config.floatX)
+    X = WindowDataset(seq[:-1], 10, axis=1)
+    Z = WindowDataset(seq[1:, :1], 10, axis=1)
+    rnn = SupervisedRnn(2, 10, 1, batch_size=8, max_iter=10)
+    rnn.fit(X, Z)
+
+
+def test_srnn_fit_bucketed():
+    X = [np.random.standard_normal((i, 2)) for i in range(3, 13)]
+    Z = [np.random.standard_normal((i, 3)) for i in range(3, 13)]
+    rnn = SupervisedRnn(2, 10, 3, batch_size=2, max_iter=10)
+    rnn.n_buckets = 2
+    rnn.fit(X, Z)
+
+    # The minibatches are drawn from the random state of the network.
+    rnn.random_state = 1
+    first = [rnn._make_args(X, Z).next()[0][0] for _ in range(2)]
+    assert first[0].shape == first[1].shape
+    assert np.allclose(first[0], first[1])
+
+    Z = np.random.standard_normal((10, 3))
+    rnn = SupervisedRnn(2, 10, 3, pooling='mean', batch_size=2, max_iter=10)
+    rnn.fit(X, Z)
+
+
+def test_srnn_fit_packed():
+    X = PackedSequences.from_list(
+        [np.random.standard_normal((i, 2)) for i in range(3, 13)])
+    Z = PackedSequences(np.random.standard_normal((X.data.shape[0], 3)),
+                        X.offsets)
+    rnn = SupervisedRnn(2, 10, 3, batch_size=2, max_iter=10)
+    rnn.fit(X, Z)
+
+
+def test_srnn_masked():
+    X = np.random.standard_normal((6, 2, 2)).astype(theano.config.floatX)
+    Z = np.random.standard_normal((6, 2, 3)).astype(theano.config.floatX)
+    # The second sequence is padded with two time steps in the back.
+    M = np.ones((6, 2), dtype=theano.config.floatX)
+    M[4:, 1] = 0
+    rnn = SupervisedRnn(2, 10, 3, use_mask=True, max_iter=10)
+    f_output = rnn.function(['inpt', 'mask'], 'output')
+    f_loss = rnn.function(['inpt', 'target', 'mask'], 'loss')
+
+    X_padded = X.copy()
+    X_padded[4:, 1] = 10
+    Y = f_output(X_padded, M)
+    assert np.allclose(Y[:, 0], rnn.predict(X[:, :1])[:, 0])
+    assert np.allclose(Y[:4, 1], rnn.predict(X[:4, 1:])[:, 0])
+
+    # Padding does not contribute to the loss.
+    Z_padded = Z.copy()
+    Z_padded[4:, 1] = 10
+    assert np.allclose(f_loss(X_padded, Z_padded, M), f_loss(X, Z, M))
+
+    rnn.fit(X, Z)
+
+    rnn = SupervisedRnn(2, 10, 3, pooling='mean', use_mask=True)
+    f_output = rnn.function(['inpt', 'mask'], 'output')
+    Y = f_output(X_padded, M)
+    assert np.allclose(Y[1], rnn.predict(X[:4, 1:])[0])
+
+
+def test_slstm_masked():
+    X = np.random.standard_normal((6, 2, 2)).astype(theano.config.floatX)
+    M = np.ones((6, 2), dtype=theano.config.floatX)
+    M[:2, 1] = 0
+    rnn = SupervisedLstm(2, 10, 3, pooling='last', use_mask=True)
+    f_output = rnn.function(['inpt', 'mask'], 'output')
+    X_padded = X.copy()
+    X_padded[:2, 1] = 10
+    Y = f_output(X_padded, M)
+    assert np.allclose(Y[1], rnn.predict(X[2:, 1:])[0])
+
+
+def test_srnn_powerfit_masked():
+    X = np.random.standard_normal((6, 4, 2)).astype(theano.config.floatX)
+    Z = np.random.standard_normal((6, 4, 3)).astype(theano.config.floatX)
+    VX = np.random.standard_normal((6, 3, 2)).astype(theano.config.floatX)
+    VZ = np.random.standard_normal((6, 3, 3)).astype(theano.config.floatX)
+    rnn = SupervisedRnn(2, 10, 3, use_mask=True, batch_size=2)
+    f_loss = rnn.function(['inpt', 'target', 'mask'], 'loss',
+                          explicit_pars=True)
+    M = np.ones((6, 3), dtype=theano.config.floatX)
+
+    stop = lambda info: info['n_iter'] >= 3
+    report = lambda info: True
+    infos = list(rnn.powerfit((X, Z), (VX, VZ), stop, report,
+                              eval_batch_size=2))
+    assert infos[-1]['n_iter'] == 3
+    assert np.allclose(infos[-1]['best_loss'],
+                       f_loss(infos[-1]['best_pars'], VX, VZ, M))
+
+    infos = list(rnn.powerfit((X, Z), (VX, VZ), stop, report,
+                              async_evals=1))
+    assert infos[-1]['n_pending_evals'] == 0
+
+
+def test_srnn_fit_bucketed_masked():
+    X = [np.random.standard_normal((i, 2)) for i in range(3, 13)]
+    Z = np.random.standard_normal((10, 3))
+    rnn = SupervisedRnn(2, 10, 3, pooling='max', batch_size=2, max_iter=10,
+                        use_mask=True)
+    rnn.fit(X, Z)
+
+
+def check_carried_states(rnn):
+    X = np.random.standard_normal((8, 3, 2)).astype(theano.config.floatX)
+    names = state_names(rnn.exprs)
+    assert names
+
+    f_first = rnn.function(['inpt'], ['final_' + i for i in names])
+    givens, inpts = rnn._state_givens()
+    f_second = rnn.function(['inpt'] + inpts, 'output', givens=givens)
+
+    states = f_first(X[:5])
+    assert np.allclose(rnn.predict(X)[5:], f_second(X[5:], *states))
+
+
+def test_srnn_carried_states():
+    leaky_coeffs = [np.ones(4) * .5, np.ones(4) * .25]
+    check_carried_states(SupervisedRnn(2, [4, 4], 3, leaky_coeffs=leaky_coeffs,
+                                       bptt_steps=5))
+
+
+def test_slstm_carried_states():
+    check_carried_states(SupervisedLstm(2, 4, 3, leaky_coeffs=[np.ones(4) * .5],
+                                        bptt_steps=5))
+
+
+def test_srnn_fit_truncated():
+    X = np.random.standard_normal((10, 5, 2)).astype(theano.config.floatX)
+    Z = np.random.standard_normal((10, 5, 3)).astype(theano.config.floatX)
+    for carry in 'state', 'reset':
+        rnn = SupervisedRnn(2, 10, 3, batch_size=2, max_iter=10,
+                            bptt_steps=4, bptt_carry=carry)
+        rnn.fit(X, Z)
+
+    rnn = SupervisedLstm(2, 10, 3, max_iter=10, bptt_steps=4)
+    args = rnn._make_args(X, Z)
+    lengths = [args.next()[0][0].shape[0] for _ in range(4)]
+    assert lengths == [4, 4, 2, 4], lengths
+    rnn.fit(X, Z)
+
+    X = [np.random.standard_normal((i, 2)) for i in range(3, 13)]
+    Z = [np.random.standard_normal((i, 3)) for i in range(3, 13)]
+    rnn = SupervisedRnn(2, 10, 3, batch_size=2, max_iter=10, use_mask=True,
+                        bptt_steps=4)
+    rnn.fit(X, Z)
+
+
+def test_srnn_fit_truncated_masked_leaky():
+    X = np.random.standard_normal((10, 5, 2)).astype(theano.config.floatX)
+    Z = np.random.standard_normal((10, 5, 1)).astype(theano.config.floatX)
+    rnn = SupervisedRnn(2, [3], 1, leaky_coeffs=[np.ones(3) * .5],
+                        use_mask=True, bptt_steps=2, max_iter=10)
+    rnn.fit(X, Z)
+
+
+def check_streams(rnn):
+    X = np.random.standard_normal((6, 3, 2)).astype(theano.config.floatX)
+    Y = rnn.predict(X)
+
+    # Interleave the streams, in changing groups and orders.
+    res = np.empty_like(Y)
+    for t in range(6):
+        res[t, 2] = rnn.step(X[t, [2]], ['c'])[0]
+        res[t, [1, 0]] = rnn.step(X[t, [1, 0]], ['b', 'a'])
+    assert np.allclose(Y, res)
+
+    rnn.reset_streams(['a'])
+    res = np.concatenate([rnn.predict_stream(X[:2], ['a', 'd', 'e']),
+                          rnn.predict_stream(X[2:], ['a', 'd', 'e'])])
+    assert np.allclose(Y, res)
+
+    # Only the most recently used streams are kept.
+    rnn.max_streams = 3
+    rnn.step(X[0, [0]], ['f'])
+    assert rnn._stream_states.keys() == ['d', 'e', 'f']
+    rnn.reset_streams()
+
+
+def test_srnn_streams():
+    check_streams(SupervisedRnn(2, 10, 3, leaky_coeffs=[np.ones(10) * .5]))
+
+
+def test_slstm_streams():
+    check_streams(SupervisedLstm(2, 10, 3, use_mask=True))
+
+
+def test_srnn_streams_masked_leaky():
+    check_streams(SupervisedRnn(2, [10], 3, leaky_coeffs=[np.ones(10) * .5],
+                                use_mask=True))
+
+
+def test_srnn_fit_hessianfree():
+    X = np.random.standard_normal((10, 8, 2)).astype(theano.config.floatX)
+    Z = np.random.standard_normal((10, 8, 3)).astype(theano.config.floatX)
+    rnn = SupervisedRnn(2, 5, 3, optimizer=('hf', {'max_cg_iter': 20}),
+                        batch_size=4)
+    rnn.curvature_batch_size = 2
+    rnn.parameters.data[...] *= 0.1
+    f_loss = rnn.function(['inpt', 'target'], 'loss')
+    loss = f_loss(X, Z)
+    for i, info in enumerate(rnn.iter_fit(X, Z)):
+        if i == 5:
+            break
+    assert f_loss(X, Z) < loss
+    assert 'n_cg_iter' in info
+
+    rnn = SupervisedLstm(2, 5, 3, optimizer='hf', use_mask=True, max_iter=3)
+    rnn.fit(X, Z)
+
+
+def test_srnn_hessianfree_loss_functions():
+    X = np.random.standard_normal((10, 8, 2)).astype(theano.config.floatX)
+    Z = np.random.standard_normal((10, 8, 3)).astype(theano.config.floatX)
+    rnn = SupervisedRnn(2, 5, 3, optimizer='hf')
+    f_loss, f_d_loss = rnn._make_loss_functions()
+    fused = f_loss.im_self
+    loss = rnn.function(['inpt', 'target'], 'loss', explicit_pars=True)
+
+    # Gradient and loss at the same point share a single pass.
+    pars = rnn.parameters.data
+    f_d_loss(pars, X, Z)
+    assert np.allclose(f_loss(pars, X, Z), loss(pars, X, Z))
+    assert fused.n_evals == 1
+
+    # Losses at other points are computed without the gradient.
+    assert np.allclose(f_loss(pars + 1, X, Z), loss(pars + 1, X, Z))
+    assert fused.n_evals == 1
+
+
+def test_srnn_hessianfree_random_state():
+    X = np.random.standard_normal((10, 8, 2)).astype(theano.config.floatX)
+    Z = np.random.standard_normal((10, 8, 3)).astype(theano.config.floatX)
+    rnn = SupervisedRnn(2, 5, 3, optimizer='hf')
+    rnn.curvature_batch_size = 2
+
+    state = np.random.get_state()
+    X1, Z1 = rnn._curvature_args([X, Z], 1)
+    X2, Z2 = rnn._curvature_args([X, Z], 1)
+    # The global generator is left alone.
+    assert np.all(np.random.get_state()[1] == state[1])
+    assert X1.shape == (10, 2, 2) and Z1.shape == (10, 2, 3)
+    assert np.allclose(X1, X2) and np.allclose(Z1, Z2)
+
+
 def test_fd_srnn_fit():
     X = np.random.standard_normal((10, 5, 2)).astype(theano.config.floatX)
     Z = np.random.standard_normal((10, 5, 3)).astype(theano.config.floatX)
@@ -78,6 +350,12 @@ def test_usrnn_transform():
     rnn.transform(X)
 
 
+def test_usrnn_transform_chunked():
+    X = np.random.standard_normal((10, 5, 2)).astype(theano.config.floatX)
+    rnn = UnsupervisedRnn(2, 10, 3, loss=lambda x: T.log(x), max_iter=10)
+    assert np.allclose(rnn.transform(X), rnn.transform(X, max_rows=3))
+
+
 def test_slstm():
     raise SkipTest()
     X = np.random.standard_normal((10, 5, 2)).astype(theano.config.floatX)
@@ -103,6 +381,29 @@ def test_slstm_predict():
     rnn.predict(X)
 
 
+def test_slstm_fit_minibatches():
+    # The number of samples is a multiple of the batch size, so that all
+    # minibatches are full, whichever comes first.
+    X = np.random.standard_normal((10, 4, 2)).astype(theano.config.floatX)
+    Z = np.random.standard_normal((10, 4, 3)).astype(theano.config.floatX)
+    rnn = SupervisedLstm(2, 10, 3, batch_size=2, max_iter=10)
+    # Minibatches are cut across samples, not through time.
+    batch, _ = rnn._make_args(X, Z).next()
+    assert batch[0].shape == (10, 2, 2)
+    assert batch[1].shape == (10, 2, 3)
+    rnn.fit(X, Z)
+    assert np.allclose(rnn.predict(X), rnn.predict(X, max_rows=2))
+
+    rnn = SupervisedLstm(2, 10, 3, pooling='mean', batch_size=2)
+    batch, _ = rnn._make_args(X, Z.mean(axis=0)).next()
+    assert batch[0].shape == (10, 2, 2)
+    assert batch[1].shape == (2, 3)
+
+    rnn = UnsupervisedLstm(2, 10, 3, loss=lambda x: T.log(x), batch_size=2)
+    batch, _ = rnn._make_args(X).next()
+    assert batch[0].shape == (10, 2, 2)
+
+
 def test_uslstm_fit():
     raise SkipTest()
     X = np.random.standard_normal((10, 5, 2)).astype(theano.config.floatX)
@@ -172,3 +473,19 @@ def test_gn_product_rnn():
     Gp = f_Hp(rnn.parameters.data, p, X, Z)
 
     assert np.allclose(Gp, Gp_expl)
+
+
+def test_srnn_fit_resident_data():
+    X = np.random.standard_normal((10, 5, 2)).astype(theano.config.floatX)
+    Z = np.random.standard_normal((10, 5, 3)).astype(theano.config.floatX)
+    rnn = SupervisedRnn(2, 10, 3, max_iter=10, batch_size=2)
+    rnn.resident_data = True
+    rnn.fit(X, Z)
+
+
+def test_srnn_fit_prefetch():
+    X = np.random.standard_normal((10, 5, 2)).astype(theano.config.floatX)
+    Z = np.random.standard_normal((10, 5, 3)).astype(theano.config.floatX)
+    rnn = SupervisedRnn(2, 10, 3, max_iter=10, batch_size=2)
+    rnn.prefetch = 3
+    rnn.fit(X, Z)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from breze.learn import sequences
+from breze.learn.data import (padzeros, interpolate, split, collapse,
+                              uncollapse, consecutify, windowify,
+                              WindowDataset)
+from breze.learn.sequences import PackedSequences
+
+
+def make_seqs(dtype='float32'):
+    return [np.arange(i * 2, dtype=dtype).reshape((i, 2)) + i
+            for i in [3, 1, 5, 4]]
+
+
+def test_pack_unpack():
+    seqs = make_seqs()
+    data, offsets = sequences.pack(seqs)
+    assert data.dtype == np.float32
+    assert list(offsets) == [0, 3, 4, 9, 13]
+    assert list(sequences.positions(offsets)[:5]) == [0, 1, 2, 0, 0]
+    assert all((i == j).all() for i, j in
+               zip(seqs, sequences.unpack(data, offsets)))
+
+
+def test_pad_and_mask():
+    seqs = make_seqs('int32')
+    padded = padzeros(seqs)
+    assert padded.dtype == np.int32
+    assert padded.shape == (4, 5, 2)
+    for seq, p in zip(seqs, padded):
+        assert (p[5 - len(seq):] == seq).all()
+        assert (p[:5 - len(seq)] == 0).all()
+
+    data, offsets = sequences.pack(seqs)
+    padded = sequences.pad(data, offsets, 6, front=False, time_major=True)
+    mask = sequences.mask(offsets, 6, front=False, time_major=True)
+    assert padded.shape == (6, 4, 2)
+    assert (mask.sum(axis=0) == [3, 1, 5, 4]).all()
+    assert (padded[:, :, 0][mask == 0] == 0).all()
+    assert (padded[:3, 0] == seqs[0]).all()
+
+
+def test_interpolate_many():
+    seqs = make_seqs()
+    data, offsets = sequences.pack(seqs)
+    for kind in 'linear', 'nearest':
+        res, new_offsets = sequences.interpolate(data, offsets, 3, kind)
+        assert res.dtype == np.float32
+        assert list(sequences.lengths(new_offsets)) == [9, 3, 15, 12]
+        # A sequence of length one stays constant.
+        assert (res[9:12] == seqs[1]).all()
+        for seq, r in zip(seqs, sequences.unpack(res, new_offsets)):
+            if len(seq) > 1:
+                assert np.allclose(r, interpolate(seq, 3, kind))
+                assert np.allclose(r[[0, -1]], seq[[0, -1]])
+
+
+def test_split_collapse():
+    seqs = make_seqs()
+    pieces = split(seqs, 2)
+    assert [len(i) for i in pieces] == [2, 1, 1, 2, 2, 1, 2, 2]
+    assert (np.concatenate(pieces) == np.concatenate(seqs)).all()
+
+    collapsed = collapse(seqs, 2)
+    assert [i.shape for i in collapsed] == [(1, 4), (0, 4), (2, 4), (2, 4)]
+    assert (collapsed[2][1] == seqs[2][2:4].ravel()).all()
+    uncollapsed = uncollapse(collapsed, 2)
+    assert (uncollapsed[3] == seqs[3]).all()
+
+
+def test_consecutify():
+    seqs = make_seqs('int64')
+    block, views = consecutify(seqs)
+    assert block.dtype == np.int64
+    views[1][...] = -1
+    assert (block[3] == -1).all()
+
+
+def test_packed_sequences():
+    seqs = make_seqs()
+    packed = PackedSequences.from_list(seqs)
+    assert len(packed) == 4
+    assert (packed[2] == seqs[2]).all()
+    assert (packed[-1] == seqs[-1]).all()
+
+    sub = packed[1:3]
+    assert list(sub.lengths) == [1, 5]
+    assert np.may_share_memory(sub.data, packed.data)
+    taken = packed[[3, 0]]
+    assert (taken[0] == seqs[3]).all() and (taken[1] == seqs[0]).all()
+
+    pieces = packed.split(2)
+    assert pieces.data is packed.data
+    assert list(pieces.lengths) == [2, 1, 1, 2, 2, 1, 2, 2]
+    assert [i.shape for i in split(packed, 2).to_list()] == [
+        i.shape for i in split(seqs, 2)]
+
+    assert all((i == j).all() for i, j in
+               zip(collapse(packed, 2), collapse(seqs, 2)))
+    assert (padzeros(packed) == padzeros(seqs)).all()
+
+
+def test_packed_diff():
+    seqs = make_seqs() + [np.zeros((0, 2), dtype='float32')]
+    diff = PackedSequences.from_list(seqs).diff()
+    assert list(diff.lengths) == [2, 0, 4, 3, 0]
+    for seq, d in zip(seqs, diff):
+        assert np.allclose(d, seq[1:] - seq[:-1])
+
+
+def test_packed_windows():
+    seqs = make_seqs()
+    packed = PackedSequences.from_list(seqs)
+    for size, offset in [(2, 1), (3, 2)]:
+        desired = windowify(seqs, size, offset)
+        assert np.allclose(windowify(packed, size, offset), desired)
+        assert np.allclose(WindowDataset(packed, size, offset), desired)
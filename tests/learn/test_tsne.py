@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 
 import numpy as np
+import scipy.sparse
 import theano
 
-from breze.learn.tsne import Tsne
+from breze.learn.tsne import (
+    Tsne, barnes_hut_loss_and_gradient, bisect_precisions,
+    conditional_probabilities, nearest_neighbours, neighbour_probabilities,
+    sparse_neighbour_probabilities)
 
 
 def test_tsne():
@@ -11,3 +15,109 @@ def test_tsne():
     tsne = Tsne(n_inpt=3, n_lowdim=2, perplexity=40, early_exaggeration=50,
                 max_iter=10)
     E = tsne.fit_transform(X)
+
+
+def test_barnes_hut_gradient():
+    rng = np.random.RandomState(0)
+    Y = rng.standard_normal((50, 2))
+    P = rng.random_sample((50, 50))
+    P[range(50), range(50)] = 0
+    P += P.T
+    P /= P.sum()
+
+    diff = Y[:, np.newaxis] - Y[np.newaxis]
+    q = 1 / (1 + (diff ** 2).sum(axis=2))
+    q[range(50), range(50)] = 0
+    desired = 4 * (((P - q / q.sum()) * q)[:, :, np.newaxis] * diff).sum(axis=1)
+
+    _, exact = barnes_hut_loss_and_gradient(
+        Y, scipy.sparse.csr_matrix(P), theta=0)
+    assert np.allclose(exact, desired)
+
+    _, approx = barnes_hut_loss_and_gradient(
+        Y, scipy.sparse.csr_matrix(P), theta=0.5)
+    assert abs(approx - desired).max() < 0.1 * abs(desired).max()
+
+
+def test_tsne_barnes_hut():
+    rng = np.random.RandomState(0)
+    X = np.vstack([rng.standard_normal((50, 3)),
+                   rng.standard_normal((50, 3)) + 20])
+    X = X.astype(theano.config.floatX)
+    tsne = Tsne(n_inpt=3, n_lowdim=2, perplexity=10, early_exaggeration=50,
+                max_iter=200, method='barnes_hut')
+    E = tsne.fit_transform(X)
+    assert E.shape == (100, 2)
+
+    # Nearest neighbours in the embedding are from the same cluster.
+    dists = ((E[:, np.newaxis] - E[np.newaxis]) ** 2).sum(axis=2)
+    dists[range(100), range(100)] = np.inf
+    labels = np.repeat([0, 1], 50)
+    assert (labels[dists.argmin(axis=1)] == labels).mean() > 0.95
+
+
+def test_nearest_neighbours():
+    rng = np.random.RandomState(0)
+    for d in [3, 20]:
+        X = rng.standard_normal((80, d))
+        dists, indices = nearest_neighbours(X, 5, chunk_size=30)
+        full = ((X[:, np.newaxis] - X[np.newaxis]) ** 2).sum(axis=2)
+        full[range(80), range(80)] = np.inf
+        desired = np.sort(full, axis=1)[:, :5]
+        assert np.allclose(np.sort(dists, axis=1), desired)
+        assert np.allclose(full[np.arange(80)[:, np.newaxis], indices], dists)
+
+
+def test_sparse_neighbour_probabilities():
+    rng = np.random.RandomState(0)
+    X = rng.standard_normal((60, 3))
+    P = sparse_neighbour_probabilities(X, 10)
+    assert isinstance(P, scipy.sparse.csr_matrix)
+    assert P.nnz <= 2 * 60 * 30
+    assert np.allclose(P.sum(), 1)
+    assert np.allclose(P.toarray(), P.toarray().T)
+
+    # With all points as neighbours, the result equals the dense one.
+    P = sparse_neighbour_probabilities(X, 10, n_neighbours=59).toarray()
+    assert np.allclose(P, neighbour_probabilities(X, 10), atol=1e-6)
+
+
+def test_neighbour_probabilities_large_scale():
+    rng = np.random.RandomState(0)
+    X = rng.standard_normal((60, 3))
+    # All terms of the neighbourhoods underflow for the initial precisions,
+    # which are scaled down accordingly.
+    X_scaled = X * 100
+    assert np.allclose(sparse_neighbour_probabilities(X_scaled, 10).toarray(),
+                       sparse_neighbour_probabilities(X, 10).toarray(),
+                       atol=1e-6)
+    assert np.allclose(neighbour_probabilities(X_scaled, 10),
+                       neighbour_probabilities(X, 10), atol=1e-6)
+
+    dists, _ = nearest_neighbours(X_scaled, 30)
+    precisions = bisect_precisions(dists, 10)
+    p_cond = conditional_probabilities(dists, precisions)
+    assert np.allclose(p_cond.sum(axis=1), 1)
+    entropy = -(p_cond * np.log(np.maximum(p_cond, 1E-12))).sum(axis=1)
+    assert np.allclose(entropy, np.log(10), atol=1e-4)
+
+
+def test_tsne_transform():
+    rng = np.random.RandomState(0)
+    centers = rng.standard_normal((3, 5)) * 10
+    X = np.vstack([rng.standard_normal((50, 5)) + i for i in centers])
+    X = X.astype(theano.config.floatX)
+    X_new = np.vstack([rng.standard_normal((5, 5)) + i for i in centers])
+    X_new = X_new.astype(theano.config.floatX)
+
+    tsne = Tsne(n_inpt=5, n_lowdim=2, perplexity=10, max_iter=200,
+                method='barnes_hut')
+    E = tsne.fit_transform(X)
+    E_new = tsne.transform(X_new)
+    assert E_new.shape == (15, 2)
+    assert (tsne.embeddings == E).all()
+
+    # New points are placed next to their cluster.
+    dists = ((E_new[:, np.newaxis] - E[np.newaxis]) ** 2).sum(axis=2)
+    labels = np.repeat([0, 1, 2], 50)
+    assert (labels[dists.argmin(axis=1)] == np.repeat([0, 1, 2], 5)).all()